@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import threading
+import time
+
+# Account values of one BALANCE reply and the unix time it was received
+AccountSnapshot = collections.namedtuple("AccountSnapshot", "balance equity margin margin_free time")
+
+
+class AccountService:
+    """
+    Keeps a snapshot of the account balance and equity up to date from a
+    background thread.
+
+    The account is requested every `interval` seconds and after `refresh`
+    is called, e.g. on trade transactions. Requests asked for while one is
+    running are served by a single following request.
+
+    `snapshot` is replaced as a whole by the thread, so reading it never
+    waits for a request.
+
+    Params:
+
+      - `request`: callable sending a BALANCE request and returning the reply
+      - `interval` (default: `1.0`): seconds between requests, `0` or `None`
+        to request the account only when `refresh` is called
+      - `notify` (default: `None`): callable receiving request errors
+    """
+
+    def __init__(self, request, interval=1.0, notify=None):
+        self._request = request
+        self.interval = interval or None
+        self._notify = notify
+
+        self.snapshot = AccountSnapshot(0.0, 0.0, 0.0, 0.0, None)
+        self.requests = 0  # BALANCE requests sent
+        self.errors = 0  # requests that failed
+
+        self._wanted = threading.Event()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._t_refresh, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread. Can be called more than once"""
+        if self._thread is None:
+            return
+        self._stop = True
+        self._wanted.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def refresh(self):
+        """Asks the background thread for a new snapshot, without waiting for it"""
+        self._wanted.set()
+
+    def update(self):
+        """Requests the account and returns the new snapshot"""
+        self.requests += 1
+        try:
+            reply = self._request()
+            snapshot = AccountSnapshot(
+                float(reply["balance"]),
+                float(reply["equity"]),
+                float(reply.get("margin", 0.0)),
+                float(reply.get("margin_free", 0.0)),
+                time.time(),
+            )
+        except KeyError:
+            # error reply without account values
+            self.errors += 1
+            return self.snapshot
+        except Exception as e:
+            self.errors += 1
+            if self._notify is not None:
+                self._notify(e)
+            return self.snapshot
+
+        self.snapshot = snapshot
+        return snapshot
+
+    def _t_refresh(self):
+        while True:
+            self._wanted.wait(self.interval)
+            if self._stop:
+                break
+            self._wanted.clear()
+            self.update()
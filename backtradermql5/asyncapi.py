@@ -0,0 +1,205 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import collections
+
+import zmq
+import zmq.asyncio
+
+from backtradermql5.codec import getcodec
+from backtradermql5.mt5store import MTraderAPI, ServerConfigError, ServerDataError, IndicatorError, getports
+
+
+class AsyncMTraderAPI:
+    """
+    asyncio client for the MQL5 JSON API with pipelined requests.
+
+    Requests go out on a DEALER socket, so any number of them can be in
+    flight. The terminal serves requests one at a time and answers them in
+    order on the DATA and INDICATOR_DATA sockets, so replies are matched to
+    requests first in, first out.
+
+    The terminal pushes replies round robin to every connected client.
+    Do not use this class next to an `MTraderStore` connected to the same
+    terminal.
+
+    Usage:
+
+        async with AsyncMTraderAPI(host="localhost") as api:
+            balance, history = await asyncio.gather(
+                api.balance(), api.history("EURUSD", "M1", begin, end)
+            )
+    """
+
+    def __init__(self, host="localhost", datatimeout=10, codec="json", debug=False, context=None, ports=None):
+        self.HOST = host
+        sys_port, data_port, _, _, indicator_data_port, _ = getports(ports)
+        self.debug = debug
+        self.codec = getcodec(codec)
+        self.sys_timeout = 1
+        self.data_timeout = datatimeout
+
+        self.context = context or zmq.asyncio.Context.instance()
+        try:
+            self.sys_socket = self.context.socket(zmq.DEALER)
+            self.sys_socket.connect("tcp://{}:{}".format(self.HOST, sys_port))
+
+            self.data_socket = self.context.socket(zmq.PULL)
+            self.data_socket.set_hwm(1000)
+            self.data_socket.connect("tcp://{}:{}".format(self.HOST, data_port))
+
+            self.indicator_data_socket = self.context.socket(zmq.PULL)
+            self.indicator_data_socket.connect("tcp://{}:{}".format(self.HOST, indicator_data_port))
+        except zmq.ZMQError:
+            raise zmq.ZMQBindError("Binding ports ERROR")
+
+        # futures waiting for the "OK" of the terminal and for replies, in request order
+        self._acks = collections.deque()
+        self._replies = {self.data_socket: collections.deque(), self.indicator_data_socket: collections.deque()}
+        self._send_lock = None
+        self._readers = list()
+        self._last = None  # future of the last request sent, set to the loop time it settled
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        for task in self._readers:
+            task.cancel()
+        self._readers = list()
+        for socket in (self.sys_socket, self.data_socket, self.indicator_data_socket):
+            socket.close(linger=0)
+
+    def _start_readers(self):
+        self._send_lock = asyncio.Lock()
+        self._readers = [
+            asyncio.ensure_future(self._read_acks()),
+            asyncio.ensure_future(self._read_replies(self.data_socket)),
+            asyncio.ensure_future(self._read_replies(self.indicator_data_socket)),
+        ]
+
+    async def _read_acks(self):
+        while True:
+            _, msg = await self.sys_socket.recv_multipart()
+            ack, reply = self._acks.popleft()
+            msg = msg.decode("utf8")
+            if msg == "OK":
+                if not ack.done():
+                    ack.set_result(msg)
+                continue
+
+            # the terminal will not answer a rejected request
+            self._replies[reply[0]].remove(reply[1])
+            if not ack.done():
+                ack.set_exception(zmq.NotDone("Something wrong on server side"))
+
+    async def _read_replies(self, socket):
+        replies = self._replies[socket]
+        while True:
+            msg = self.codec.loads(await socket.recv())
+            if self.debug:
+                print("ZMQ ASYNC REPLY: ", msg)
+            # a reply whose request timed out is discarded
+            fut = replies.popleft()
+            if not fut.done():
+                fut.set_result(msg)
+
+    async def _request(self, request, socket):
+        if not self._readers:
+            self._start_readers()
+
+        loop = asyncio.get_event_loop()
+        ack, reply, settled = loop.create_future(), loop.create_future(), loop.create_future()
+        try:
+            async with self._send_lock:
+                prev, self._last = self._last, settled
+                self._acks.append((ack, (socket, reply)))
+                self._replies[socket].append(reply)
+                await self.sys_socket.send_multipart([b"", self.codec.dumps(request)])
+            t_sent = loop.time()
+
+            if self.debug:
+                print("ZMQ ASYNC REQUEST: ", request)
+
+            # The terminal answers "OK" only after it served the previous request
+            deadline = t_sent
+            if prev is not None and not ack.done():
+                deadline = max(t_sent, await asyncio.shield(prev))
+            try:
+                await asyncio.wait_for(asyncio.shield(ack), max(0.0, deadline + self.sys_timeout - loop.time()))
+            except asyncio.TimeoutError:
+                raise zmq.NotDone("Sending request ERROR")
+
+            try:
+                return await asyncio.wait_for(asyncio.shield(reply), self.data_timeout)
+            except asyncio.TimeoutError:
+                raise zmq.NotDone("Data socket timeout ERROR")
+        finally:
+            settled.set_result(loop.time())
+
+    async def construct_and_send(self, **kwargs) -> dict:
+        """Construct a request dictionary from default, send it to server and await the reply"""
+        return await self._request(MTraderAPI.construct_request(**kwargs), self.data_socket)
+
+    async def indicator_construct_and_send(self, **kwargs) -> dict:
+        """Construct an indicator request dictionary from default, send it to server and await the reply"""
+        return await self._request(MTraderAPI.construct_indicator_request(**kwargs), self.indicator_data_socket)
+
+    async def account(self) -> dict:
+        conf = await self.construct_and_send(action="ACCOUNT")
+        if conf["error"]:
+            raise ServerDataError(conf)
+        return conf
+
+    async def balance(self) -> dict:
+        return await self.construct_and_send(action="BALANCE")
+
+    async def positions(self) -> list:
+        positions = await self.construct_and_send(action="POSITIONS")
+        return positions.get("positions", [])
+
+    async def config(self, symbol, granularity) -> None:
+        """Subscribe the terminal to the live data of a symbol and granularity (e.g. "M1")"""
+        ret_val = await self.construct_and_send(action="CONFIG", symbol=symbol, chartTF=granularity)
+        if ret_val["error"]:
+            raise ServerConfigError(ret_val["description"])
+
+    async def history(self, symbol, granularity, begin=None, end=None) -> list:
+        """History rows of a symbol between two unix timestamps"""
+        data = await self.construct_and_send(
+            action="HISTORY", actionType="DATA", symbol=symbol, chartTF=granularity, fromDate=begin, toDate=end
+        )
+        return data["data"]
+
+    async def trade(self, **kwargs) -> dict:
+        """Send a TRADE request, e.g. `trade(actionType="ORDER_TYPE_BUY", symbol="EURUSD", volume=0.1)`"""
+        ret_val = await self.construct_and_send(action="TRADE", **kwargs)
+        if ret_val["error"]:
+            raise ServerDataError(ret_val)
+        return ret_val
+
+    async def indicator_attach(self, symbol, granularity, name, id, params, linecount) -> dict:
+        ret_val = await self.indicator_construct_and_send(
+            action="INDICATOR",
+            actionType="ATTACH",
+            symbol=symbol,
+            chartTF=granularity,
+            name=name,
+            id=id,
+            params=params,
+            linecount=linecount,
+        )
+        if ret_val["error"]:
+            raise IndicatorError(ret_val["description"])
+        return ret_val
+
+    async def indicator_data(self, id, fromDate) -> dict:
+        ret_val = await self.indicator_construct_and_send(
+            action="INDICATOR", actionType="REQUEST", id=id, fromDate=fromDate
+        )
+        if ret_val["error"]:
+            raise IndicatorError(ret_val["description"])
+        return ret_val
@@ -0,0 +1,415 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import calendar
+import collections
+import time
+from datetime import datetime
+
+import numpy as np
+from backtrader.utils.py3 import queue
+
+# Candle length in seconds of MTrader granularities. MN1 is a calendar month
+PERIODS = {
+    "M1": 60,
+    "M5": 300,
+    "M15": 900,
+    "M30": 1800,
+    "H1": 3600,
+    "H2": 7200,
+    "H3": 10800,
+    "H4": 14400,
+    "H6": 21600,
+    "H8": 28800,
+    "H12": 43200,
+    "D1": 86400,
+    "W1": 604800,
+    "MN1": 2592000,
+}
+
+# Weeks open on Sunday, 1970-01-04 was the first one after the epoch
+_WEEK_OFFSET = 4 * 86400
+
+
+def derivable(granularity, base):
+    """True if the candles of `granularity` can be built from closed candles of `base`"""
+    if granularity == base or base not in PERIODS or granularity not in PERIODS or base in ("W1", "MN1"):
+        return False
+    if granularity in ("W1", "MN1"):
+        return 86400 % PERIODS[base] == 0
+    return PERIODS[granularity] % PERIODS[base] == 0
+
+
+def bar_open(t, granularity):
+    """Open time of the candle of `granularity` containing the unix time `t`"""
+    if granularity == "MN1":
+        d = datetime.utcfromtimestamp(t)
+        return calendar.timegm((d.year, d.month, 1, 0, 0, 0))
+    if granularity == "W1":
+        return t - (t + _WEEK_OFFSET) % PERIODS["W1"]
+    return t - t % PERIODS[granularity]
+
+
+def bar_close(start, granularity):
+    """Close time of the candle of `granularity` opened at `start`"""
+    if granularity == "MN1":
+        d = datetime.utcfromtimestamp(start)
+        year, month = (d.year + 1, 1) if d.month == 12 else (d.year, d.month + 1)
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+    return start + PERIODS[granularity]
+
+
+def bar_opens(times, granularity):
+    """Vectorized `bar_open` for an array of unix times"""
+    times = np.asarray(times, dtype=np.int64)
+    if granularity == "MN1":
+        months = times.astype("datetime64[s]").astype("datetime64[M]")
+        return months.astype("datetime64[s]").astype(np.int64)
+    if granularity == "W1":
+        return times - (times + _WEEK_OFFSET) % PERIODS["W1"]
+    return times - times % PERIODS[granularity]
+
+
+class BarAggregator:
+    """
+    Builds the candles of `granularity` from the closed candles of the
+    finer `base` granularity, one base candle at a time in constant time.
+
+    A candle is complete when its last base candle arrives or, after a gap,
+    with the first base candle of a later candle. Base candles not newer
+    than the last one are ignored, so a history and the live candles
+    following it can overlap.
+
+    Candles are `[time, open, high, low, close, volume, spread]` lists as in
+    HISTORY replies and live messages. Volumes are summed, the spread is the
+    one of the last base candle.
+    """
+
+    def __init__(self, granularity, base):
+        if not derivable(granularity, base):
+            raise ValueError("{} candles can not be built from {} candles".format(granularity, base))
+        self.granularity = granularity
+        self.base = base
+        self.ratio = max(1, PERIODS[granularity] // PERIODS[base])  # base candles per candle
+        self.bar = None  # candle being built
+        self.last = None  # time of the last base candle
+        self._baseperiod = PERIODS[base]
+        self._close = None  # close time of the candle being built
+
+    def history_begin(self, t):
+        """Start of the base history for candles from the unix time `t`: the open
+        of its day, week or month, so feeds built from the same base share it"""
+        return bar_open(t, self.granularity if self.granularity in ("W1", "MN1") else "D1")
+
+    def aggregate(self, price_data, include_last=False):
+        """Candles of a columnar array of base candles, see `aggregate_array`"""
+        return aggregate_array(price_data, self.granularity, self.base, include_last)
+
+    def history_end(self):
+        """Returns the candles completed by the end of a history download. None,
+        a complete candle is returned with its last base candle"""
+        return ()
+
+    def update(self, row):
+        """Adds a closed base candle. Returns the candles it completed, oldest first"""
+        t = row[0]
+        if self.last is not None and t <= self.last:
+            return ()
+        self.last = t
+
+        done = ()
+        bar = self.bar
+        if bar is not None and t >= self._close:
+            done, bar = (bar,), None
+
+        if bar is None:
+            start = bar_open(t, self.granularity)
+            self._close = bar_close(start, self.granularity)
+            bar = [start, row[1], row[2], row[3], row[4], row[5], row[6]]
+        else:
+            if row[2] > bar[2]:
+                bar[2] = row[2]
+            if row[3] < bar[3]:
+                bar[3] = row[3]
+            bar[4] = row[4]
+            bar[5] += row[5]
+            bar[6] = row[6]
+
+        if t + self._baseperiod >= self._close:
+            self.bar = None
+            return done + (bar,)
+        self.bar = bar
+        return done
+
+
+def aggregate_array(price_data, granularity, base, include_last=False):
+    """Candles of `granularity` built from a columnar array of `base` candles
+    (rows time, open, high, low, close, volume, spread). The last candle is
+    dropped if it is not complete, unless `include_last`"""
+    if not price_data.shape[1]:
+        return np.empty((7, 0))
+
+    times = price_data[0].astype(np.int64)
+    opens = bar_opens(times, granularity)
+    starts = np.flatnonzero(np.diff(opens)) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.append(starts[1:], len(times)) - 1
+
+    bars = np.empty((7, len(starts)))
+    bars[0] = opens[starts]
+    bars[1] = price_data[1][starts]
+    bars[2] = np.maximum.reduceat(price_data[2], starts)
+    bars[3] = np.minimum.reduceat(price_data[3], starts)
+    bars[4] = price_data[4][ends]
+    bars[5] = np.add.reduceat(price_data[5], starts)
+    bars[6] = price_data[6][ends]
+
+    if not include_last and times[-1] + PERIODS[base] < bar_close(int(opens[-1]), granularity):
+        bars = bars[:, :-1]
+    return np.ascontiguousarray(bars)
+
+
+class DerivedHistory:
+    """Queue-like view of a history download of base candles or ticks,
+    returning the candles of a `BarAggregator` or `TickBarAggregator` and
+    ending with `{}` (or `None` on failure). The last candle is returned only
+    if complete, unless `include_last`"""
+
+    def __init__(self, reader, aggregator, include_last=False):
+        self.reader = reader
+        self.aggregator = aggregator
+        self.include_last = include_last
+        self._ratio = aggregator.ratio
+        self._pending = collections.deque()
+
+    def get(self, block=True, timeout=None):
+        while not self._pending:
+            row = self.reader.get(block, timeout)
+            if not row:
+                if row == {} and self.aggregator.bar is not None:
+                    if self.include_last:
+                        # the candle being built goes on with the live candles
+                        self._pending.append(list(self.aggregator.bar))
+                    else:
+                        self._pending.extend(self.aggregator.history_end())
+                self._pending.append(row)
+                break
+            self._pending.extend(self.aggregator.update(row))
+        return self._pending.popleft()
+
+    def qsize(self):
+        return len(self._pending) + self.reader.qsize() // self._ratio
+
+    def close(self):
+        if hasattr(self.reader, "close"):
+            self.reader.close()
+
+
+class DerivedQueue:
+    """Live queue of base candle messages returning the messages of the
+    candles of a `BarAggregator`. Status messages are passed on"""
+
+    def __init__(self, q, aggregator):
+        self.queue = q
+        self.aggregator = aggregator
+        self._pending = collections.deque()
+
+    def get(self, block=True, timeout=None):
+        while not self._pending:
+            msg = self.queue.get(block, timeout)
+            if not msg or not msg.get("data") or msg.get("timeframe") != self.aggregator.base:
+                return msg
+            for bar in self.aggregator.update(msg["data"]):
+                self._pending.append(dict(msg, timeframe=self.aggregator.granularity, data=bar))
+        return self._pending.popleft()
+
+    def qsize(self):
+        return len(self._pending) + self.queue.qsize()
+
+
+def _tick_price(bid, ask, price):
+    if price == "bid":
+        return bid
+    if price == "ask":
+        return ask
+    return (bid + ask) / 2.0
+
+
+class TickBarAggregator:
+    """
+    Builds bars of `seconds` from ticks, one tick at a time in constant time.
+
+    Bars open at multiples of `seconds` since the epoch and are
+    `[time, open, high, low, close, volume, spread]` lists like candles, with
+    the open time in seconds, the number of ticks as volume and a spread of
+    0. `price` is the `bid`, the `ask` or the `mid` of the ticks.
+
+    A bar is complete with the first tick of a later bar, or with `expire`
+    once its close time passed. Periods without ticks have no bar. Ticks older
+    than the bar being built are dropped and counted in `dropped`.
+
+    `end` is the time in ms up to which a history download has every tick,
+    the `todate` of a historical feed. The last bar of the history is complete
+    if it closes by then, otherwise it goes on with the live ticks.
+    """
+
+    base = "TICK"
+    ratio = 1  # the ticks per bar are not known
+
+    def __init__(self, seconds, price="bid", end=None):
+        if seconds <= 0:
+            raise ValueError("Tick bars need a length of at least one second, not {}".format(seconds))
+        if price not in ("bid", "ask", "mid"):
+            raise ValueError("Tick bar price must be bid, ask or mid, not {!r}".format(price))
+        self.seconds = int(seconds)
+        self.price = price
+        self.bar = None  # bar being built
+        self.close = None  # close time of the bar being built, in ms
+        self.last = None  # time of the last tick, in ms
+        self.dropped = 0
+        self.end = end
+        self._period = self.seconds * 1000
+
+    def history_begin(self, t):
+        """Start of the tick history for bars from the unix time `t`"""
+        return t - t % self.seconds
+
+    def update(self, tick):
+        """Adds a `[time in ms, bid, ask]` tick. Returns the bars it completed"""
+        t = tick[0]
+        if self.last is not None and t < self.last:
+            self.dropped += 1
+            return ()
+        self.last = t
+
+        price = _tick_price(tick[1], tick[2], self.price)
+        bar = self.bar
+        if bar is not None:
+            if t < self.close:
+                if price > bar[2]:
+                    bar[2] = price
+                elif price < bar[3]:
+                    bar[3] = price
+                bar[4] = price
+                bar[5] += 1
+                return ()
+            done = (bar,)
+        else:
+            done = ()
+
+        start = t - t % self._period
+        self.close = start + self._period
+        self.bar = [start // 1000, price, price, price, price, 1, 0]
+        return done
+
+    def expire(self, now):
+        """Completes the bar being built if its close time is not after `now`,
+        in ms of the tick times. Returns the completed bars"""
+        bar = self.bar
+        if bar is None or now < self.close:
+            return ()
+        self.bar = None
+        # ticks of the closed bar arriving now are too late
+        if self.last < self.close:
+            self.last = self.close
+        return (bar,)
+
+    def history_end(self):
+        """Returns the last bar of a history download if it closes by `end`"""
+        if self.end is None:
+            return ()
+        return self.expire(self.end)
+
+    def aggregate(self, price_data, include_last=False):
+        """Bars of a columnar array of ticks, see `aggregate_ticks`"""
+        return aggregate_ticks(price_data, self.seconds, self.price, include_last, self.end)
+
+
+def aggregate_ticks(price_data, seconds, price="bid", include_last=False, end=None):
+    """Bars of `seconds` built from a columnar array of ticks (rows time in
+    ms, bid, ask), as `TickBarAggregator` builds them. The last bar is
+    dropped unless `include_last` or it closes by `end`, in ms"""
+    if not price_data.shape[1]:
+        return np.empty((7, 0))
+
+    times = price_data[0].astype(np.int64)
+    # ticks of a download are sorted, ties keep their order
+    opens = times // 1000 - times // 1000 % seconds
+    prices = _tick_price(price_data[1], price_data[2], price)
+    starts = np.flatnonzero(np.diff(opens)) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.append(starts[1:], len(times))
+
+    bars = np.empty((7, len(starts)))
+    bars[0] = opens[starts]
+    bars[1] = prices[starts]
+    bars[2] = np.maximum.reduceat(prices, starts)
+    bars[3] = np.minimum.reduceat(prices, starts)
+    bars[4] = prices[ends - 1]
+    bars[5] = ends - starts
+    bars[6] = 0
+
+    if not include_last and (end is None or (bars[0, -1] + seconds) * 1000 > end):
+        bars = bars[:, :-1]
+    return np.ascontiguousarray(bars)
+
+
+class TickBarQueue:
+    """
+    Live queue of tick messages returning the bar messages of a
+    `TickBarAggregator`. Status messages are passed on.
+
+    A bar is also returned at its close time when no later tick arrives. Tick
+    times are in the clock of the trade server: its offset to the local clock
+    is taken from the ticks received. A bar is held `grace` seconds past its
+    close for ticks still on their way, and as long as messages keep coming
+    within `grace` seconds of each other, so a backlog of ticks is read before
+    its bar closes.
+    """
+
+    def __init__(self, q, aggregator, grace=0.1):
+        self.queue = q
+        self.aggregator = aggregator
+        self.grace = grace
+        self.offset = None  # ms the tick times are ahead of the local clock, at most
+        self._received = 0.0  # local time of the last message
+        self._pending = collections.deque()
+        self._msg = None  # last tick message, to address the bars closed by time
+
+    def _now(self):
+        return time.time() * 1000.0 + self.offset
+
+    def get(self, block=True, timeout=None):
+        aggregator = self.aggregator
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._pending:
+            wait = deadline
+            if aggregator.bar is not None and self.offset is not None:
+                close = max((aggregator.close - self.offset) / 1000.0, self._received) + self.grace
+                wait = close if wait is None else min(wait, close)
+            try:
+                if wait is None:
+                    msg = self.queue.get(block)
+                else:
+                    msg = self.queue.get(block, max(0.0, wait - time.time()))
+            except queue.Empty:
+                if self.offset is not None and time.time() - self._received >= self.grace:
+                    for bar in aggregator.expire(self._now() - self.grace * 1000.0):
+                        self._pending.append(dict(self._msg, data=bar))
+                if not self._pending and (not block or (deadline is not None and time.time() >= deadline)):
+                    raise
+                continue
+
+            self._received = time.time()
+            if not msg or not msg.get("data") or msg.get("timeframe") != "TICK":
+                return msg
+            tick = msg["data"]
+            offset = tick[0] - self._received * 1000.0
+            if self.offset is None or offset > self.offset:
+                self.offset = offset
+            self._msg = msg
+            for bar in aggregator.update(tick):
+                self._pending.append(dict(msg, data=bar))
+        return self._pending.popleft()
+
+    def qsize(self):
+        return len(self._pending) + self.queue.qsize()
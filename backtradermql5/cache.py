@@ -0,0 +1,232 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import hashlib
+import os
+import re
+import weakref
+
+import numpy as np
+
+
+class HistoryCache:
+    """
+    On disk cache of history downloads.
+
+    One npz file per symbol and granularity holds the columnar
+    history (see `MTraderStore.price_data_array`) and the time range it
+    covers. The range is always contiguous, so a request only needs to
+    download what lies before or after it.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, symbol, granularity):
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", "{}_{}".format(symbol, granularity))
+        return os.path.join(self.path, name + ".npz")
+
+    def load(self, symbol, granularity):
+        """Returns `(begin, end, data)` or `None` if nothing is cached.
+        `begin` and `end` are unix timestamps in seconds"""
+        filename = self._filename(symbol, granularity)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            with np.load(filename) as f:
+                begin, end = f["range"].tolist()
+                data = f["data"]
+        except (OSError, ValueError, KeyError):
+            # damaged file, download again
+            return None
+
+        return int(begin), int(end), data
+
+    def save(self, symbol, granularity, begin, end, data):
+        filename = self._filename(symbol, granularity)
+        rng = np.array([begin, end], dtype=np.int64)
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, range=rng, data=data)
+        os.replace(tmp, filename)
+
+    def clear(self, symbol=None, granularity=None):
+        """Removes the cache of a symbol and granularity or every cache file"""
+        if symbol is not None:
+            filenames = [self._filename(symbol, granularity)]
+        else:
+            filenames = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".npz")]
+
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class IndicatorSeries:
+    """
+    Values of an indicator by bar time: an array of times and an array with
+    a row of values per indicator line.
+
+    Values added bar by bar are merged into the arrays in batches.
+    """
+
+    # Bars added one by one before they are merged into the arrays
+    _BATCH = 1000
+
+    def __init__(self, linecount, times=None, values=None):
+        self.times = np.empty(0, dtype=np.int64) if times is None else times
+        self.values = np.empty((linecount, 0)) if values is None else values
+        self.dirty = False
+        self._bars = dict()
+
+    def add(self, times, values):
+        """Adds the values of many bars. They replace known values in their time range"""
+        self.compact()
+        self._merge(np.asarray(times, dtype=np.int64), np.asarray(values, dtype=np.float64))
+
+    def add_bar(self, time, values):
+        """Adds the values of a single bar"""
+        self._bars[int(time)] = values
+        self.dirty = True
+        if len(self._bars) >= self._BATCH:
+            self.compact()
+
+    def compact(self):
+        """Merges the values added bar by bar into the arrays"""
+        if not self._bars:
+            return
+        bars, self._bars = self._bars, dict()
+        times = np.fromiter(bars, dtype=np.int64, count=len(bars))
+        values = np.array(list(bars.values()), dtype=np.float64).T
+
+        # sort by time, the values added last win
+        times = np.concatenate((self.times, times))[::-1]
+        values = np.concatenate((self.values, values), axis=1)[:, ::-1]
+        times, idx = np.unique(times, return_index=True)
+        self.times, self.values = times, np.ascontiguousarray(values[:, idx])
+
+    def _merge(self, times, values):
+        if not len(times):
+            return
+        keep = (self.times < times[0]) | (self.times > times[-1])
+        times = np.concatenate((self.times[keep], times))
+        values = np.concatenate((self.values[:, keep], values), axis=1)
+        order = np.argsort(times, kind="stable")
+        self.times, self.values = times[order], values[:, order]
+        self.dirty = True
+
+    def get(self, time):
+        """Values of the bar at a unix timestamp or `None`"""
+        values = self._bars.get(time)
+        if values is not None:
+            return values
+        i = np.searchsorted(self.times, time)
+        if i < len(self.times) and self.times[i] == time:
+            return self.values[:, i]
+        return None
+
+    def lookup(self, times):
+        """Indices of bar times in the arrays and a mask of the ones found"""
+        self.compact()
+        if not len(self.times):
+            return np.zeros(len(times), dtype=np.int64), np.zeros(len(times), dtype=bool)
+        idx = np.searchsorted(self.times, times).clip(max=len(self.times) - 1)
+        return idx, self.times[idx] == times
+
+
+class IndicatorCache:
+    """
+    Values of MT5 indicators shared by every indicator with the same name,
+    parameters, symbol and granularity.
+
+    The `maxitems` most recently used series are kept in memory. With a
+    `path` series are also saved to disk, one npz file each, and the least
+    recently used files are removed when they take more than `maxbytes`.
+    """
+
+    def __init__(self, path=None, maxitems=64, maxbytes=512 * 1024 * 1024):
+        self.path = path and os.path.expanduser(path)
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self._series = collections.OrderedDict()
+        self._inuse = weakref.WeakValueDictionary()  # series referenced by indicators
+
+    @staticmethod
+    def key(name, params, symbol, granularity, linecount):
+        return "{}|{}|{}|{}|{}".format(name, ",".join(str(x) for x in params), symbol, granularity, linecount)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf8")).hexdigest() + ".npz")
+
+    def series(self, key, linecount):
+        """Returns the series of an indicator key, loaded from disk or new"""
+        series = self._series.get(key)
+        if series is not None:
+            self._series.move_to_end(key)
+            return series
+
+        series = self._inuse.get(key) or self._load(key, linecount) or IndicatorSeries(linecount)
+        self._inuse[key] = series
+        self._series[key] = series
+        while len(self._series) > self.maxitems:
+            self._save(*self._series.popitem(last=False))
+        return series
+
+    def _load(self, key, linecount):
+        if not self.path:
+            return None
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as f:
+                times, values = f["time"], f["data"]
+            os.utime(filename)
+        except (OSError, ValueError, KeyError):
+            # missing or damaged file
+            return None
+        if values.shape != (linecount, len(times)):
+            return None
+        return IndicatorSeries(linecount, times, values)
+
+    def _save(self, key, series):
+        if not self.path or not series.dirty:
+            return
+        series.compact()
+        filename = self._filename(key)
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, time=series.times, data=series.values)
+        os.replace(tmp, filename)
+        series.dirty = False
+        self._evict(keep=filename)
+
+    def _evict(self, keep):
+        files = list()
+        for name in os.listdir(self.path):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                filename = os.path.join(self.path, name)
+                stat = os.stat(filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total <= self.maxbytes:
+                break
+            if filename != keep:
+                os.remove(filename)
+                total -= size
+
+    def flush(self):
+        """Saves the series changed since they were loaded"""
+        for key, series in list(self._inuse.items()):
+            self._save(key, series)
+
+    def clear(self):
+        """Forgets every series, in memory and on disk"""
+        self._series.clear()
+        self._inuse.clear()
+        if self.path:
+            for name in os.listdir(self.path):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(self.path, name))
@@ -0,0 +1,88 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+
+class JSONCodec:
+    """Standard library JSON, as used by pyzmq `send_json`/`recv_json`"""
+
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """JSON encoded and decoded with `orjson`. Wire compatible with the MQL5 JSON API"""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self._option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj):
+        return self._dumps(obj, option=self._option)
+
+    def loads(self, data):
+        return self._loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack encoded with `msgpack`.
+
+    The MQL5 JSON API expert advisor only speaks JSON, so this codec needs a
+    server on the other side that understands MessagePack (e.g. the mock
+    server)
+    """
+
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+
+    def dumps(self, obj):
+        return self._packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self._unpackb(data, raw=False)
+
+
+CODECS = {
+    "json": JSONCodec,
+    "orjson": OrjsonCodec,
+    "msgpack": MsgpackCodec,
+}
+
+# Codecs speaking the JSON wire format, replaced by the standard library codec without their package
+JSON_CODECS = ("orjson",)
+
+
+def getcodec(codec):
+    """Returns a codec instance for a codec name. Codec instances are passed through.
+    A JSON codec whose package is not installed falls back to the standard library one"""
+    if not isinstance(codec, str):
+        return codec
+
+    try:
+        codeccls = CODECS[codec]
+    except KeyError:
+        raise ValueError("Unknown codec %s. Supported codecs: %s" % (codec, ", ".join(CODECS)))
+
+    try:
+        return codeccls()
+    except ImportError:
+        if codec not in JSON_CODECS:
+            # the server expects this wire format
+            raise ImportError("Codec %s requires the %s package to be installed" % (codec, codec))
+        print("Codec %s requires the %s package to be installed, using json instead" % (codec, codec))
+        return JSONCodec()
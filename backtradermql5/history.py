@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from backtrader.utils.py3 import queue
+
+
+class SharedHistory:
+    """
+    Rows of one history download, read by every data feed asking for the
+    same history.
+
+    The download thread appends rows with `put` and each feed reads them in
+    order through its own `HistoryReader`, so the rows are held once for
+    all feeds. Rows read by every reader are dropped. With `maxrows` the
+    download waits while the slowest reader is `maxrows` rows behind.
+
+    Readers can join until the first row is dropped. `stopped` is set when
+    the last reader left, so the download can end early.
+    """
+
+    # Rows read by all readers are dropped in batches of this size
+    _TRIM = 1024
+
+    def __init__(self, maxrows=0):
+        self.maxrows = maxrows
+        self.stopped = threading.Event()
+        self._rows = list()
+        self._base = 0  # position of _rows[0] in the download
+        self._readers = list()
+        self._full = False  # the download waits for the slowest reader
+        self._cond = threading.Condition()
+
+    def reader(self):
+        """Returns a new `HistoryReader` or `None` if rows were dropped already"""
+        with self._cond:
+            if self._base or self.stopped.is_set():
+                return None
+            reader = HistoryReader(self)
+            self._readers.append(reader)
+            return reader
+
+    def put(self, row):
+        """Appends a row. Returns `False` if there are no readers anymore"""
+        with self._cond:
+            while self.maxrows and len(self._rows) - self._behind() >= self.maxrows:
+                if self.stopped.is_set():
+                    return False
+                self._full = True
+                self._cond.wait(0.5)
+            self._full = False
+            if self.stopped.is_set():
+                return False
+            self._rows.append(row)
+            self._cond.notify_all()
+            return True
+
+    def stop(self):
+        """Ends the download and releases the rows"""
+        with self._cond:
+            self.stopped.set()
+            self._rows = list()
+            self._cond.notify_all()
+
+    def _behind(self):
+        # rows in the buffer read by every reader
+        return min(r.pos for r in self._readers) - self._base if self._readers else 0
+
+    def _get(self, reader, block, timeout):
+        with self._cond:
+            while reader.pos - self._base >= len(self._rows):
+                if self.stopped.is_set():
+                    return None  # the download was stopped
+                if not block or not self._cond.wait(timeout):
+                    raise queue.Empty
+
+            row = self._rows[reader.pos - self._base]
+            reader.pos += 1
+
+            if self._full:
+                self._cond.notify_all()
+            behind = self._behind()
+            if behind >= self._TRIM:
+                del self._rows[:behind]
+                self._base += behind
+            return row
+
+    def _qsize(self, reader):
+        with self._cond:
+            return len(self._rows) - (reader.pos - self._base)
+
+    def _close(self, reader):
+        with self._cond:
+            if reader in self._readers:
+                self._readers.remove(reader)
+            if not self._readers:
+                self.stopped.set()
+                self._rows = list()
+            self._cond.notify_all()
+
+
+class HistoryReader:
+    """Queue-like view of a `SharedHistory` for one data feed. The reader
+    leaves the download after reading its end (`{}` or `None`)"""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.pos = 0  # position of the next row in the download
+
+    def get(self, block=True, timeout=None):
+        row = self.shared._get(self, block, timeout)
+        if not row:
+            self.close()
+        return row
+
+    def qsize(self):
+        return self.shared._qsize(self)
+
+    def close(self):
+        self.shared._close(self)
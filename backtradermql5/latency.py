@@ -0,0 +1,149 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Stages of the order lifecycle measured by LatencyTracker: name -> (from, to)
+STAGES = collections.OrderedDict(
+    (
+        ("submit", ("created", "queued")),  # order object to order thread queue
+        ("queue", ("queued", "sent")),  # waiting in the order thread and the request thread
+        ("ack", ("sent", "acked")),  # wire send to the "OK" of the terminal
+        ("reply", ("sent", "replied")),  # wire send to the reply with the order id
+        ("fill", ("sent", "filled")),  # wire send to the first fill
+        ("total", ("created", "filled")),  # order object to the first fill
+    )
+)
+
+
+class OrderTimes:
+    """
+    `time.monotonic` times of the lifecycle of one order. Times not reached
+    are `None`. `fills` holds the time of every fill, `filled` the first one
+    """
+
+    __slots__ = ("oref", "symbol", "created", "queued", "sent", "acked", "replied", "rejected", "fills")
+
+    def __init__(self, oref, symbol=None):
+        self.oref = oref
+        self.symbol = symbol
+        self.created = time.monotonic()
+        self.queued = self.sent = self.acked = self.replied = None
+        self.rejected = False
+        self.fills = list()
+
+    @property
+    def filled(self):
+        return self.fills[0] if self.fills else None
+
+    def duration(self, stage):
+        """Seconds spent in a stage of `STAGES` or `None` if not reached"""
+        start, end = (getattr(self, x) for x in STAGES[stage])
+        if start is None or end is None:
+            return None
+        return end - start
+
+    def __repr__(self):
+        stages = ", ".join(
+            "{}={:.3f}ms".format(stage, self.duration(stage) * 1000.0)
+            for stage in STAGES
+            if self.duration(stage) is not None
+        )
+        return "OrderTimes(oref={}, symbol={}, {})".format(self.oref, self.symbol, stages)
+
+
+class LatencyTracker:
+    """
+    Records the lifecycle times of orders and keeps rolling samples of the
+    time spent in each of the `STAGES`.
+
+    The records of the last `maxorders` orders are kept, and the last
+    `maxorders` samples of each stage.
+    """
+
+    def __init__(self, maxorders=1000):
+        self.maxorders = maxorders
+        self._orders = collections.OrderedDict()  # oref -> OrderTimes
+        self._samples = {stage: collections.deque(maxlen=maxorders) for stage in STAGES}
+        self._lock = threading.Lock()
+
+    def created(self, oref, symbol=None):
+        with self._lock:
+            self._orders[oref] = OrderTimes(oref, symbol)
+            while len(self._orders) > self.maxorders:
+                self._orders.popitem(last=False)
+
+    def queued(self, oref):
+        self._record(oref, "queued", time.monotonic())
+
+    def replied(self, oref, fut, rejected=False):
+        """Takes the send, ack and reply times from the future of the order request"""
+        with self._lock:
+            times = self._orders.get(oref)
+            if times is None:
+                return
+            times.sent = getattr(fut, "t_sent", None)
+            times.acked = getattr(fut, "t_ack", None)
+            times.replied = getattr(fut, "t_reply", None)
+            times.rejected = rejected
+            for stage in ("submit", "queue", "ack", "reply"):
+                self._sample(times, stage)
+
+    def filled(self, oref):
+        with self._lock:
+            times = self._orders.get(oref)
+            if times is None:
+                return
+            times.fills.append(time.monotonic())
+            if len(times.fills) == 1:
+                self._sample(times, "fill")
+                self._sample(times, "total")
+
+    def _record(self, oref, name, value):
+        with self._lock:
+            times = self._orders.get(oref)
+            if times is not None:
+                setattr(times, name, value)
+
+    def _sample(self, times, stage):
+        duration = times.duration(stage)
+        if duration is not None:
+            self._samples[stage].append(duration)
+
+    def get(self, oref):
+        """`OrderTimes` of an order or `None` if it is not known (anymore)"""
+        return self._orders.get(oref)
+
+    def orders(self):
+        """`OrderTimes` of the last orders, oldest first"""
+        with self._lock:
+            return list(self._orders.values())
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """Percentiles of the time spent in each stage in milliseconds:
+        `{stage: {"count": n, 50: ms, 90: ms, 99: ms}}`"""
+        stats = collections.OrderedDict()
+        for stage in STAGES:
+            samples = np.array(self._copy(stage)) * 1000.0
+            stats[stage] = dict(count=len(samples))
+            for p in percentiles:
+                stats[stage][p] = float(np.percentile(samples, p)) if len(samples) else None
+        return stats
+
+    def histogram(self, stage, bins=20):
+        """`numpy.histogram` of the samples of a stage in milliseconds"""
+        return np.histogram(np.array(self._copy(stage)) * 1000.0, bins=bins)
+
+    def _copy(self, stage):
+        # order threads append samples at any time
+        with self._lock:
+            return list(self._samples[stage])
+
+    def clear(self):
+        with self._lock:
+            self._orders.clear()
+            for samples in self._samples.values():
+                samples.clear()
@@ -0,0 +1,356 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import itertools
+import math
+import threading
+import time
+
+import zmq
+
+from backtradermql5.bars import PERIODS
+from backtradermql5.codec import getcodec
+from backtradermql5.mt5store import getports
+
+
+class MTraderMockServer:
+    """
+    Pure Python stand-in for the MQL5 JSON API expert advisor.
+
+    Binds the sockets `MTraderAPI` connects to, so the store, broker and
+    data feeds can be driven without a MetaTrader 5 terminal:
+
+      - SYS (REP): receives requests and answers "OK"
+      - DATA / INDICATOR_DATA (PUSH): request replies
+      - LIVE / EVENTS (PUSH): live prices and trade transactions
+      - CHART_DATA (PULL): sink for chart messages
+
+    Replies are served from a background thread. `publish_live` and
+    `publish_event` may be called from any thread.
+
+    Params:
+
+      - `host` (default: `127.0.0.1`): interface to bind to
+      - `history` (default: `None`): callable `(symbol, timeframe, begin, end)`
+        returning the rows of a HISTORY reply. Synthetic prices are
+        generated when not set
+      - `latency` (default: `0.0`): seconds to wait before each reply
+      - `fill` (default: `True`): push a deal transaction on EVENTS for
+        every market order
+      - `fill_delay` (default: `0.002`): seconds between the TRADE reply
+        and the deal transaction, as the terminal fires `OnTradeTransaction`
+        after answering the request
+      - `seed` (default: `0`): seed of the synthetic price generator
+      - `codec` (default: `json`): wire format, must match the store `codec`
+      - `ports` (default: `None`): ports to bind, as the store `ports`
+
+    INDICATOR requests with a `toDate` are answered with the values of all
+    bars in the range: `{"time": [...], "data": [[...], ...]}` with a list
+    of values per indicator line.
+    """
+
+    # Bars (or ticks) generated when a HISTORY request has no `fromDate`
+    _DEFAULT_BARS = 1000
+
+    # Milliseconds the sockets keep unsent messages when the server stops
+    _LINGER = 100
+
+    # Seconds a reply waits for a client connecting its sockets, before it is dropped
+    _CONNECT_WAIT = 1.0
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        history=None,
+        latency=0.0,
+        fill=True,
+        fill_delay=0.002,
+        seed=0,
+        codec="json",
+        debug=False,
+        ports=None,
+    ):
+        self.host = host
+        self.ports = getports(ports)
+        self.history = history or self.synthetic_history
+        self.latency = latency
+        self.fill = fill
+        self.fill_delay = fill_delay
+        self.seed = seed
+        self.codec = getcodec(codec)
+        self.debug = debug
+
+        self.balance = 10000.0
+        self.equity = 10000.0
+        self.positions = list()
+
+        self.requests = collections.Counter()  # handled requests by action
+        self.chart_messages = 0  # messages received on the chart socket
+        self.last_chart_messages = collections.deque(maxlen=100)
+
+        self._order_ids = itertools.count(1000)
+        self._indicators = dict()  # indicator id -> (line count, timeframe)
+
+        self._context = zmq.Context()
+        self._live_lock = threading.Lock()
+        self._events_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self._handlers = {
+            "RESET": self._on_ok,
+            "CONFIG": self._on_ok,
+            "ACCOUNT": self._on_account,
+            "BALANCE": self._on_balance,
+            "POSITIONS": self._on_positions,
+            "ORDERS": self._on_orders,
+            "HISTORY": self._on_history,
+            "TRADE": self._on_trade,
+            "CHART": self._on_chart,
+            "INDICATOR": self._on_indicator,
+        }
+
+    def _bind(self, socket_type, port):
+        socket = self._context.socket(socket_type)
+        socket.setsockopt(zmq.LINGER, self._LINGER)
+        socket.bind("tcp://{}:{}".format(self.host, port))
+        return socket
+
+    def start(self):
+        """Bind all sockets and start serving requests"""
+        sys_port, data_port, live_port, events_port, indicator_data_port, chart_data_port = self.ports
+        try:
+            self.sys_socket = self._bind(zmq.REP, sys_port)
+            self.data_socket = self._bind(zmq.PUSH, data_port)
+            self.live_socket = self._bind(zmq.PUSH, live_port)
+            self.events_socket = self._bind(zmq.PUSH, events_port)
+            self.indicator_data_socket = self._bind(zmq.PUSH, indicator_data_port)
+            self.chart_data_socket = self._bind(zmq.PULL, chart_data_port)
+        except zmq.ZMQError:
+            self._context.destroy(linger=0)
+            raise zmq.ZMQBindError("Binding ports ERROR")
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._t_serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and release the ports"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._context.destroy(linger=self._LINGER)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def publish_live(self, symbol, timeframe, data, status="CONNECTED"):
+        """Push a live price message as sent by the terminal on LIVE"""
+        msg = {"status": status, "symbol": symbol, "timeframe": timeframe, "data": data}
+        with self._live_lock:
+            self.live_socket.send(self.codec.dumps(msg))
+
+    def publish_event(self, request, reply):
+        """Push a trade transaction as sent by the terminal on EVENTS"""
+        with self._events_lock:
+            self.events_socket.send(self.codec.dumps({"request": request, "reply": reply}))
+
+    def _price(self, symbol, t):
+        """Deterministic price of a symbol at a time, independent of the requested range"""
+        x = (int(t) * 2654435761 + self._salt(symbol)) % 4294967296
+        return 1.1 + 0.01 * math.sin(t / 86400.0) + 0.0005 * (x / 4294967296.0 - 0.5)
+
+    def _salt(self, symbol):
+        return sum(ord(c) for c in "{}{}".format(self.seed, symbol))
+
+    def synthetic_history(self, symbol, timeframe, begin, end):
+        """Deterministic candles or ticks between two unix timestamps"""
+        end = end or int(time.time())
+
+        if timeframe == "TICK":
+            step = 250  # ms between ticks
+            end = end * 1000
+            begin = begin * 1000 if begin else end - self._DEFAULT_BARS * step
+            begin += -begin % step
+            rows = list()
+            for t in range(begin, end, step):
+                bid = round(self._price(symbol, t / 1000.0), 5)
+                rows.append([t, bid, round(bid + 0.00012, 5)])
+            return rows
+
+        period = PERIODS[timeframe]
+        end -= end % period
+        begin = begin - begin % period if begin else end - self._DEFAULT_BARS * period
+        rows = list()
+        for t in range(begin, end + period, period):
+            o = self._price(symbol, t)
+            c = self._price(symbol, t + period)
+            h = max(o, c) + 0.0001
+            l = min(o, c) - 0.0001
+            volume = 1 + (t // period) % 500
+            rows.append([t, round(o, 5), round(h, 5), round(l, 5), round(c, 5), volume, 12])
+        return rows
+
+    def _t_serve(self):
+        poller = zmq.Poller()
+        poller.register(self.sys_socket, zmq.POLLIN)
+        poller.register(self.chart_data_socket, zmq.POLLIN)
+
+        while not self._stop_event.is_set():
+            events = dict(poller.poll(50))
+
+            if self.chart_data_socket in events:
+                msg = self.codec.loads(self.chart_data_socket.recv())
+                self.chart_messages += 1
+                self.last_chart_messages.append(msg)
+
+            if self.sys_socket in events:
+                request = self.codec.loads(self.sys_socket.recv())
+                self.sys_socket.send_string("OK")
+                if self.debug:
+                    print("MOCK REQUEST: ", request)
+
+                self.requests[request["action"]] += 1
+                handler = self._handlers.get(request["action"], self._on_unknown)
+                if self.latency:
+                    time.sleep(self.latency)
+                handler(request)
+
+    def _send_reply(self, socket, msg):
+        # A PUSH socket blocks without a connected client, which would keep `stop` waiting.
+        # A new client can send its first request before its reply sockets are connected
+        raw = self.codec.dumps(msg)
+        deadline = time.monotonic() + self._CONNECT_WAIT
+        while True:
+            try:
+                socket.send(raw, zmq.NOBLOCK)
+                return
+            except zmq.Again:
+                if self._stop_event.is_set() or time.monotonic() > deadline:
+                    break
+                time.sleep(0.001)
+        if self.debug:
+            print("MOCK REPLY DROPPED, NO CLIENT: ", msg)
+
+    def _reply(self, msg):
+        self._send_reply(self.data_socket, msg)
+
+    def _indicator_reply(self, msg):
+        self._send_reply(self.indicator_data_socket, msg)
+
+    def _on_ok(self, request):
+        self._reply({"error": False})
+
+    def _on_unknown(self, request):
+        self._reply({"error": True, "lastError": "0", "description": "Wrong action"})
+
+    def _on_account(self, request):
+        self._reply(
+            {
+                "error": False,
+                "broker": "MTraderMockServer",
+                "currency": "USD",
+                "server": "mock",
+                "trading_allowed": 1,
+                "bot_trading": 1,
+                "balance": self.balance,
+                "equity": self.equity,
+                "margin": 0.0,
+                "margin_free": self.equity,
+                "margin_level": 0.0,
+            }
+        )
+
+    def _on_balance(self, request):
+        self._reply({"balance": self.balance, "equity": self.equity, "margin": 0.0, "margin_free": self.equity})
+
+    def _on_positions(self, request):
+        self._reply({"error": False, "positions": self.positions})
+
+    def _on_orders(self, request):
+        self._reply({"error": False, "orders": []})
+
+    def _on_history(self, request):
+        if request["actionType"] != "DATA":
+            self._reply({"error": False})
+            return
+
+        rows = self.history(request["symbol"], request["chartTF"], request["fromDate"], request["toDate"])
+        self._reply({"error": False, "symbol": request["symbol"], "timeframe": request["chartTF"], "data": rows})
+
+    def _on_trade(self, request):
+        action_type = request["actionType"]
+        if action_type in ("POSITION_CLOSE_ID", "ORDER_CANCEL", "POSITION_MODIFY", "ORDER_MODIFY"):
+            self._reply({"error": False, "retcode": 10009, "description": "TRADE_RETCODE_DONE"})
+            return
+
+        oid = next(self._order_ids)
+        price = float(request["price"] or 1.1)
+        self._reply(
+            {
+                "error": False,
+                "retcode": 10009,
+                "desription": "TRADE_RETCODE_DONE",
+                "order": oid,
+                "volume": request["volume"],
+                "price": price,
+                "bid": price,
+                "ask": price,
+            }
+        )
+
+        if self.fill and action_type in ("ORDER_TYPE_BUY", "ORDER_TYPE_SELL"):
+            deal = (
+                {
+                    "action": "TRADE_ACTION_DEAL",
+                    "order": oid,
+                    "symbol": request["symbol"],
+                    "type": action_type,
+                    "volume": request["volume"],
+                    "price": price,
+                },
+                {"result": "TRADE_RETCODE_DONE", "order": oid, "volume": request["volume"], "price": price},
+            )
+            t = threading.Timer(self.fill_delay, self.publish_event, args=deal)
+            t.daemon = True
+            t.start()
+
+    def _on_chart(self, request):
+        if request["actionType"] == "OPEN":
+            self._reply({"error": False, "mtChartId": hash(request["chartId"]) & 0xFFFFFFFF})
+        else:
+            self._reply({"error": False})
+
+    def _indicator_value(self, t):
+        return (int(t) % 86400) / 86400.0
+
+    def _on_indicator(self, request):
+        if request["actionType"] == "ATTACH":
+            self._indicators[request["id"]] = (request["linecount"] or 1, request["chartTF"])
+            self._indicator_reply({"error": False, "id": request["id"]})
+            return
+
+        try:
+            linecount, timeframe = self._indicators[request["id"]]
+        except KeyError:
+            self._indicator_reply({"error": True, "description": "Unknown indicator id"})
+            return
+
+        if request.get("toDate") is None:
+            value = self._indicator_value(request["fromDate"])
+            self._indicator_reply({"error": False, "data": [value] * linecount})
+            return
+
+        # values of the bars opened between `fromDate` and `toDate`
+        period = PERIODS[timeframe]
+        begin = int(request["fromDate"])
+        begin += -begin % period
+        end = min(int(request["toDate"]), int(time.time()))
+        times = list(range(begin, end + 1, period))
+        values = [self._indicator_value(t) for t in times]
+        self._indicator_reply({"error": False, "time": times, "data": [values] * linecount})
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import contextlib
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.utils.py3 import with_metaclass
@@ -8,6 +9,7 @@
 from backtrader.position import Position
 
 from backtradermql5 import mt5store
+from backtradermql5.trail import TrailingStops
 
 
 class MTraderCommInfo(CommInfoBase):
@@ -42,21 +44,33 @@ class MTraderBroker(with_metaclass(MetaMTraderBroker, BrokerBase)):
 
         Set to `False` during instantiation to disregard any existing
         position
+
+    With a `router` (see `backtradermql5.router.MTraderRouter`) the broker
+    trades on the terminals of all its stores: orders go to the store of
+    their data, positions are collected from every terminal and cash and
+    value are the sums of the accounts.
     """
 
     # TODO: close positions
 
     params = (("use_positions", True),)
 
-    def __init__(self, **kwargs):
+    def __init__(self, router=None, **kwargs):
         super(MTraderBroker, self).__init__()
-        self.o = mt5store.MTraderStore(**kwargs)
+        self.router = router
+        if router is None:
+            self.o = mt5store.MTraderStore(**kwargs)
+            self.stores = [self.o]
+        else:
+            self.o = router.stores[0]
+            self.stores = router.stores
 
         self.orders = collections.OrderedDict()  # orders by order id
         self.notifs = collections.deque()  # holds orders which are notified
 
         self.opending = collections.defaultdict(list)  # pending transmission
         self.brackets = dict()  # confirmed brackets
+        self.trails = TrailingStops()  # StopTrail orders, trailed on the live prices
 
         self.startingcash = self.cash = 0.0
         self.startingvalue = self.value = 0.0
@@ -66,16 +80,17 @@ def __init__(self, **kwargs):
     def start(self):
         super(MTraderBroker, self).start()
         self.addcommissioninfo(self, MTraderCommInfo(mult=1.0, stocklike=False))
-        self.o.start(broker=self)
-        # Check MetaTrader account
-        self.o.check_account()
-        # Get balance on start
-        self.o.get_balance()
-        self.startingcash = self.cash = self.o.get_cash()
-        self.startingvalue = self.value = self.o.get_value()
+        for store in self.stores:
+            store.start(broker=self)
+            # Check MetaTrader account
+            store.check_account()
+            # Get balance on start
+            store.get_balance()
+        self.startingcash = self.cash = self.getcash()
+        self.startingvalue = self.value = self.getvalue()
 
         if self.p.use_positions:
-            for p in self.o.get_positions():
+            for p in (p for store in self.stores for p in store.get_positions()):
                 # print('position for instrument:', p.symbol)
                 is_sell = p.type.endswith("_SELL")
                 size = float(p.volume)
@@ -105,17 +120,24 @@ def data_started(self, data):
 
     def stop(self):
         super(MTraderBroker, self).stop()
-        self.o.stop()
+        for store in self.stores:
+            store.stop()
 
     def getcash(self):
         # This call cannot block if no answer is available from MTrader
-        self.cash = cash = self.o.get_cash()
+        self.cash = cash = sum(store.get_cash() for store in self.stores)
         return cash
 
     def getvalue(self, datas=None):
-        self.value = self.o.get_value()
+        self.value = sum(store.get_value() for store in self.stores)
         return self.value
 
+    def _store(self, data):
+        """Store of the terminal trading the symbol of a data feed"""
+        if self.router is None:
+            return self.o
+        return self.router.store(data._dataname)
+
     def getposition(self, data, clone=True):
         # return self.o.getposition(data._dataname, clone=clone)
         pos = self.positions[data._dataname]
@@ -261,6 +283,21 @@ def _transmit(self, order):
         oref = order.ref
         pref = getattr(order.parent, "ref", oref)  # parent ref or self
 
+        if order.exectype == Order.StopTrail and oref == pref and order.transmit:
+            # MT5 has no trailing stop orders: the stop trails the live prices
+            # from the current one and a market order is sent when it is hit
+            self.orders[oref] = order
+            self.trails.add(
+                oref,
+                order.data._dataname,
+                order.isbuy(),
+                amount=order.trailamount or None,
+                percent=None if order.trailamount else order.trailpercent,
+            )
+            self._submit(oref)
+            self._accept(oref)
+            return order
+
         if order.transmit:
             if oref != pref:  # children order
                 # Put parent in orders dict, but add stopside and takeside
@@ -271,12 +308,12 @@ def _transmit(self, order):
                     self.orders[o.ref] = o  # write them down
 
                 self.brackets[pref] = [parent, stopside, takeside]
-                self.o.order_create(parent, stopside, takeside)
+                self._store(parent.data).order_create(parent, stopside, takeside)
                 return takeside  # parent was already returned
 
             else:  # Parent order, which is not being transmitted
                 self.orders[order.ref] = order
-                return self.o.order_create(order)
+                return self._store(order.data).order_create(order)
 
         # Not transmitting
         self.opending[pref].append(order)
@@ -315,6 +352,7 @@ def buy(
             transmit=transmit,
         )
 
+        self._store(data).latency.created(order.ref, data._dataname)
         order.addinfo(**kwargs)
         order.addcomminfo(self.getcommissioninfo(data))
         return self._transmit(order)
@@ -352,17 +390,43 @@ def sell(
             transmit=transmit,
         )
 
+        self._store(data).latency.created(order.ref, data._dataname)
         order.addinfo(**kwargs)
         order.addcomminfo(self.getcommissioninfo(data))
         return self._transmit(order)
 
+    def basket(self):
+        """Context manager sending the orders created inside it together,
+        see `MTraderStore.basket`
+
+            with self.broker.basket():
+                for data in self.datas:
+                    self.order_target_size(data=data, target=0.1)
+        """
+        if len(self.stores) == 1:
+            return self.o.basket()
+
+        stack = contextlib.ExitStack()
+        for store in self.stores:
+            stack.enter_context(store.basket())
+        return stack
+
     def cancel(self, order):
         if not self.orders.get(order.ref, False):
             return
         if order.status == Order.Cancelled:  # already cancelled
             return
+        if self.trails.remove(order.ref):
+            self._cancel(order.ref)
+            return order
+
+        return self._store(order.data).order_cancel(order)
 
-        return self.o.order_cancel(order)
+    def _live_prices(self, symbol, bid, ask):
+        """Moves the trailing stops of a symbol and sends the ones that were hit"""
+        for oref in self.trails.update(symbol, bid, ask):
+            order = self.orders[oref]
+            self._store(order.data).order_trigger(order)
 
     def notify(self, order):
         self.notifs.append(order.clone())
@@ -2,6 +2,52 @@
 import math
 import uuid
 
+import numpy as np
+
+
+def lttb(x, y, n):
+    """Indices of `n` points picked by Largest-Triangle-Three-Buckets.
+
+    The first and the last point are kept. Every bucket in between keeps the
+    point forming the largest triangle with the point kept in the previous
+    bucket and the average of the next bucket.
+    """
+    size = len(y)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    idx = np.empty(n, dtype=np.int64)
+    idx[0], idx[-1] = 0, size - 1
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    edges = np.append(edges, size)
+
+    a = 0
+    for i in range(n - 2):
+        start, end, nend = edges[i], edges[i + 1], edges[i + 2]
+        avg_x, avg_y = x[end:nend].mean(), y[end:nend].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def minmax(x, y, n):
+    """Indices of the lowest and the highest point of `n // 2` buckets"""
+    size = len(y)
+    if n >= size or n < 2:
+        return np.arange(size)
+
+    edges = np.linspace(0, size, n // 2 + 1).astype(np.int64)
+    idx = list()
+    for start, end in zip(edges[:-1], edges[1:]):
+        bucket = y[start:end]
+        idx.append(start + int(np.argmin(bucket)))
+        idx.append(start + int(np.argmax(bucket)))
+    return np.unique(idx)
+
+
+DOWNSAMPLERS = dict(lttb=lttb, minmax=minmax)
+
 
 class MTraderChart(bt.Indicator):
 
@@ -16,7 +62,19 @@ class MTraderChart(bt.Indicator):
 
     # If False, plot will be output on the next live tick/bar or immediatly after
     # indicator calculations have finished when backtesting
-    params = dict(resampled=False, realtime=True, offset=False)
+    #
+    # With `realtime=False` and `downsample` set to a number of points, the values
+    # older than the last `recent_bars` bars are reduced to `downsample` points per
+    # line with `downsample_method` ("lttb" or "minmax") before they are sent.
+    # The lines are then drawn as DRAW_SECTION unless a linetype was given
+    params = dict(
+        resampled=False,
+        realtime=True,
+        offset=False,
+        downsample=None,
+        downsample_method="lttb",
+        recent_bars=500,
+    )
 
     # Equates to constant EMPTY_VALUE in MQL5
     str_inf = "1.797693134862316e+308"
@@ -43,39 +101,66 @@ def __init__(self):
             self.p.d = self.data
             self.p.store = self.data.o
 
+        if self.p.downsample and self.p.downsample_method not in DOWNSAMPLERS:
+            raise ValueError(
+                "downsample_method must be one of {}, got {}".format(list(DOWNSAMPLERS), self.p.downsample_method)
+            )
+
         res = self.p.store.config_chart(self.p.chart_id, self.p.symbol, self.p.timeframe, self.p.compression)
         self.p.mt_chart_id = res["mtChartId"]
 
+    def _historydone(self):
+        d = self.p.d
+        if d._state == d._ST_OVER:
+            # preloaded data, the history ends with the last bar
+            return len(self.data) >= self.data.buflen()
+        return d._historyend or d._state == d._ST_LIVE
+
     def next(self):
-        state = self.p.d._state
-        qsize = self.p.d._historyback_queue_size
-        _ST_LIVE = self.p.d._ST_LIVE
+        push = self.p.realtime or self._historydone()
 
         for indicator in self.indicators:
             for line in indicator.line_store:
                 date = self.data.datetime.datetime()
                 value = line["line"][0]
                 if date != line["last_date"] and not math.isnan(value):
+                    if not line["values"]:
+                        line["prev_date"] = line["last_date"]
                     line["values"].append(round(value, 6))
-                    line["from_date"] = date.timestamp()
+                    line["dates"].append(date.timestamp())
                     # non-realtime has problems with gaps. the plot will be offset to the left by the amount of gaps
-                    if qsize <= 1 or state == _ST_LIVE or self.p.realtime:
-                        if self.p.offset and line["last_date"]:
-                            line["from_date"] = line["last_date"].timestamp()
-                        if not self.p.realtime:
-                            line["values"].reverse()
-                        self.p.store.push_chart_data(
-                            self.p.chart_id,
-                            self.p.mt_chart_id,
-                            indicator.id,
-                            line["buffer_id"],
-                            line["from_date"],
-                            line["values"],
-                        )
-                        line["values"] = []
-                        line["from_date"] = None
+                    if push:
+                        self._push(indicator, line)
                     line["last_date"] = date
 
+    def _push(self, indicator, line):
+        values, dates = line["values"], line["dates"]
+        if self.p.offset:
+            # every value is drawn at the bar before its own
+            prev = line["prev_date"].timestamp() if line["prev_date"] else dates[0]
+            dates = [prev] + dates[:-1]
+
+        old = len(values) - self.p.recent_bars
+        if not self.p.realtime and self.p.downsample and old > self.p.downsample:
+            x, y = np.array(dates[:old]), np.array(values[:old])
+            # the bars between the kept points are empty, the section line joins the points
+            sparse = [self.str_inf] * old
+            for i in DOWNSAMPLERS[self.p.downsample_method](x, y, self.p.downsample):
+                sparse[i] = values[i]
+            values = sparse + values[old:]
+
+        self.p.store.push_chart_data(
+            self.p.chart_id,
+            self.p.mt_chart_id,
+            indicator.id,
+            line["buffer_id"],
+            dates[-1],
+            values[::-1],
+            len(self.data),
+        )
+        line["values"] = []
+        line["dates"] = []
+
     def addchartindicator(self, indicator):
         """
         Adds an indicator instance to a chart (sub)window in MT5.
@@ -88,6 +173,9 @@ def addchartindicator(self, indicator):
 
         self.p.store.chart_add_indicator(self.p.chart_id, indicator.id, indicator.sub_window_idx, indicator.shortname)
         for line in indicator.line_store:
+            if self.p.downsample and not self.p.realtime and "linetype" not in line["user_style"]:
+                # sections join the downsampled points over the bars without a value
+                line["style"]["linetype"] = "DRAW_SECTION"
             self.p.store.chart_indicator_add_line(self.p.chart_id, indicator.id, line["style"])
         self.indicators.append(indicator)
 
@@ -120,10 +208,12 @@ def addline(self, line, *args, **kwargs):
         self.line_store.append(
             {
                 "last_date": None,
-                "from_date": None,
+                "prev_date": None,
                 "line": line,
                 "style": style,
+                "user_style": kwargs["style"],
                 "values": [],
+                "dates": [],
                 "buffer_id": self.indicator_line_count,
             }
         )
@@ -1,12 +1,52 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from datetime import datetime
+from datetime import datetime, timezone
+
+import numpy as np
 
 from backtrader.feed import DataBase
-from backtrader import date2num, num2date
+from backtrader import TimeFrame, date2num, num2date
 from backtrader.utils.py3 import queue, with_metaclass
 
 from backtradermql5 import mt5store
+from backtradermql5.bars import BarAggregator, DerivedQueue, TickBarAggregator, TickBarQueue
+
+
+def _utcoffset(time_stamp):
+    """Offset in seconds of the local timezone at a unix timestamp"""
+    utc = datetime.fromtimestamp(time_stamp, timezone.utc).replace(tzinfo=None)
+    return (datetime.fromtimestamp(time_stamp) - utc).total_seconds()
+
+
+def timestamp2num(time_stamps):
+    """Vectorized `date2num(datetime.fromtimestamp(t))` for an array of unix timestamps"""
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    if not len(time_stamps):
+        return time_stamps
+
+    # Evaluate the local offset once per quarter of an hour. Timezone changes happen on such boundaries
+    buckets, inverse = np.unique(np.floor(time_stamps / 900.0), return_inverse=True)
+    offsets = np.array([_utcoffset(b * 900.0) for b in buckets])
+    local = time_stamps + offsets[inverse]
+
+    days = np.floor(local / 86400.0)
+    return 719163.0 + days + (local - days * 86400.0) / 86400.0  # 719163 = ordinal of 1970-01-01
+
+
+def num2timestamp(nums):
+    """Vectorized `datetime.timestamp(num2date(n))` for an array of local date numbers, rounded to seconds"""
+    local = (np.asarray(nums, dtype=np.float64) - 719163.0) * 86400.0
+    if not len(local):
+        return local.astype(np.int64)
+
+    # The offset is looked up at the local time first, then again at the resulting unix time
+    time_stamps = local
+    for _ in range(2):
+        buckets, inverse = np.unique(np.floor(time_stamps / 900.0), return_inverse=True)
+        offsets = np.array([_utcoffset(b * 900.0) for b in buckets])
+        time_stamps = local - offsets[inverse]
+
+    return np.round(time_stamps).astype(np.int64)
 
 
 class MetaMTraderData(DataBase.__class__):
@@ -35,6 +75,10 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
         The standard data feed parameters `fromdate` and `todate` will be
         used as reference.
 
+        Historical feeds support `preload` and `runonce`. The download is
+        then converted to arrays and loaded in bulk, unless filters,
+        `tzinput` or `backfill_from` require loading bar by bar.
+
       - `backfill` (default: `True`)
 
         Perform backfilling after a disconnection/reconnection cycle. The gap
@@ -65,6 +109,28 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
         Add spread difference to candle price data.
         Only works with candle data.
 
+      - `tickbars` (default: `False`)
+
+        Subscribe to ticks and build bars of the `timeframe` and
+        `compression` of the feed from them, which can be any number of
+        seconds or minutes, e.g. `bt.TimeFrame.Seconds` with `compression=5`.
+        Bars are labelled with their open time like MT5 candles, their
+        volume is the number of ticks. A bar is delivered with the first
+        tick of a later bar or at its close time when no tick arrives. The
+        last bar of a historical feed is included if it closes by `todate`.
+        Replaces `cerebro.resampledata` on a tick feed
+
+      - `tickprice` (default: `None`)
+
+        Price of the ticks the bars of `tickbars` are built from: `bid`,
+        `ask` or `mid`. `None` uses `useask`
+
+      - `tickgrace` (default: `0.1`)
+
+        Seconds a bar of `tickbars` is held past its close time for ticks
+        still on their way from the terminal. Later ticks of the bar are
+        dropped
+
     """
 
     params = (
@@ -75,6 +141,9 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
         ("reconnect", True),
         ("useask", False),  # use the ask price instead of the default
         ("addspread", False),  # add spread difference to candle price data
+        ("tickbars", False),  # build bars of timeframe and compression from ticks
+        ("tickprice", None),  # bid, ask or mid price of the tick bars
+        ("tickgrace", 0.1),  # seconds a tick bar waits for late ticks
         # # Some brokers (looking at you, markets.com) deliver historical data and live/historical bar
         # # data with a different spread than live ticks.
         # # Setting "correct_tick_history = True" attempts to automatically correct historical tick data based on
@@ -88,14 +157,34 @@ class MTraderData(with_metaclass(MetaMTraderData, DataBase)):
     _ST_FROM, _ST_START, _ST_LIVE, _ST_HISTORBACK, _ST_OVER = range(5)
 
     _historyback_queue_size = 0
+    _historyend = False  # the bar loaded last is the last one of the history download
 
     def islive(self):
         """True notifies `Cerebro` that `preloading` and `runonce`
         should be deactivated"""
-        return True
+        return not self.p.historical
+
+    # Seconds per unit of the time frames of tick bars
+    _TICKBAR_SECONDS = {TimeFrame.Seconds: 1, TimeFrame.Minutes: 60}
 
     def __init__(self, **kwargs):
         self.o = self._store(**kwargs)
+        # time frame and compression subscribed to
+        self._subscription = (self.p.timeframe, self.p.compression)
+        if self.p.tickbars:
+            if self.p.timeframe not in self._TICKBAR_SECONDS:
+                raise ValueError(
+                    "Tick bars are built for seconds or minutes, not %s" % TimeFrame.getname(self.p.timeframe)
+                )
+            self._subscription = (TimeFrame.Ticks, 1)
+        self._counted = False  # counted by the store with add_feed
+        self._add_feed()
+
+    def _add_feed(self):
+        # counted once per run: at creation, so feeds starting before it share its history, and again by a later start
+        if not self._counted:
+            self.o.add_feed(self.p.dataname, *self._subscription)
+            self._counted = True
 
     def setenvironment(self, env):
         """Receives an environment (cerebro) and passes it over to the store it
@@ -107,17 +196,31 @@ def start(self):
         """Starts the MTrader connection and gets the real contract and
         contractdetails if it exists"""
         super(MTraderData, self).start()
+        self._add_feed()
 
         # Create attributes as soon as possible
         self._statelivereconn = False  # if reconnecting in live state
-        self.qlive = self.o.q_livedata
+        self._granularity = self.o.get_granularity(*self._subscription)
+        # candles built from a finer granularity with the derivebars store param
+        self._base = self.o.base_granularity(self.p.dataname, self._granularity)
+        self._aggregator = None
+        self._livequeue = self.o.register_livequeue(self.p.dataname, self._base or self._granularity)
+        self.qlive = self._livequeue
+        if self.p.tickbars:
+            seconds = self.p.compression * self._TICKBAR_SECONDS[self.p.timeframe]
+            price = self.p.tickprice or ("ask" if self.p.useask else "bid")
+            self._aggregator = TickBarAggregator(seconds, price)
+            self.qlive = TickBarQueue(self._livequeue, self._aggregator, self.p.tickgrace)
+        elif self._base is not None:
+            self._aggregator = BarAggregator(self._granularity, self._base)
+            self.qlive = DerivedQueue(self._livequeue, self._aggregator)
         self._state = self._ST_OVER
 
         # Kickstart store and get queue to wait on
         self.o.start(data=self)
 
         # Add server script symbol and time frame
-        self.o.config_server(self.p.dataname, self.p.timeframe, self.p.compression)
+        self.o.config_server(self.p.dataname, *self._subscription)
 
         # Backfill from external data feed
         if self.p.backfill_from is not None:
@@ -127,7 +230,9 @@ def start(self):
             self._start_finish()
             # initial state for _load
             self._state = self._ST_START
-            self._st_start()
+            # historical data is downloaded by `preload` or on the first `_load`
+            if not self.p.historical:
+                self._st_start()
 
     def _st_start(self):
         self.put_notification(self.DELAYED)
@@ -139,19 +244,107 @@ def _st_start(self):
             self.p.dataname,
             date_begin,
             date_end,
-            self.p.timeframe,
-            self.p.compression,
+            *self._subscription,
             self.p.include_last,
             # self.p.correct_tick_history,
+            aggregator=self._history_aggregator(date_end),
         )
+        self._histahead = None  # (row,) read ahead of the bar being loaded
+        self._historyend = False
 
         self._state = self._ST_HISTORBACK
 
         return True
 
+    def _history_aggregator(self, date_end):
+        if self.p.tickbars:
+            # A historical feed has every tick up to todate, a live one gets the rest of its last bar live
+            end = None
+            if self.p.historical and date_end is not None:
+                end = int(round((date_end - datetime(1970, 1, 1)).total_seconds() * 1000))
+            self._aggregator.end = end
+        return self._aggregator
+
+    def preload(self):
+        """Loads the whole history in bulk from columnar arrays if possible,
+        bar by bar otherwise"""
+        if not self._canbulkload():
+            return super(MTraderData, self).preload()
+
+        self.put_notification(self.DELAYED)
+
+        date_begin = num2date(self.fromdate) if self.fromdate > float("-inf") else None
+        date_end = num2date(self.todate) if self.todate < float("inf") else None
+
+        price_data = self.o.price_data_array(
+            self.p.dataname,
+            date_begin,
+            date_end,
+            *self._subscription,
+            self.p.include_last,
+            aggregator=self._history_aggregator(date_end),
+        )
+
+        self._bulkload(price_data)
+
+        self.put_notification(self.DISCONNECTED)
+        self._state = self._ST_OVER
+
+        self._last()
+        self.home()
+
+    def _canbulkload(self):
+        if self._state != self._ST_START or self._filters or self._tzinput:
+            return False
+        return all(line.mode == line.UnBounded for line in self.lines)
+
+    def _bulkload(self, price_data):
+        """Fills the lines with the columns of a history download"""
+        if self._granularity == "TICK" and not self.p.tickbars:
+            dt = timestamp2num(price_data[0] / 1000.0)
+            price = price_data[2] if self.p.useask else price_data[1]
+            columns = dict(open=price, high=price, low=price, close=price, volume=np.zeros(len(price)))
+        else:
+            dt = timestamp2num(price_data[0])
+            columns = dict(open=price_data[1], high=price_data[2], low=price_data[3], close=price_data[4])
+            if self.p.addspread:
+                points, digits = (0.001, 3) if self.p.dataname.endswith("JPY") else (0.00001, 5)
+                spread = price_data[6] * points
+                for name, values in columns.items():
+                    # python rounding, numpy rounds half to even on the binary value
+                    columns[name] = np.array([round(x, digits) for x in (values + spread).tolist()])
+            columns["volume"] = price_data[5]
+
+        # Same checks as bar by bar loading: skip times already seen and bars before fromdate, stop after todate
+        keep = np.ones(len(dt), dtype=bool)
+        keep[1:] = dt[1:] > np.maximum.accumulate(dt)[:-1]
+        keep &= dt >= self.fromdate
+        over = np.flatnonzero(dt > self.todate)
+        if len(over):
+            keep[over[0] :] = False
+
+        columns["datetime"] = dt
+        columns["openinterest"] = np.zeros(len(dt))
+        size = int(keep.sum())
+
+        for alias in self.lines.getlinealiases():
+            line = getattr(self.lines, alias)
+            values = columns.get(alias)
+            values = values[keep] if values is not None else np.full(size, np.nan)
+            line.array.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+            line.idx += size
+            line.lencount += size
+
     def stop(self):
-        """Stops and tells the store to stop"""
+        """Stops, leaves the shared subscription and tells the store to stop"""
         super(MTraderData, self).stop()
+        qhist = getattr(self, "qhist", None)
+        if hasattr(qhist, "close"):
+            qhist.close()
+        self.o.unregister_livequeue(self.p.dataname, self._base or self._granularity, self._livequeue)
+        if self._counted:
+            self._counted = False
+            self.o.release_server(self.p.dataname, *self._subscription)
         self.o.stop()
 
     def haslivedata(self):
@@ -188,11 +381,9 @@ def _load(self):
                         self._st_start()
                         continue
 
-                    if (
-                        msg["timeframe"] == self.o.get_granularity(self.p.timeframe, self.p.compression)
-                        and msg["symbol"] == self.p.dataname
-                    ):
-                        if msg["timeframe"] == "TICK":
+                    # status changes are fanned out to all feeds with the data of a single one
+                    if msg["timeframe"] == self._granularity and msg["symbol"] == self.p.dataname:
+                        if msg["timeframe"] == "TICK" and not self.p.tickbars:
                             if self._load_tick(msg["data"]):
                                 return True  # loading worked
                         else:
@@ -200,7 +391,16 @@ def _load(self):
                                 return True  # loading worked
 
             elif self._state == self._ST_HISTORBACK:
-                msg = self.qhist.get()
+                if self._histahead is not None:
+                    (msg,), self._histahead = self._histahead, None
+                else:
+                    msg = self.qhist.get()
+                if msg:
+                    # The history is streamed, only the next row tells if this bar is the last one
+                    self._histahead = (self.qhist.get(),)
+                    self._historyend = not self._histahead[0]
+                else:
+                    self._historyend = True
                 # Queue size of historical price data
                 self._historyback_queue_size = self.qhist.qsize()
                 if msg is None:
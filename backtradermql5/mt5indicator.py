@@ -1,11 +1,18 @@
 from backtrader import bt
-import uuid
+from array import array
+import time
+
+import numpy as np
+
+from backtradermql5.mt5data import num2timestamp
 
 
 def getMTraderIndicator(mtstore, data_obj, lines=list(), plotinfo=dict(), plotlines=dict(), *args, **kwargs):
 
     if "plotname" not in plotinfo:
         plotinfo["plotname"] = kwargs["indicator"]
+    # Download the values of many bars with one request if the server supports it
+    kwargs.setdefault("bulk", True)
     globals()["plotinfo"] = plotinfo
     globals()["plotlines"] = plotlines
     globals()["lines"] = lines
@@ -22,36 +29,147 @@ class MTraderIndicator(bt.Indicator):
         plotinfo = plotinfo
         plotlines = plotlines
 
+        # Terminal bar times are in server time, which can be ahead of UTC
+        _RANGE_AHEAD = 7 * 86400
+
         def __init__(self):
             self.last_fromDate = 0
             self.p.timeframe = self.data_obj._timeframe
             self.p.compression = self.data_obj._compression
-            self.p.id = str(uuid.uuid4())
             self.p.symbol = self.data_obj._dataname
             self.p.linecount = len(lines)
             self.p.params = [str(x) for x in self.p.params]
 
-            ret_val = self.mtstore.config_indicator(
+            # The MT5 indicator instance is only attached when values are missing from the indicator cache
+            self.p.indicatorId = None
+            self._series = self.mtstore.indicator_series(
                 self.p.symbol,
                 self.p.timeframe,
                 self.p.compression,
                 self.p.indicator,
-                self.p.id,
                 self.p.params,
                 self.p.linecount,
             )
+            self._bulk = self.p.bulk
+            self._fetchedto = None  # last bar time downloaded in bulk
+
+        def _attach(self):
+            if self.p.indicatorId is None:
+                self.p.indicatorId = self.mtstore.shared_indicator(
+                    self.p.symbol,
+                    self.p.timeframe,
+                    self.p.compression,
+                    self.p.indicator,
+                    self.p.params,
+                    self.p.linecount,
+                )
+            return self.p.indicatorId
+
+        def _fetch(self, fromDate, toDate, served, closed=True):
+            """Downloads and caches the values of the closed bars between two unix
+            timestamps. Returns the values of the bar `served` if it is not closed"""
+            ret_val = self.mtstore.indicator_data_range(self._attach(), fromDate, toDate)
+            if ret_val is None:
+                # the server answers one bar per request
+                self._bulk = False
+                return None
+
+            times, values = ret_val
+            keep = np.ones(len(times), dtype=bool)
+            if len(times) and times[-1] > served:
+                # the last bar after the data may still be open and its values not final
+                keep[-1] = False
+            if not closed:
+                keep &= times < served
+            self._series.add(times[keep], values[:, keep])
+            self._fetchedto = max(served, int(times[keep][-1])) if keep.any() else served
+            if not closed and served in times:
+                return [float(x) for x in values[:, np.flatnonzero(times == served)[0]]]
+            return None
+
+        def _todate(self):
+            if self.data_obj.todate < float("inf"):
+                return int(num2timestamp([self.data_obj.todate])[0])
+            return int(time.time()) + self._RANGE_AHEAD
+
+        def _barvalues(self, fromDate, closed=True):
+            values = [float(x) for x in self.mtstore.indicator_data(self._attach(), fromDate)["data"]]
+            if closed:
+                self._series.add_bar(fromDate, values)
+            return values
 
-            self.p.indicatorId = ret_val["id"]
+        def _lastopen(self):
+            """True if the current bar of the data is its last historical candle
+            loaded with `include_last`, which is still open"""
+            d = self.data_obj
+            if not d.p.include_last:
+                return False
+            if d._state == d._ST_OVER:
+                return len(d) >= d.buflen()
+            return d._state == d._ST_HISTORBACK and d._historyend
 
         def next(self):
-            fromDate = int(self.data_obj.datetime.datetime().timestamp())
+            fromDate = int(round(self.data_obj.datetime.datetime().timestamp()))
 
             if fromDate != self.last_fromDate:
-                ret_val = self.mtstore.indicator_data(self.p.indicatorId, fromDate)
                 self.last_fromDate = fromDate
 
-                for i in range(len(ret_val["data"])):
-                    self.lines[i][0] = float(ret_val["data"][i])
+                # the values of an open bar are not cached, they change until it closes
+                closed = not self._lastopen()
+                values = self._series.get(fromDate) if closed else None
+                if values is None and self._bulk and (self._fetchedto is None or fromDate > self._fetchedto):
+                    # one request up to the end of the data, or for the new bars in live trading
+                    values = self._fetch(fromDate, self._todate(), fromDate, closed)
+                    if closed:
+                        values = self._series.get(fromDate)
+
+                if values is None:
+                    values = self._barvalues(fromDate, closed)
+
+                for i in range(len(values)):
+                    self.lines[i][0] = float(values[i])
+
+        def once(self, start, end):
+            if self.data_obj is not self.data or self.data_obj._tz is not None:
+                return self.once_via_next(start, end)
+
+            fromDates = num2timestamp(self.data_obj.datetime.array[start:end])
+            if not len(fromDates):
+                return
+
+            # the last candle loaded with include_last is still open, its values are not cached
+            closed = not (self.data_obj.p.include_last and end >= self.data_obj.buflen())
+
+            openvalues = None
+            idx, found = self._series.lookup(fromDates)
+            if not closed:
+                found[-1] = False
+            if self._bulk and not found.all():
+                missing = fromDates[~found]
+                last = int(missing[-1])
+                if closed:
+                    # backtrader runs the first bars in a call of their own: one range up to the last
+                    # preloaded bar, without the open one loaded with include_last
+                    i = self.data_obj.buflen() - (2 if self.data_obj.p.include_last else 1)
+                    if i >= end:
+                        last = int(num2timestamp(self.data_obj.datetime.array[i : i + 1])[0])
+                openvalues = self._fetch(int(missing[0]), last, last, closed)
+                idx, found = self._series.lookup(fromDates)
+                if not closed:
+                    found[-1] = openvalues is not None
+
+            if len(self._series.times):
+                values = self._series.values[:, idx]
+            else:
+                values = np.empty((self.p.linecount, len(fromDates)))
+            if openvalues is not None:
+                values[:, -1] = openvalues
+            for j in np.flatnonzero(~found):
+                # bars the server did not answer for, and the open bar
+                values[:, j] = self._barvalues(int(fromDates[j]), closed or j < len(fromDates) - 1)
+
+            for i in range(len(values)):
+                self.lines[i].array[start:end] = array("d", values[i].tolist())
 
     setAttributes()
 
@@ -2,10 +2,27 @@
 
 import zmq
 import collections
-from datetime import datetime
+import contextlib
+import numpy as np
+import os
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from socket import gethostbyname, socketpair
 import threading
+import time
+import types
+import uuid
+import zlib
 
+from backtradermql5.account import AccountService
 from backtradermql5.adapter import PositionAdapter
+from backtradermql5.bars import PERIODS, DerivedHistory, derivable
+from backtradermql5.cache import HistoryCache, IndicatorCache
+from backtradermql5.codec import getcodec
+from backtradermql5.history import SharedHistory
+from backtradermql5.latency import LatencyTracker
+from backtradermql5.publisher import ChartPublisher
+from backtradermql5.recorder import EVENTS, LIVE, Recorder
 
 import backtrader as bt
 from backtrader.metabase import MetaParams
@@ -54,6 +71,28 @@ def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
 
 
+def getports(ports):
+    """Returns the six ports of a terminal from a `ports` argument: `None` for the
+    default ports, a sequence of six ports or the SYS port followed by the others"""
+    if ports is None:
+        return MTraderAPI.PORTS
+    if isinstance(ports, int):
+        return tuple(range(ports, ports + len(MTraderAPI.PORTS)))
+    ports = tuple(int(port) for port in ports)
+    if len(ports) != len(MTraderAPI.PORTS):
+        raise ValueError("Expected {} ports, got {}".format(len(MTraderAPI.PORTS), ports))
+    return ports
+
+
+def gethost(host):
+    """Returns the address of a terminal host, so that its names and address
+    give the same store. A host that does not resolve is returned as is"""
+    try:
+        return gethostbyname(host)
+    except (OSError, UnicodeError):
+        return host
+
+
 class MTraderAPI:
     """
     This class implements Python side for MQL5 JSON API
@@ -62,41 +101,53 @@ class MTraderAPI:
 
     # TODO: unify error handling
 
+    SYS_PORT = 15555  # REP/REQ port
+    DATA_PORT = 15556  # PUSH/PULL port
+    LIVE_PORT = 15557  # PUSH/PULL port
+    EVENTS_PORT = 15558  # PUSH/PULL port
+    INDICATOR_DATA_PORT = 15559  # REP/REQ port
+    CHART_DATA_PORT = 15560  # PUSH port
+
+    # Default ports in the order of the `ports` argument
+    PORTS = (SYS_PORT, DATA_PORT, LIVE_PORT, EVENTS_PORT, INDICATOR_DATA_PORT, CHART_DATA_PORT)
+
     def __init__(self, *args, **kwargs):
 
         self.HOST = kwargs["host"]
-        self.SYS_PORT = 15555  # REP/REQ port
-        self.DATA_PORT = 15556  # PUSH/PULL port
-        self.LIVE_PORT = 15557  # PUSH/PULL port
-        self.EVENTS_PORT = 15558  # PUSH/PULL port
-        self.INDICATOR_DATA_PORT = 15559  # REP/REQ port
-        self.CHART_DATA_PORT = 15560  # PUSH port
+        # ports of the expert advisor of the terminal, as set in its inputs
+        (
+            self.SYS_PORT,
+            self.DATA_PORT,
+            self.LIVE_PORT,
+            self.EVENTS_PORT,
+            self.INDICATOR_DATA_PORT,
+            self.CHART_DATA_PORT,
+        ) = getports(kwargs.get("ports"))
         self.debug = kwargs["debug"]
+        # wire format of every socket
+        self.codec = getcodec(kwargs.get("codec", "json"))
+        # `backtradermql5.recorder.Recorder` of the request replies, set by the store
+        self.recorder = None
 
         # ZeroMQ timeout in seconds
-        sys_timeout = 1
-        data_timeout = kwargs["datatimeout"]
+        self.sys_timeout = 1
+        self.data_timeout = kwargs["datatimeout"]
 
         # initialise ZMQ context
         context = zmq.Context()
 
         # connect to server sockets
         try:
-            self.sys_socket = context.socket(zmq.REQ)
-            # set port timeout
-            self.sys_socket.RCVTIMEO = sys_timeout * 1000
+            # DEALER instead of REQ: requests are pipelined by the request thread
+            self.sys_socket = context.socket(zmq.DEALER)
             self.sys_socket.set_hwm(1000)
             self.sys_socket.connect("tcp://{}:{}".format(self.HOST, self.SYS_PORT))
 
             self.data_socket = context.socket(zmq.PULL)
-            # set port timeout
-            self.data_socket.RCVTIMEO = data_timeout * 1000
             self.data_socket.set_hwm(1000)
             self.data_socket.connect("tcp://{}:{}".format(self.HOST, self.DATA_PORT))
 
             self.indicator_data_socket = context.socket(zmq.PULL)
-            # set port timeout
-            self.indicator_data_socket.RCVTIMEO = data_timeout * 1000
             self.indicator_data_socket.connect("tcp://{}:{}".format(self.HOST, self.INDICATOR_DATA_PORT))
             self.chart_data_socket = context.socket(zmq.PUSH)
             # set port timeout
@@ -106,40 +157,154 @@ def __init__(self, *args, **kwargs):
         except zmq.ZMQError:
             raise zmq.ZMQBindError("Binding ports ERROR")
 
-    def _send_request(self, data: dict) -> None:
-        """Send request to server via ZeroMQ System socket"""
-        try:
-            self.sys_socket.send_json(data)
-            msg = self.sys_socket.recv_string()
-
-            if self.debug:
-                print("ZMQ SYS REQUEST: ", data, " -> ", msg)
-            # terminal received the request
-            assert msg == "OK", "Something wrong on server side"
-        except AssertionError as err:
-            raise zmq.NotDone(err)
-        except zmq.ZMQError:
-            raise zmq.NotDone("Sending request ERROR")
-
-    def _pull_reply(self):
-        """Get reply from server via Data socket with timeout"""
-        try:
-            msg = self.data_socket.recv_json()
-        except zmq.ZMQError:
-            raise zmq.NotDone("Data socket timeout ERROR")
-        if self.debug:
-            print("ZMQ DATA REPLY: ", msg)
-        return msg
-
-    def _indicator_pull_reply(self):
-        """Get reply from server via Data socket with timeout"""
-        try:
-            msg = self.indicator_data_socket.recv_json()
-        except zmq.ZMQError:
-            raise zmq.NotDone("Indicator Data socket timeout ERROR")
-        if self.debug:
-            print("ZMQ INDICATOR DATA REPLY: ", msg)
-        return msg
+        # Requests from any thread are queued for the request thread, which owns the
+        # SYS, DATA and INDICATOR_DATA sockets
+        self._requests = collections.deque()
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self._stop = False
+
+        self._thread = threading.Thread(target=self._t_requests, daemon=True)
+        self._thread.start()
+
+    def submit(self, request: dict, indicator=False) -> Future:
+        """Queue a request for the server. Returns a future for the reply.
+
+        Requests are sent in submission order without waiting for earlier
+        replies. The terminal answers in order, so replies are matched first
+        in, first out
+        """
+        fut = Future()
+        fut.request = request
+        fut.indicator = indicator
+        fut.t_submit = time.monotonic()
+        self._requests.append(fut)
+        self._wake_w.send(b"\0")
+        return fut
+
+    def close(self):
+        """Stop the request thread and close the request sockets"""
+        if self._stop:
+            return
+        self._stop = True
+        self._wake_w.send(b"\0")
+        self._thread.join()
+
+    def _t_requests(self):
+        poller = zmq.Poller()
+        poller.register(self._wake_r, zmq.POLLIN)
+        poller.register(self.sys_socket, zmq.POLLIN)
+        poller.register(self.data_socket, zmq.POLLIN)
+        poller.register(self.indicator_data_socket, zmq.POLLIN)
+
+        acks = collections.deque()  # requests waiting for "OK"
+        replies = {self.data_socket: collections.deque(), self.indicator_data_socket: collections.deque()}
+        last = None  # last request sent
+
+        def settle(fut, exc=None):
+            fut.t_settled = time.monotonic()
+            if exc is not None and not fut.done():
+                fut.set_exception(exc)
+
+        def ack_deadline(fut):
+            # The terminal answers "OK" only after it served the previous request
+            prev = fut.prev
+            if prev is None:
+                return fut.t_sent + self.sys_timeout
+            if prev.t_settled is None:
+                return float("inf")
+            return max(fut.t_sent, prev.t_settled) + self.sys_timeout
+
+        while not self._stop:
+            # wake up for the closest timeout
+            deadlines = [ack_deadline(f) for f in acks if f.t_settled is None]
+            deadlines += [
+                f.t_ack + self.data_timeout
+                for q in replies.values()
+                for f in q
+                if f.t_settled is None and f.t_ack is not None
+            ]
+            timeout = None
+            if deadlines and min(deadlines) < float("inf"):
+                timeout = max(0, 1000 * (min(deadlines) - time.monotonic())) + 1
+
+            events = dict(poller.poll(timeout))
+
+            if self._wake_r.fileno() in events:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            while self._requests:
+                fut = self._requests.popleft()
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    self.sys_socket.send_multipart([b"", self.codec.dumps(fut.request)])
+                except zmq.ZMQError:
+                    fut.set_exception(zmq.NotDone("Sending request ERROR"))
+                    continue
+                fut.t_sent = time.monotonic()
+                fut.t_ack = fut.t_reply = fut.t_settled = None
+                fut.prev = last
+                last = fut
+                acks.append(fut)
+                replies[self.indicator_data_socket if fut.indicator else self.data_socket].append(fut)
+
+            if self.sys_socket in events:
+                while True:
+                    try:
+                        _, msg = self.sys_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    fut = acks.popleft()
+                    fut.prev = None
+                    msg = msg.decode("utf8")
+                    if self.debug:
+                        print("ZMQ SYS REQUEST: ", fut.request, " -> ", msg)
+                    if msg != "OK":
+                        # the terminal does not answer a rejected request
+                        replies[self.indicator_data_socket if fut.indicator else self.data_socket].remove(fut)
+                        settle(fut, zmq.NotDone("Something wrong on server side"))
+                        continue
+                    fut.t_ack = time.monotonic()
+
+            for socket, queued in replies.items():
+                if socket not in events:
+                    continue
+                while True:
+                    try:
+                        msg = self.codec.loads(socket.recv(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                    if self.debug:
+                        print("ZMQ DATA REPLY: ", msg)
+                    # a reply whose request timed out is discarded
+                    fut = queued.popleft()
+                    fut.t_reply = time.monotonic()
+                    recorder = self.recorder
+                    if recorder is not None and not fut.indicator:
+                        recorder.reply(fut.request, msg)
+                    if fut.t_settled is None:
+                        settle(fut)
+                        fut.set_result(msg)
+
+            now = time.monotonic()
+            for fut in acks:
+                if fut.t_settled is None and ack_deadline(fut) <= now:
+                    settle(fut, zmq.NotDone("Sending request ERROR"))
+            for socket, queued in replies.items():
+                for fut in queued:
+                    if fut.t_settled is None and fut.t_ack is not None and fut.t_ack + self.data_timeout <= now:
+                        if socket is self.data_socket:
+                            settle(fut, zmq.NotDone("Data socket timeout ERROR"))
+                        else:
+                            settle(fut, zmq.NotDone("Indicator Data socket timeout ERROR"))
+
+        for socket in (self.sys_socket, self.data_socket, self.indicator_data_socket):
+            socket.close(linger=0)
 
     def live_socket(self, context=None):
         """Connect to socket in a ZMQ context"""
@@ -167,12 +332,13 @@ def _push_chart_data(self, data: dict) -> None:
         try:
             if self.debug:
                 print("ZMQ PUSH CHART DATA: ", data, " -> ", data)
-            self.chart_data_socket.send_json(data)
+            self.chart_data_socket.send(self.codec.dumps(data))
         except zmq.ZMQError:
             raise zmq.NotDone("Sending request ERROR")
 
-    def construct_and_send(self, **kwargs) -> dict:
-        """Construct a request dictionary from default and send it to server"""
+    @staticmethod
+    def construct_request(**kwargs) -> dict:
+        """Construct a request dictionary from default"""
 
         # default dictionary
         request = {
@@ -205,15 +371,20 @@ def construct_and_send(self, **kwargs) -> dict:
             else:
                 raise KeyError("Unknown key in **kwargs ERROR")
 
-        # send dict to server
-        self._send_request(request)
+        return request
 
-        # return server reply
-        return self._pull_reply()
-
-    def indicator_construct_and_send(self, **kwargs) -> dict:
+    def construct_and_send(self, **kwargs) -> dict:
         """Construct a request dictionary from default and send it to server"""
 
+        request = self.construct_request(**kwargs)
+
+        # send dict to server and return server reply
+        return self.submit(request).result()
+
+    @staticmethod
+    def construct_indicator_request(**kwargs) -> dict:
+        """Construct an indicator request dictionary from default"""
+
         # default dictionary
         request = {
             "action": None,
@@ -235,15 +406,20 @@ def indicator_construct_and_send(self, **kwargs) -> dict:
             else:
                 raise KeyError("Unknown key in **kwargs ERROR")
 
-        # send dict to server
-        self._send_request(request)
+        return request
 
-        # return server reply
-        return self._indicator_pull_reply()
-
-    def chart_data_construct_and_send(self, **kwargs) -> dict:
+    def indicator_construct_and_send(self, **kwargs) -> dict:
         """Construct a request dictionary from default and send it to server"""
 
+        request = self.construct_indicator_request(**kwargs)
+
+        # send dict to server and return server reply
+        return self.submit(request, indicator=True).result()
+
+    @staticmethod
+    def construct_chart_message(**kwargs) -> dict:
+        """Construct a chart message dictionary from default"""
+
         # default dictionary
         message = {
             "action": None,
@@ -264,30 +440,164 @@ def chart_data_construct_and_send(self, **kwargs) -> dict:
             else:
                 raise KeyError("Unknown key in **kwargs ERROR")
 
+        return message
+
+    def chart_data_construct_and_send(self, **kwargs) -> dict:
+        """Construct a request dictionary from default and send it to server"""
+
+        message = self.construct_chart_message(**kwargs)
+
         # send dict to server
         self._push_chart_data(message)
 
 
 class MetaSingleton(MetaParams):
-    """Metaclass to make a metaclassed class a singleton"""
+    """Metaclass to make a metaclassed class a singleton per key returned by
+    the `_singleton_key` classmethod of the class for the call arguments"""
 
     def __init__(cls, name, bases, dct):
         super(MetaSingleton, cls).__init__(name, bases, dct)
-        cls._singleton = None
+        cls._singletons = dict()
 
     def __call__(cls, *args, **kwargs):
-        if cls._singleton is None:
-            cls._singleton = super(MetaSingleton, cls).__call__(*args, **kwargs)
+        key = cls._singleton_key(*args, **kwargs)
+        singleton = cls._singletons.get(key)
+        if singleton is None:
+            singleton = cls._singletons[key] = super(MetaSingleton, cls).__call__(*args, **kwargs)
+
+        return singleton
+
+
+class storemethod:
+    """Decorator for a method bound to the store it is called on, or to the
+    store class when called on the class like a classmethod"""
 
-        return cls._singleton
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, objtype=None):
+        return types.MethodType(self.func, objtype if obj is None else obj)
 
 
 class MTraderStore(with_metaclass(MetaSingleton, object)):
     """
     Singleton class wrapping to control the connections to MetaTrader.
+    There is one store per terminal, i.e. per `host` and `ports`.
 
     Balance update occurs at the beginning and after each
-    transaction registered by '_t_streaming_events'.
+    transaction registered by '_t_streaming'.
+
+    Params:
+
+      - `host` (default: `localhost`): MetaTrader 5 terminal address
+
+      - `ports` (default: `None`): ports of the expert advisor of the
+        terminal. `None` for the default ports 15555 to 15560, the SYS port
+        followed by the five others, or a tuple of the SYS, DATA, LIVE,
+        EVENTS, INDICATOR_DATA and CHART_DATA ports
+
+      - `debug` (default: `False`): print every message sent and received
+
+      - `datatimeout` (default: `10`): seconds to wait for a data reply
+
+      - `codec` (default: `json`)
+
+        Wire format of all sockets. `json` uses the standard library, `orjson`
+        is a faster JSON implementation and `msgpack` needs a server that
+        speaks MessagePack. See `backtradermql5.codec`
+
+      - `cachedir` (default: `None`)
+
+        Directory of the on disk history cache. When set, history downloads
+        with a start date are kept per symbol and granularity and later
+        requests only download the bars missing before or after the cached
+        range
+
+      - `historychunk` (default: `10000`)
+
+        Bars per HISTORY request when downloading history with a start date.
+        Bars reach the data feed as soon as the first request is answered and
+        at most `historyconcurrency` + 1 chunks are held in memory. Tick
+        downloads are requested in windows of `historychunk` seconds. `0`
+        downloads everything with one request
+
+      - `historyconcurrency` (default: `4`)
+
+        HISTORY requests of a download sent ahead of the one being received.
+        The terminal serves them one after the other without waiting for a
+        round trip in between
+
+      - `historyretries` (default: `2`)
+
+        Times a HISTORY request of a download is sent again after a timeout
+
+      - `indicatorcache` (default: `64`)
+
+        MT5 indicator value series kept in memory. Indicators with the same
+        name, parameters, symbol and granularity share their values and only
+        contact the terminal for bars not seen before. With `cachedir` the
+        values are also kept on disk, in the `indicators` subdirectory
+
+      - `indicatorcachemb` (default: `512`)
+
+        Megabytes of indicator values kept on disk. The least recently used
+        are removed first
+
+      - `chartinterval` (default: `0.1`)
+
+        Seconds chart messages are queued before a background thread sends
+        them. Values pushed for successive bars of the same line are sent
+        as one message. See `backtradermql5.publisher.ChartPublisher`
+
+      - `chartbatch` (default: `5000`)
+
+        Queued chart values that trigger sending before `chartinterval`
+
+      - `balanceinterval` (default: `1.0`)
+
+        Seconds between background refreshes of balance and equity while a
+        broker is running. The account is also refreshed after every trade
+        transaction. `getcash` and `getvalue` return the last values without
+        waiting for the terminal. `0` refreshes on transactions only
+
+      - `latencyorders` (default: `1000`)
+
+        Orders whose lifecycle times are kept, and samples kept per stage
+        for the latency percentiles. See `get_order_latency` and
+        `get_latency_stats`
+
+      - `orderworkers` (default: `4`)
+
+        Threads sending order and cancel requests. The requests of a symbol
+        are always sent by the same thread, in the order they were made, so
+        a slow reply only holds up the orders of the symbols of its thread
+
+      - `orderretries` (default: `2`)
+
+        Times an order request is sent again when it could not be sent or
+        the terminal rejected it with a requote, price change, off quotes,
+        too many requests or no connection retcode. Other failures reject
+        the order. A retried order goes after the orders of its basket
+        that were sent already
+
+      - `recordfile` (default: `None`)
+
+        File the session is recorded to: the raw LIVE and EVENTS messages
+        and the replies to CONFIG, HISTORY, TRADE and BALANCE requests,
+        appended with their time. The file is closed when the store stops
+        and appended to again by a later session. Play it back with
+        `backtradermql5.replay.MTraderReplayServer`
+
+      - `derivebars` (default: `False`)
+
+        Builds the candles of data feeds from the closed candles of a finer
+        granularity of the same symbol instead of subscribing them. `True`
+        uses the finest granularity of the feeds created for the symbol, a
+        granularity like `M1` always that one. Feeds of 5 time frames of a
+        symbol then take one subscription and share one history download.
+        Granularities that are not a multiple of it are subscribed as usual.
+        See `backtradermql5.bars.BarAggregator`
     """
 
     # TODO: implement stop_limit
@@ -296,10 +606,40 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
     BrokerCls = None  # broker class will autoregister
     DataCls = None  # data class will auto register
 
-    params = (("host", "localhost"), ("debug", False), ("datatimeout", 10))
+    params = (
+        ("host", "localhost"),
+        ("ports", None),
+        ("debug", False),
+        ("datatimeout", 10),
+        ("codec", "json"),
+        ("cachedir", None),
+        ("historychunk", 10000),
+        ("historyconcurrency", 4),
+        ("historyretries", 2),
+        ("indicatorcache", 64),
+        ("indicatorcachemb", 512),
+        ("chartinterval", 0.1),
+        ("chartbatch", 5000),
+        ("balanceinterval", 1.0),
+        ("latencyorders", 1000),
+        ("orderworkers", 4),
+        ("orderretries", 2),
+        ("recordfile", None),
+        ("derivebars", False),
+    )
 
     _DTEPOCH = datetime(1970, 1, 1)
 
+    # Messages taken from a socket before polling again
+    _STREAMING_BATCH = 256
+
+    # Finished orders whose late transactions are still matched to them
+    _RETIRED_ORDERS = 1024
+
+    # Trade retcodes of order requests the terminal refused and that can be sent again:
+    # requote, price changed, off quotes, too many requests, no connection
+    _RETRY_RETCODES = (10004, 10020, 10021, 10024, 10031)
+
     # MTrader supported granularities
     _GRANULARITIES = {
         (bt.TimeFrame.Ticks, 1): "TICK",
@@ -319,6 +659,9 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         (bt.TimeFrame.Months, 1): "MN1",
     }
 
+    # Time frame and compression of MTrader granularities
+    _TIMEFRAMES = {granularity: key for key, granularity in _GRANULARITIES.items()}
+
     # Order type matching with MetaTrader 5
     _ORDEREXECS = {
         (bt.Order.Market, "buy"): "ORDER_TYPE_BUY",
@@ -327,19 +670,32 @@ class MTraderStore(with_metaclass(MetaSingleton, object)):
         (bt.Order.Limit, "sell"): "ORDER_TYPE_SELL_LIMIT",
         (bt.Order.Stop, "buy"): "ORDER_TYPE_BUY_STOP",
         (bt.Order.Stop, "sell"): "ORDER_TYPE_SELL_STOP",
+        # trailed by the broker, sent when the stop is hit
+        (bt.Order.StopTrail, "buy"): "ORDER_TYPE_BUY",
+        (bt.Order.StopTrail, "sell"): "ORDER_TYPE_SELL",
         # (bt.Order.StopLimit, 'buy'): 'ORDER_TYPE_BUY_STOP_LIMIT',
         # (bt.Order.StopLimit, 'sell'): 'ORDER_TYPE_SELL_STOP_LIMIT',
     }
 
     @classmethod
-    def getdata(cls, *args, **kwargs):
-        """Returns `DataCls` with args, kwargs"""
-        return cls.DataCls(*args, **kwargs)
-
-    @classmethod
-    def getbroker(cls, *args, **kwargs):
-        """Returns broker with *args, **kwargs from registered `BrokerCls`"""
-        return cls.BrokerCls(*args, **kwargs)
+    def _singleton_key(cls, *args, **kwargs):
+        return gethost(kwargs.get("host", cls.params.host)), getports(kwargs.get("ports", cls.params.ports))
+
+    @storemethod
+    def getdata(store, *args, **kwargs):
+        """Returns `DataCls` of this store with args, kwargs. Called on the class,
+        the data uses the store of the `host` and `ports` in kwargs"""
+        if not isinstance(store, type):
+            kwargs.update(host=store.p.host, ports=store.p.ports)
+        return store.DataCls(*args, **kwargs)
+
+    @storemethod
+    def getbroker(store, *args, **kwargs):
+        """Returns broker of this store with *args, **kwargs from registered `BrokerCls`.
+        Called on the class, the broker uses the store of the `host` and `ports` in kwargs"""
+        if not isinstance(store, type):
+            kwargs.update(host=store.p.host, ports=store.p.ports)
+        return store.BrokerCls(*args, **kwargs)
 
     def __init__(self, *args, **kwargs):
         super(MTraderStore, self).__init__()
@@ -349,33 +705,94 @@ def __init__(self, *args, **kwargs):
         self._env = None  # reference to cerebro for general notifications
         self.broker = None  # broker instance
         self.datas = list()  # datas that have registered over start
+        self._datasbyname = dict()  # map data._name to the first data with that name
 
-        self._orders = collections.OrderedDict()  # map order.ref to oid
-        self._ordersrev = collections.OrderedDict()  # map oid to order.ref
+        # Open orders only, finished ones are retired by _retire_order
+        self._orders = dict()  # map order.ref to oid
+        self._ordersrev = dict()  # map oid to order.ref
         self._orders_type = dict()  # keeps order types
+        self._retired = collections.OrderedDict()  # map oid to order.ref of the last finished orders
+        self._positionids = dict()  # map order.ref of filled market orders to oid, closed by cancelling the order
+        self._triggered = set()  # order.ref of trailing stops sent by order_trigger, accepted already
+
+        # Transactions can arrive before the reply of the order that caused them.
+        # They wait here while order requests are in flight
+        self._translock = threading.Lock()
+        self._ordersinflight = 0
+        self._pendingtrans = collections.defaultdict(list)  # map oid to transactions
+        self._basket = None  # orders collected by `basket`
+        self.latency = LatencyTracker(self.params.latencyorders)
 
         kwargs.update(
             {
                 "host": self.params.host,
+                "ports": self.params.ports,
                 "debug": self.params.debug,
                 "datatimeout": self.params.datatimeout,
+                "codec": self.params.codec,
             }
         )
         self.oapi = MTraderAPI(*args, **kwargs)
 
-        self._cash = 0.0
-        self._value = 0.0
+        self.recorder = None
+        self._open_recorder()
+
+        self._historycache = None
+        indicatorpath = None
+        if self.params.cachedir is not None:
+            self._historycache = HistoryCache(self.params.cachedir)
+            indicatorpath = os.path.join(self.params.cachedir, "indicators")
+        self.indicatorcache = IndicatorCache(
+            indicatorpath, maxitems=self.params.indicatorcache, maxbytes=self.params.indicatorcachemb * 1024 * 1024
+        )
+        self._indicatorids = dict()  # MT5 indicator instances by indicator cache key
+
+        # chart messages are sent from a background thread
+        self._chartpublisher = ChartPublisher(
+            self.oapi._push_chart_data, interval=self.params.chartinterval, maxvalues=self.params.chartbatch
+        )
 
-        self.q_livedata = queue.Queue()
+        # balance and equity, refreshed in the background once the broker started
+        self.account = AccountService(self._balance_request, self.params.balanceinterval, self.put_notification)
+
+        # live data queues by (symbol, granularity), routed by '_t_livedata'
+        self._livequeues = dict()
+        self._livequeues_all = tuple()
+        self._livedisconnected = False
 
         self._cancel_flag = False
 
+        # one thread polls the live data and events sockets
+        self._streaming = None
+        self._streamingstop = False
+        self._wake_r, self._wake_w = socketpair()
+        self._wake_r.setblocking(False)
+        self.socket_errors = collections.Counter()  # failed receives or messages by socket
+
+        self._historystreams = set()  # running history downloads
+
+        # Feeds of the same symbol and granularity share the subscription, the live
+        # messages and history downloads with the same dates
+        self._feeds = collections.Counter()  # (symbol, granularity) -> feeds created
+        self._subscriptions = collections.Counter()  # (symbol, granularity) -> feeds started
+        self._sublock = threading.Lock()
+        self._sharedhistory = dict()  # history request -> SharedHistory being read
+        self._historyarrays = dict()  # history request -> [array, feeds that may still ask for it]
+        self._bases = dict()  # (symbol, granularity) -> granularity its candles are built from or None
+
+        derivebars = self.params.derivebars
+        if derivebars and derivebars is not True and derivebars not in PERIODS:
+            raise ValueError("derivebars must be a boolean or a candle granularity, not {!r}".format(derivebars))
+
         self.debug = self.params.debug
 
         # Clear any previous subscribed Symbols
         self.reset_server()
 
     def start(self, data=None, broker=None):
+        # a session after `stop` appends to the recording again
+        self._open_recorder()
+
         # Datas require some processing to kickstart data reception
         if data is None and broker is None:
             self.cash = None
@@ -385,6 +802,7 @@ def start(self, data=None, broker=None):
             self._env = data._env
             # For datas simulate a queue with None to kickstart co
             self.datas.append(data)
+            self._datasbyname.setdefault(data._name, data)
 
             if self.broker is not None:
                 self.broker.data_started(data)
@@ -393,12 +811,33 @@ def start(self, data=None, broker=None):
             self.broker = broker
             self.broker_threads()
             self.streaming_events()
+            self.account.start()
 
     def stop(self):
         # signal end of thread
         if self.broker is not None:
-            self.q_ordercreate.put(None)
-            self.q_orderclose.put(None)
+            for q in self._orderqueues:
+                q.put(None)
+
+        self.stop_streaming()
+        self.account.stop()
+
+        for shared in list(self._historystreams):
+            shared.stop()
+
+        self.indicatorcache.flush()
+        self._chartpublisher.flush()
+        self._close_recorder()
+
+    def _open_recorder(self):
+        if self.recorder is None and self.params.recordfile is not None:
+            self.recorder = Recorder(self.params.recordfile, self.oapi.codec)
+            self.oapi.recorder = self.recorder
+
+    def _close_recorder(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = self.oapi.recorder = None
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -429,70 +868,189 @@ def get_granularity(self, frame, compression):
         return granularity
 
     def get_cash(self):
-        return self._cash
+        return self.account.snapshot.balance
 
     def get_value(self):
-        return self._value
+        return self.account.snapshot.equity
+
+    def get_account_state(self):
+        """Returns the last `AccountSnapshot` with balance, equity, margin, free margin
+        and the unix time it was received. Does not wait for the terminal"""
+        return self.account.snapshot
+
+    def get_order_latency(self, oref):
+        """Returns the `backtradermql5.latency.OrderTimes` of an order: monotonic times
+        of creation, queueing, wire send, terminal "OK", reply and fills"""
+        return self.latency.get(oref)
+
+    def get_latency_stats(self, percentiles=(50, 90, 99)):
+        """Returns rolling percentiles in milliseconds of each order lifecycle stage,
+        see `backtradermql5.latency.STAGES`"""
+        return self.latency.percentiles(percentiles)
 
     def get_balance(self):
-        try:
-            bal = self.oapi.construct_and_send(action="BALANCE")
-        except Exception as e:
-            self.put_notification(e)
-        # TODO: error handling
-        # if bal['error']:
-        #     self.put_notification(bal)
-        #     continue
-        try:
-            self._cash = float(bal["balance"])
-            self._value = float(bal["equity"])
-        except KeyError:
-            pass
+        """Requests balance and equity and waits for the reply"""
+        self.account.update()
+
+    def _balance_request(self):
+        return self.oapi.construct_and_send(action="BALANCE")
 
     def streaming_events(self):
-        t = threading.Thread(target=self._t_livedata, daemon=True)
-        t.start()
+        """Starts the thread receiving live data and trade transactions"""
+        if self._streaming is not None:
+            return
 
-        t = threading.Thread(target=self._t_streaming_events, daemon=True)
-        t.start()
+        self._streamingstop = False
+        self._streaming = threading.Thread(target=self._t_streaming, daemon=True)
+        self._streaming.start()
 
-    def _t_livedata(self):
-        # create socket connection for the Thread
-        socket = self.oapi.live_socket()
-        while True:
-            try:
-                last_data = socket.recv_json()
-                if self.debug:
-                    print("ZMQ LIVE DATA: ", last_data)
-            except zmq.ZMQError:
-                raise zmq.NotDone("Live data ERROR")
+    def stop_streaming(self):
+        """Stops the thread started by `streaming_events`. Can be called more than once"""
+        if self._streaming is None:
+            return
 
-            self.q_livedata.put(last_data)
+        self._streamingstop = True
+        self._wake_w.send(b"\0")
+        if self._streaming is not threading.current_thread():
+            self._streaming.join()
+        self._streaming = None
+
+    def _t_streaming(self):
+        # create socket connections for the Thread
+        live = self.oapi.live_socket()
+        events = self.oapi.streaming_socket()
+        handlers = (
+            (live, "live", LIVE, "ZMQ LIVE DATA: ", self._route_livedata),
+            (events, "events", EVENTS, "ZMQ STREAMING TRANSACTION: ", self._transaction),
+        )
 
-    def _t_streaming_events(self):
-        # create socket connection for the Thread
-        socket = self.oapi.streaming_socket()
-        while True:
-            try:
-                transaction = socket.recv_json()
-                if self.debug:
-                    print("ZMQ STREAMING TRANSACTION: ", transaction)
-            except zmq.ZMQError:
-                raise zmq.NotDone("Streaming data ERROR")
+        poller = zmq.Poller()
+        poller.register(self._wake_r, zmq.POLLIN)
+        poller.register(live, zmq.POLLIN)
+        poller.register(events, zmq.POLLIN)
+
+        while not self._streamingstop:
+            ready = dict(poller.poll())
+
+            if self._wake_r.fileno() in ready:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            for socket, name, channel, debugmsg, handler in handlers:
+                if socket not in ready:
+                    continue
+
+                # drain a batch per wake up, then give the other socket a turn
+                for _ in range(self._STREAMING_BATCH):
+                    try:
+                        raw = socket.recv(zmq.NOBLOCK)
+                        # opened and closed by start and stop while streaming
+                        recorder = self.recorder
+                        if recorder is not None:
+                            recorder.write(channel, raw)
+                        msg = self.oapi.codec.loads(raw)
+                    except zmq.Again:
+                        break
+                    except Exception as e:
+                        self.socket_errors[name] += 1
+                        self.put_notification(e)
+                        continue
+
+                    if self.debug:
+                        print(debugmsg, msg)
+
+                    try:
+                        handler(msg)
+                    except Exception as e:
+                        self.socket_errors[name] += 1
+                        self.put_notification(e)
+
+        live.close(linger=0)
+        events.close(linger=0)
+
+    def register_livequeue(self, symbol, granularity):
+        """Returns a queue receiving the live data of a symbol and granularity"""
+        q = queue.Queue()
+        key = (symbol, granularity)
+        # Tuples are replaced and never mutated, the live data thread reads them without locking
+        self._livequeues[key] = self._livequeues.get(key, ()) + (q,)
+        self._livequeues_all += (q,)
+        return q
+
+    def unregister_livequeue(self, symbol, granularity, q):
+        """Stops routing live data to a queue returned by `register_livequeue`"""
+        key = (symbol, granularity)
+        queues = tuple(x for x in self._livequeues.get(key, ()) if x is not q)
+        if queues:
+            self._livequeues[key] = queues
+        else:
+            self._livequeues.pop(key, None)
+        self._livequeues_all = tuple(x for x in self._livequeues_all if x is not q)
+
+    def _route_livedata(self, msg):
+        """Puts a live data message in the queues of the feeds it belongs to.
+
+        Status changes of the terminal connection are fanned out to all feeds
+        """
+        status = msg.get("status")
+        if status == "DISCONNECTED" or (status == "CONNECTED" and self._livedisconnected):
+            self._livedisconnected = status == "DISCONNECTED"
+            for q in self._livequeues_all:
+                q.put(msg)
+            return
 
-            self._transaction(transaction)
+        for q in self._livequeues.get((msg.get("symbol"), msg.get("timeframe")), ()):
+            q.put(msg)
+
+        if self.broker is not None and msg.get("data"):
+            if msg.get("timeframe") == "TICK":
+                _, bid, ask = msg["data"]
+            else:
+                bid = ask = msg["data"][4]  # close of the current candle
+            self.broker._live_prices(msg.get("symbol"), float(bid), float(ask))
 
     def broker_threads(self):
-        self.q_ordercreate = queue.Queue()
-        t = threading.Thread(target=self._t_order_create, daemon=True)
-        t.start()
+        self._orderqueues = [queue.Queue() for _ in range(max(1, self.p.orderworkers))]
+        for q in self._orderqueues:
+            t = threading.Thread(target=self._t_orders, args=(q,), daemon=True)
+            t.start()
 
-        self.q_orderclose = queue.Queue()
-        t = threading.Thread(target=self._t_order_cancel, daemon=True)
-        t.start()
+    def _orderqueue(self, symbol):
+        """Queue of the order thread of a symbol"""
+        return self._orderqueues[zlib.crc32(symbol.encode("utf8")) % len(self._orderqueues)]
 
     def order_create(self, order, stopside=None, takeside=None, **kwargs):
         """Creates an order"""
+        okwargs = self._order_request(order, stopside, takeside, **kwargs)
+        if self._basket is not None:
+            self._basket.append((order.ref, okwargs))
+        else:
+            self._order_queue(order.ref, okwargs)
+
+        # notify orders of being submitted
+        self.broker._submit(order.ref)
+        if stopside is not None and stopside.price is not None:
+            self.broker._submit(stopside.ref)
+        if takeside is not None and takeside.price is not None:
+            self.broker._submit(takeside.ref)
+
+        return order
+
+    def order_trigger(self, order):
+        """Sends an order trailed by the broker whose stop was hit, as a market order"""
+        self._triggered.add(order.ref)
+        self._order_queue(order.ref, self._order_request(order))
+        return order
+
+    def _order_queue(self, oref, okwargs):
+        self.latency.queued(oref)
+        self._orderqueue(okwargs["symbol"]).put(("create", [(oref, okwargs)]))
+
+    def _order_request(self, order, stopside=None, takeside=None, **kwargs):
+        """TRADE request of an order"""
         okwargs = dict()
         okwargs["action"] = "TRADE"
 
@@ -505,7 +1063,7 @@ def order_create(self, order, stopside=None, takeside=None, **kwargs):
         okwargs["symbol"] = order.data._dataname
         okwargs["volume"] = abs(order.created.size)
 
-        if order.exectype != bt.Order.Market:
+        if order.exectype not in (bt.Order.Market, bt.Order.StopTrail):
             okwargs["price"] = format(order.created.price)
 
         if order.valid is None:
@@ -516,10 +1074,6 @@ def order_create(self, order, stopside=None, takeside=None, **kwargs):
         if order.exectype == bt.Order.StopLimit:
             okwargs["price"] = order.created.pricelimit
 
-        # TODO: implement StopTrail
-        # if order.exectype == bt.Order.StopTrail:
-        #     okwargs['distance'] = order.trailamount
-
         okwargs["comment"] = dict()
 
         if stopside is not None and stopside.price is not None:
@@ -534,88 +1088,315 @@ def order_create(self, order, stopside=None, takeside=None, **kwargs):
         okwargs["magic"] = order.ref
 
         okwargs.update(**kwargs)  # anything from the user
-        self.q_ordercreate.put(
-            (
-                order.ref,
-                okwargs,
-            )
-        )
+        return okwargs
 
-        # notify orders of being submitted
-        self.broker._submit(order.ref)
-        if stopside is not None and stopside.price is not None:
-            self.broker._submit(stopside.ref)
-        if takeside is not None and takeside.price is not None:
-            self.broker._submit(takeside.ref)
+    @contextlib.contextmanager
+    def basket(self):
+        """Orders created inside the block are sent together when it ends.
 
-        return order
+        Their requests are pipelined, so they reach the terminal without
+        waiting for the replies of the ones before. Replies and rejects are
+        still handled order by order. Baskets can be nested, the outermost
+        one sends the orders.
 
-    def _t_order_create(self):
+            with store.basket():
+                for data in self.datas:
+                    self.buy(data=data, size=0.1)
+        """
+        if self._basket is not None:
+            yield
+            return
+
+        self._basket = list()
+        try:
+            yield
+        finally:
+            orders, self._basket = self._basket, None
+            byqueue = collections.OrderedDict()
+            for oref, okwargs in orders:
+                self.latency.queued(oref)
+                byqueue.setdefault(self._orderqueue(okwargs["symbol"]), list()).append((oref, okwargs))
+            for q, items in byqueue.items():
+                q.put(("create", items))
+
+    def _t_orders(self, q):
         while True:
-            msg = self.q_ordercreate.get()
+            msg = q.get()
             if msg is None:
                 break
 
-            oref, okwargs = msg
-
+            action, arg = msg
             try:
-                o = self.oapi.construct_and_send(**okwargs)
+                if action == "create":
+                    self._orders_create(arg)
+                else:
+                    self._order_cancel(arg)
             except Exception as e:
+                # a failed order must not stop the thread
                 self.put_notification(e)
-                self.broker._reject(oref)
-                return
 
-            if self.debug:
-                print(o)
+    def _orders_create(self, orders):
+        with self._translock:
+            self._ordersinflight += len(orders)
+
+        # send every order of a basket before waiting for the first reply
+        sent = list()
+        for oref, okwargs in orders:
+            sent.append((oref, okwargs, self._order_submit(okwargs)))
+
+        for oref, okwargs, fut in sent:
+            for _ in range(self.p.orderretries):
+                if not self._order_retryable(fut):
+                    break
+                fut = self._order_submit(okwargs)
+            self._order_reply(oref, okwargs, fut)
+
+    def _order_submit(self, okwargs):
+        """Sends an order request. A request that can not be built or sent gives
+        a failed future, so the order is rejected and no longer counted in flight"""
+        try:
+            return self.oapi.submit(self.oapi.construct_request(**okwargs))
+        except Exception as e:
+            fut = Future()
+            fut.set_exception(e)
+            return fut
 
-            if o["error"]:
-                self.put_notification(o["desription"])
-                self.broker._reject(oref)
-                return
-            else:
-                oid = o["order"]
+    def _order_retryable(self, fut):
+        """Whether an order request can be sent again without the risk of a second order"""
+        try:
+            o = fut.result()
+        except zmq.NotDone:
+            # a request that timed out may still reach the terminal
+            return getattr(fut, "t_sent", None) is None
+        except Exception:
+            return False
+        return bool(o.get("error")) and o.get("retcode") in self._RETRY_RETCODES
+
+    def _order_reply(self, oref, okwargs, fut):
+        """Maps the reply of an order request to its backtrader order"""
+        triggered = oref in self._triggered
+        self._triggered.discard(oref)
+        try:
+            o = fut.result()
+        except Exception as e:
+            self.latency.replied(oref, fut, rejected=True)
+            self._order_done()
+            self.put_notification(e)
+            self.broker._reject(oref)
+            return
+
+        self.latency.replied(oref, fut, rejected=bool(o["error"]))
+        if self.debug:
+            print(o)
 
-            self._orders[oref] = oid
+        if o["error"]:
+            self._order_done()
+            # the JSON API spells the key "desription"
+            self.put_notification(o.get("desription", o.get("description")))
+            self.broker._reject(oref)
+            return
+        else:
+            oid = o["order"]
+
+        if not triggered:
+            # a trailing stop was submitted and accepted when the broker took it
             self.broker._submit(oref)
 
-            # keeps orders types
-            self._orders_type[oref] = okwargs["actionType"]
-            # maps ids to backtrader order
-            self._ordersrev[oid] = oref
+        # keeps orders types
+        self._orders_type[oref] = okwargs["actionType"]
+        # maps ids to backtrader order
+        self._ordersrev[oid] = oref
+        self._orders[oref] = oid
+
+        self._order_done(oid)
+
+    def _order_done(self, oid=None):
+        """Processes the transactions that arrived before the order reply"""
+        with self._translock:
+            self._ordersinflight -= 1
+            transactions = self._pendingtrans.pop(oid, [])
+            if not self._ordersinflight:
+                # nothing in flight, the remaining transactions come from external orders
+                external = [t for ts in self._pendingtrans.values() for t in ts]
+                self._pendingtrans.clear()
+            else:
+                external = []
+
+        for request, reply in transactions:
+            self._process_transaction(oid, request, reply)
+        for request, reply in external:
+            self._external_transaction(request, reply)
 
     def order_cancel(self, order):
-        self.q_orderclose.put(order.ref)
+        # same thread as the orders of the symbol, so a cancel never overtakes its order
+        self._orderqueue(order.data._dataname).put(("cancel", order.ref))
         return order
 
-    def _t_order_cancel(self):
-        while True:
-            oref = self.q_orderclose.get()
-            if oref is None:
-                break
+    def _order_cancel(self, oref):
+        oid = self._orders.get(oref, self._positionids.get(oref))
+        if oid is None:
+            return  # the order is no longer there
 
-            oid = self._orders.get(oref, None)
-            if oid is None:
-                continue  # the order is no longer there
+        # get symbol name
+        order = self.broker.orders[oref]
+        symbol = order.data._dataname
+        # get order type
+        order_type = self._orders_type.get(oref, None)
 
-            # get symbol name
-            order = self.broker.orders[oref]
-            symbol = order.data._dataname
-            # get order type
-            order_type = self._orders_type.get(oref, None)
+        try:
+            if order_type in ["ORDER_TYPE_BUY", "ORDER_TYPE_SELL"] or oref in self._positionids:
+                self.close_position(oid, symbol)
+            else:
+                self.cancel_order(oid, symbol)
+        except Exception as e:
+            self.put_notification("Order not cancelled: {}, {}".format(oid, e))
+            return
 
-            try:
-                if order_type in ["ORDER_TYPE_BUY", "ORDER_TYPE_SELL"]:
-                    self.close_position(oid, symbol)
-                else:
-                    self.cancel_order(oid, symbol)
-            except Exception as e:
-                self.put_notification("Order not cancelled: {}, {}".format(oid, e))
-                continue
+        self._cancel_flag = True
+        self.broker._cancel(oref)
+        self._retire_order(oref)
+        self._positionids.pop(oref, None)
 
-            self._cancel_flag = True
-            self.broker._cancel(oref)
+    def _history_request(self, symbol, granularity, begin, end):
+        """Sends a HISTORY request. Returns a future for the reply"""
+        request = self.oapi.construct_request(
+            action="HISTORY",
+            actionType="DATA",
+            symbol=symbol,
+            chartTF=granularity,
+            fromDate=begin,
+            toDate=end,
+            # correctTickHistory=correct_tick_history,
+        )
+        return self.oapi.submit(request)
+
+    def _history_windows(self, granularity, begin, end):
+        """Splits a download between two unix timestamps into windows of `historychunk` bars"""
+        if begin is None or not self.p.historychunk:
+            return [(begin, end)]
+
+        span = self.p.historychunk * PERIODS.get(granularity, 1)
+        stop = end if end is not None else int(time.time())
+        windows = list()
+        while begin + span < stop:
+            windows.append((begin, begin + span))
+            begin += span
+        windows.append((begin, end))
+        return windows
+
+    @staticmethod
+    def _window_tail(granularity, rows, tail):
+        """Rows at the last time of a window. The next window may repeat them"""
+        if not rows:
+            return tail
+        if granularity != "TICK":
+            return rows[-1:]
+
+        last = rows[-1][0]
+        i = len(rows) - 1
+        while i > 0 and rows[i - 1][0] == last:
+            i -= 1
+        return rows[i:]
+
+    @staticmethod
+    def _dedupe_window(granularity, rows, tail):
+        """Drops the rows of a window already received with the previous window.
+
+        Candles are unique by time. Several ticks can share a millisecond, so
+        ticks at the boundary time are only dropped if they were received
+        """
+        if not tail or not rows:
+            return rows
+
+        last = tail[-1][0]
+        i = 0
+        while i < len(rows) and rows[i][0] <= last:
+            i += 1
+        if not i:
+            return rows
+
+        head = list()
+        if granularity == "TICK":
+            seen = list(tail)
+            for row in rows[:i]:
+                if row[0] < last:
+                    continue
+                if row in seen:
+                    seen.remove(row)
+                else:
+                    head.append(row)
+        return head + rows[i:]
+
+    def _history_shards(self, symbol, granularity, begin, end):
+        """Downloads the history of a symbol between two unix timestamps in
+        windows of `historychunk` bars. Yields the rows of each window in
+        order, without the rows already received with the previous window.
+
+        Up to `historyconcurrency` windows are requested ahead. A window whose
+        request times out is requested again up to `historyretries` times
+        """
+        windows = collections.deque(self._history_windows(granularity, begin, end))
+        inflight = collections.deque()
+        tail = list()
+        while windows or inflight:
+            while windows and len(inflight) < max(1, self.p.historyconcurrency):
+                window = windows.popleft()
+                inflight.append((window, self._history_request(symbol, granularity, *window)))
+
+            window, pending = inflight.popleft()
+            retries = 0
+            while True:
+                try:
+                    rows = pending.result()["data"]
+                    break
+                except zmq.NotDone:
+                    if retries >= self.p.historyretries:
+                        raise
+                    retries += 1
+                    if self.debug:
+                        print("Retrying: {}, Timeframe: {}, window: {} - {}".format(symbol, granularity, *window))
+                    pending = self._history_request(symbol, granularity, *window)
+
+            rows, tail = self._dedupe_window(granularity, rows, tail), self._window_tail(granularity, rows, tail)
+            yield rows
+
+    def _history_rows(self, symbol, granularity, begin, end):
+        """Downloads the history of a symbol between two unix timestamps as a list of rows"""
+        rows = list()
+        for shard in self._history_shards(symbol, granularity, begin, end):
+            rows.extend(shard)
+        return rows
+
+    def _t_price_data(self, shared, dataname, tf, begin, end, include_first):
+        """Downloads a history into a `SharedHistory`. Rows are added while the
+        next windows are downloaded"""
+        put = shared.put
+
+        # The last candle may not be closed and is held back until the next one arrives
+        holdback = not include_first and tf != "TICK"
+        held = None
+        shards = self._history_shards(dataname, tf, begin, end)
+        try:
+            for rows in shards:
+                for row in rows:
+                    if holdback:
+                        row, held = held, row
+                        if row is None:
+                            continue
+                    if not put(row):
+                        return
+                del rows
+
+            put({})
+        except Exception as e:
+            self.put_notification(e)
+            put(None)
+        finally:
+            shards.close()
+            self._historystreams.discard(shared)
 
-    def price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False):
+    def _price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False):
+        """Downloads the history of a symbol as a list of rows"""
         # def price_data(
         #     self, dataname, dtbegin, dtend, timeframe, compression, include_first=False, correct_tick_history=False
         # ):
@@ -630,16 +1411,7 @@ def price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_f
         if self.debug:
             print("Fetching: {}, Timeframe: {}, Fromdate: {}".format(dataname, tf, dtbegin))
 
-        data = self.oapi.construct_and_send(
-            action="HISTORY",
-            actionType="DATA",
-            symbol=dataname,
-            chartTF=tf,
-            fromDate=begin,
-            toDate=end,
-            # correctTickHistory=correct_tick_history,
-        )
-        price_data = data["data"]
+        price_data = self._history_rows(dataname, tf, begin, end)
         # Remove last unclosed candle
         # TODO Is this relevant for ticks?
         if not include_first and tf != "TICK":
@@ -648,12 +1420,187 @@ def price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_f
             except:
                 pass
 
-        q = queue.Queue()
-        for c in price_data:
-            q.put(c)
+        return price_data
 
-        q.put({})
-        return q
+    def _cached_price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False):
+        """Serves the history of a symbol from the history cache, downloading only
+        what the cache lacks before and after its range"""
+        tf = self.get_granularity(timeframe, compression)
+        # tick times are in milliseconds
+        scale = 1000.0 if tf == "TICK" else 1.0
+
+        begin = end = None
+        if dtbegin:
+            begin = int((dtbegin - self._DTEPOCH).total_seconds())
+        if dtend:
+            end = int((dtend - self._DTEPOCH).total_seconds())
+
+        cached = self._historycache.load(dataname, tf)
+        if cached is None:
+            cbegin = begin
+            merged = self._rows2array(tf, self._history_rows(dataname, tf, begin, end))
+        else:
+            cbegin, cend, data = cached
+            head = tail = None
+            if begin < cbegin:
+                if self.debug:
+                    print("Fetching: {}, Timeframe: {}, head of cache: {} - {}".format(dataname, tf, begin, cbegin))
+                head = self._rows2array(tf, self._history_rows(dataname, tf, begin, cbegin))
+                cbegin = begin
+            if end is None or end > cend:
+                if self.debug:
+                    print("Fetching: {}, Timeframe: {}, tail of cache: {} - {}".format(dataname, tf, cend, end))
+                tail = self._rows2array(tf, self._history_rows(dataname, tf, cend, end))
+
+            # Where downloads overlap the cache the latest one wins: a download replaces the cached rows of
+            # the times it covers. Rows are not deduplicated by time, ticks can share a millisecond
+            if head is not None and head.shape[1]:
+                data = data[:, data[0] > head[0, -1]]
+            if tail is not None and tail.shape[1]:
+                data = data[:, data[0] < tail[0, 0]]
+            parts = [part for part in (head, data, tail) if part is not None]
+            merged = np.concatenate(parts, axis=1)
+            merged = merged[:, np.argsort(merged[0], kind="stable")]
+
+        # The last candle may not be closed yet and stays out of the cache
+        keep = merged if tf == "TICK" else merged[:, :-1]
+        if keep.shape[1]:
+            kend = int(keep[0, -1] // scale)
+            if cached is None or (cbegin, kend) != cached[:2]:
+                self._historycache.save(dataname, tf, cbegin, kend, keep)
+
+        # Slice the requested range, starting with the candle open at `begin`
+        times = merged[0] / scale
+        first = np.searchsorted(times, begin, side="left" if tf == "TICK" else "right")
+        if tf != "TICK":
+            first = max(first - 1, 0)
+        last = len(times) if end is None else np.searchsorted(times, end, side="right")
+        price_data = merged[:, first:last]
+
+        # Remove last unclosed candle
+        if not include_first and tf != "TICK":
+            price_data = price_data[:, :-1]
+
+        return np.ascontiguousarray(price_data)
+
+    def _rows2array(self, granularity, price_data):
+        fields = 3 if granularity == "TICK" else 7
+        if not price_data:
+            return np.empty((fields, 0))
+
+        return np.ascontiguousarray(np.array(price_data, dtype=np.float64).T)
+
+    def _derived_begin(self, dtbegin, aggregator):
+        # Start of the history of the base granularity of an aggregator. The data feeds drop bars before fromdate
+        if not dtbegin:
+            return dtbegin
+        begin = int((dtbegin - self._DTEPOCH).total_seconds())
+        return self._DTEPOCH + timedelta(seconds=aggregator.history_begin(begin))
+
+    def price_data_array(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False, aggregator=None):
+        """Downloads the history of a symbol as columnar array.
+
+        Rows of the returned array are the fields of the server reply:
+        (time, bid, ask) for ticks and (time, open, high, low, close,
+        volume, spread) for candles.
+
+        While fewer feeds of the symbol and granularity asked for their
+        history than were created, the array is kept and returned again for
+        the same dates. It must not be modified.
+
+        With a `BarAggregator` or `TickBarAggregator` the history of its base
+        granularity is downloaded and the array holds the bars built from it.
+        The last bar is then only included if complete, unless
+        `include_first`
+        """
+        if aggregator is not None:
+            dtbegin = self._derived_begin(dtbegin, aggregator)
+            rows = self.price_data_array(dataname, dtbegin, dtend, *self._TIMEFRAMES[aggregator.base])
+            return aggregator.aggregate(rows, include_first)
+
+        key = (dataname, dtbegin, dtend, timeframe, compression, include_first)
+        with self._sublock:
+            shared = self._historyarrays.get(key)
+            if shared is not None:
+                shared[1] -= 1
+                if shared[1] <= 0:
+                    del self._historyarrays[key]
+                return shared[0]
+
+        tf = self.get_granularity(timeframe, compression)
+        if self._historycache is not None and dtbegin:
+            price_data = self._cached_price_data(dataname, dtbegin, dtend, timeframe, compression, include_first)
+        else:
+            price_data = self._rows2array(
+                tf, self._price_data(dataname, dtbegin, dtend, timeframe, compression, include_first)
+            )
+
+        others = self._history_readers(dataname, tf) - 1
+        if others > 0:
+            price_data.flags.writeable = False
+            with self._sublock:
+                self._historyarrays[key] = [price_data, others]
+        return price_data
+
+    def price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_first=False, aggregator=None):
+        """Downloads the history of a symbol into a queue of rows ending with `{}`.
+
+        The download is split into windows of `historychunk` bars and fed to
+        the queue by a background thread, so rows can be consumed while later
+        windows are downloaded. `None` is queued if a download fails.
+
+        Feeds asking for the same history while it is read share the
+        download: the returned queue is a `HistoryReader` of it.
+
+        With a `BarAggregator` or `TickBarAggregator` the history of its base
+        granularity is downloaded and the queue returns the bars built by the
+        aggregator, see `backtradermql5.bars.DerivedHistory`. The feed then
+        passes its live data through the same aggregator
+        """
+        if aggregator is not None:
+            dtbegin = self._derived_begin(dtbegin, aggregator)
+            reader = self.price_data(dataname, dtbegin, dtend, *self._TIMEFRAMES[aggregator.base])
+            return DerivedHistory(reader, aggregator, include_first)
+
+        key = (dataname, dtbegin, dtend, timeframe, compression, include_first)
+        with self._sublock:
+            for k in [k for k, shared in self._sharedhistory.items() if shared.stopped.is_set()]:
+                del self._sharedhistory[k]
+            shared = self._sharedhistory.get(key)
+            reader = shared.reader() if shared is not None else None
+            if reader is not None:
+                return reader
+
+            shared = self._sharedhistory[key] = SharedHistory(self.p.historychunk or 0)
+            reader = shared.reader()
+
+        if self._historycache is not None and dtbegin:
+            price_data = self._cached_price_data(dataname, dtbegin, dtend, timeframe, compression, include_first)
+            shared.maxrows = 0
+            for c in price_data.T.tolist():
+                shared.put(c)
+            shared.put({})
+            return reader
+
+        tf = self.get_granularity(timeframe, compression)
+
+        begin = end = None
+        if dtbegin:
+            begin = int((dtbegin - self._DTEPOCH).total_seconds())
+        if dtend:
+            end = int((dtend - self._DTEPOCH).total_seconds())
+
+        if self.debug:
+            print("Fetching: {}, Timeframe: {}, Fromdate: {}".format(dataname, tf, dtbegin))
+
+        self._historystreams.add(shared)
+        t = threading.Thread(
+            target=self._t_price_data,
+            args=(shared, dataname, tf, begin, end, include_first),
+            daemon=True,
+        )
+        t.start()
+        return reader
 
         # TODO live updates
         # self.streaming_events()
@@ -671,19 +1618,90 @@ def price_data(self, dataname, dtbegin, dtend, timeframe, compression, include_f
         #   if msg['status']=='DISCONNECTED':
         #     return
 
+    def add_feed(self, symbol, timeframe, compression):
+        """Counts a data feed created for a symbol and time frame, before it
+        starts. Feeds preloading the same history then share one download"""
+        self._feeds[(symbol, self.get_granularity(timeframe, compression))] += 1
+
+    def base_granularity(self, symbol, granularity):
+        """Granularity the candles of the feeds of a symbol and granularity are
+        built from with the `derivebars` param, `None` if they are subscribed.
+        The choice holds until the last of these feeds is released"""
+        key = (symbol, granularity)
+        with self._sublock:
+            if key not in self._bases:
+                derivebars = self.p.derivebars
+                if derivebars is True:
+                    bases = [g for s, g in self._feeds if s == symbol and derivable(granularity, g)]
+                    base = min(bases, key=PERIODS.get) if bases else None
+                elif derivebars and derivable(granularity, derivebars):
+                    base = derivebars
+                else:
+                    base = None
+                self._bases[key] = base
+            return self._bases[key]
+
+    def _history_readers(self, symbol, granularity):
+        """Feeds created for a symbol reading the history of a granularity,
+        their candles being of that granularity or built from it"""
+        readers = 0
+        for (s, g), n in list(self._feeds.items()):
+            if s == symbol and (g == granularity or self.base_granularity(s, g) == granularity):
+                readers += n
+        return readers
+
+    def _subscribed(self, symbol, timeframe, compression):
+        # (symbol, granularity) of the feeds and of their subscription
+        granularity = self.get_granularity(timeframe, compression)
+        return (symbol, granularity), (symbol, self.base_granularity(symbol, granularity) or granularity)
+
     def config_server(self, symbol: str, timeframe: str, compression: int) -> None:
-        """Set server terminal symbol and time frame"""
-        ret_val = self.oapi.construct_and_send(
-            action="CONFIG",
-            symbol=symbol,
-            chartTF=self.get_granularity(timeframe, compression),
-        )
+        """Set server terminal symbol and time frame.
+
+        Subscriptions are counted: only the first feed of a symbol and
+        granularity subscribes the terminal, the others share its live data.
+        Feeds whose candles are built from a finer granularity take a
+        subscription of that granularity, see `base_granularity`
+        """
+        _, (symbol, granularity) = self._subscribed(symbol, timeframe, compression)
+        with self._sublock:
+            self._subscriptions[(symbol, granularity)] += 1
+            if self._subscriptions[(symbol, granularity)] > 1:
+                return
+
+        try:
+            ret_val = self.oapi.construct_and_send(action="CONFIG", symbol=symbol, chartTF=granularity)
+        except Exception:
+            self.release_server(symbol, timeframe, compression)
+            raise
 
         if ret_val["error"]:
+            self.release_server(symbol, timeframe, compression)
             print(ret_val)
             raise ServerConfigError(ret_val["description"])
             self.put_notification(ret_val["description"])
 
+    def release_server(self, symbol: str, timeframe: str, compression: int) -> None:
+        """Ends the subscription of a feed taken with `config_server` and counted
+        with `add_feed`. The terminal has no unsubscribe request, the last feed
+        releasing a symbol and granularity only frees the history kept for the
+        feeds"""
+        key, subkey = self._subscribed(symbol, timeframe, compression)
+        with self._sublock:
+            self._feeds[key] -= 1
+            if self._feeds[key] <= 0:
+                del self._feeds[key]
+                self._bases.pop(key, None)
+                if not self._feeds:
+                    # nothing is streamed any more
+                    self._close_recorder()
+            if self._subscriptions[subkey] > 1:
+                self._subscriptions[subkey] -= 1
+                return
+            self._subscriptions.pop(subkey, None)
+            for k in [k for k in self._historyarrays if (k[0], self.get_granularity(*k[3:5])) in (key, subkey)]:
+                del self._historyarrays[k]
+
     def check_account(self) -> None:
         """Get MetaTrader 5 account settings"""
         conf = self.oapi.construct_and_send(action="ACCOUNT")
@@ -723,7 +1741,7 @@ def _transaction(self, trans):
             raise KeyError(trans)
 
         # Update balance after transaction
-        # self.get_balance()
+        self.account.refresh()
 
         if self.debug:
             print(request, reply, sep="\n")
@@ -753,28 +1771,36 @@ def _transaction(self, trans):
         # except KeyError:
         #     raise KeyError(oid)
 
-        if oid in self._orders.values():
+        with self._translock:
+            known = oid in self._ordersrev or oid in self._retired
+            if not known and self._ordersinflight:
+                # may belong to an order whose reply is still on its way
+                self._pendingtrans[oid].append((request, reply))
+                return
+
+        if known:
             # when an order id exists process transaction
             self._process_transaction(oid, request, reply)
         else:
-            # external order created this transaction
-            if self._cancel_flag and reply["result"] == "TRADE_RETCODE_DONE":
-                self._cancel_flag = False
-
-                size = float(reply["volume"])
-                price = float(reply["price"])
-                if request["type"].endswith("_SELL"):
-                    size = -size
-                for data in self.datas:
-                    if data._name == request["symbol"]:
-                        self.broker._fill_external(data, size, price)
-                        break
+            self._external_transaction(request, reply)
+
+    def _external_transaction(self, request, reply):
+        # external order created this transaction
+        if self._cancel_flag and reply["result"] == "TRADE_RETCODE_DONE":
+            self._cancel_flag = False
+
+            size = float(reply["volume"])
+            price = float(reply["price"])
+            if request["type"].endswith("_SELL"):
+                size = -size
+            data = self._datasbyname.get(request["symbol"])
+            if data is not None:
+                self.broker._fill_external(data, size, price)
 
     def _process_transaction(self, oid, request, reply):
-        try:
-            # get a reference to a backtrader order based on the order id / trade id
-            oref = self._ordersrev[oid]
-        except KeyError:
+        # get a reference to a backtrader order based on the order id / trade id
+        oref = self._ordersrev.get(oid, self._retired.get(oid))
+        if oref is None:
             return
 
         if request["action"] == "TRADE_ACTION_PENDING":
@@ -785,7 +1811,34 @@ def _process_transaction(self, oid, request, reply):
             price = float(reply["price"])
             if request["type"].endswith("_SELL"):
                 size = -size
+            self.latency.filled(oref)
             self.broker._fill(oref, size, price, reason=request["type"])
+            self._retire_order(oref)
+
+    def _retire_order(self, oref):
+        """Removes a finished order from the maps of open orders.
+
+        An order stays open while it or the stop loss and take profit orders
+        of its bracket can still be filled. The ids of the last
+        `_RETIRED_ORDERS` finished orders are kept, so late transactions are
+        not taken for external ones. A filled market order keeps its id until
+        it is cancelled, which closes its position
+        """
+        order = self.broker.orders.get(oref)
+        if order is None or order.alive() or oref in self.broker.brackets:
+            return
+
+        with self._translock:
+            oid = self._orders.pop(oref, None)
+            if oid is None:
+                return
+            self._ordersrev.pop(oid, None)
+            if self._orders_type.pop(oref, None) in ("ORDER_TYPE_BUY", "ORDER_TYPE_SELL"):
+                # cancelling the order closes its position
+                self._positionids[oref] = oid
+            self._retired[oid] = oref
+            while len(self._retired) > self._RETIRED_ORDERS:
+                self._retired.popitem(last=False)
 
     def config_chart(self, chartId, symbol, timeframe, compression):
         """Opens a chart window in MT5"""
@@ -839,10 +1892,16 @@ def push_chart_data(
         indicator_buffer_id,
         from_date,
         data,
+        seq=None,
     ):
-        """Pushes backtrader indicator values to be distributed to be drawn by JsonAPIIndicator instances"""
+        """Pushes backtrader indicator values to be distributed to be drawn by JsonAPIIndicator instances.
 
-        self.oapi.chart_data_construct_and_send(
+        Values are queued and sent in the background. `seq` is the number of
+        the bar of the newest value and lets values of successive bars be
+        sent as one message
+        """
+
+        message = self.oapi.construct_chart_message(
             action="PLOT",
             actionType="DATA",
             chartId=chart_id,
@@ -852,17 +1911,19 @@ def push_chart_data(
             fromDate=from_date,
             data=data,
         )
+        self._chartpublisher.put(message, seq)
 
     def chart_indicator_add_line(self, chart_id, chart_indicator_id, style):
         """Add line to be drawn by JsonAPIIndicator instances"""
 
-        self.oapi.chart_data_construct_and_send(
+        message = self.oapi.construct_chart_message(
             action="PLOT",
             actionType="ADDBUFFER",
             chartId=chart_id,
             chartIndicatorId=chart_indicator_id,
             style=style,
         )
+        self._chartpublisher.put(message)
 
     # def chart_add_graphic(self, chartId, chartIndicatorId, chartIndicatorSubWindow, style):
     #     """Add graphical objects to a chart window"""
@@ -881,9 +1942,7 @@ def chart_indicator_add_line(self, chart_id, chart_indicator_id, style):
     #         raise ChartError(ret_val["description"])
     #         self.put_notification(ret_val["description"])
 
-    def config_indicator(self, symbol, timeframe, compression, name, id, params, linecount):
-        """Instantiates an indicator in MT5"""
-
+    def _indicator_granularity(self, timeframe, compression):
         tf = self.get_granularity(timeframe, compression)
         if tf == "TICK":
             raise ValueError(
@@ -891,6 +1950,28 @@ def config_indicator(self, symbol, timeframe, compression, name, id, params, lin
                 compression %s"
                 % (bt.TimeFrame.getname(timeframe, compression), compression)
             )
+        return tf
+
+    def indicator_series(self, symbol, timeframe, compression, name, params, linecount):
+        """Returns the cached values of an indicator, see `IndicatorCache`"""
+        tf = self._indicator_granularity(timeframe, compression)
+        key = IndicatorCache.key(name, params, symbol, tf, linecount)
+        return self.indicatorcache.series(key, linecount)
+
+    def shared_indicator(self, symbol, timeframe, compression, name, params, linecount):
+        """Returns the id of an indicator instance in MT5, attached on first use
+        and shared by indicators with the same parameters"""
+        tf = self._indicator_granularity(timeframe, compression)
+        key = IndicatorCache.key(name, params, symbol, tf, linecount)
+        if key not in self._indicatorids:
+            ret_val = self.config_indicator(symbol, timeframe, compression, name, str(uuid.uuid4()), params, linecount)
+            self._indicatorids[key] = ret_val["id"]
+        return self._indicatorids[key]
+
+    def config_indicator(self, symbol, timeframe, compression, name, id, params, linecount):
+        """Instantiates an indicator in MT5"""
+
+        tf = self._indicator_granularity(timeframe, compression)
 
         ret_val = self.oapi.indicator_construct_and_send(
             action="INDICATOR",
@@ -940,10 +2021,45 @@ def indicator_data(
 
         return ret_val
 
+    def indicator_data_range(self, indicatorId, fromDate, toDate):
+        """Recieves the values of a MT5 indicator instance for the bars between two unix timestamps.
+
+        Returns `(times, values)`, the bar times and an array with a row of
+        values per indicator line, or `None` if the server only answers with
+        the values of a single bar
+        """
+
+        if self.debug:
+            print(
+                "Req. indicator data from: {}, to: {}, Indicator Id: {}".format(
+                    datetime.utcfromtimestamp(float(fromDate)), datetime.utcfromtimestamp(float(toDate)), indicatorId
+                )
+            )
+
+        ret_val = self.oapi.indicator_construct_and_send(
+            action="INDICATOR",
+            actionType="REQUEST",
+            id=indicatorId,
+            fromDate=fromDate,
+            toDate=toDate,
+        )
+
+        if ret_val["error"]:
+            print(ret_val)
+            raise IndicatorError(ret_val["description"])
+
+        if "time" not in ret_val:
+            return None
+
+        times = np.array(ret_val["time"], dtype=np.int64)
+        values = np.array(ret_val["data"], dtype=np.float64).reshape(len(ret_val["data"]), len(times))
+        return times, values
+
     def reset_server(self) -> None:
         """Removes all symbol subscritions and clears all indicators"""
 
         ret_val = self.oapi.construct_and_send(action="RESET")
+        self._indicatorids.clear()
 
         if ret_val["error"]:
             print(ret_val)
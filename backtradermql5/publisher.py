@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+
+class ChartPublisher:
+    """
+    Sends chart messages to the terminal from a background thread.
+
+    PLOT DATA messages of the same indicator buffer queued for successive
+    bars are coalesced into one message, with the `fromDate` of the newest
+    value and the values newest first, as the terminal expects several
+    values. Other messages are sent in the order they were queued.
+
+    The queue is sent when it holds `maxvalues` values or `interval`
+    seconds after its first message was queued.
+
+    Params:
+
+      - `send`: callable sending a message dictionary on the chart socket
+      - `interval` (default: `0.1`): seconds a message may wait in the queue
+      - `maxvalues` (default: `5000`): queued values that trigger a send
+    """
+
+    def __init__(self, send, interval=0.1, maxvalues=5000):
+        self._send = send
+        self.interval = interval
+        self.maxvalues = maxvalues
+
+        self.messages = 0  # messages sent
+        self.errors = 0  # messages that could not be sent
+
+        self._cond = threading.Condition()
+        self._queue = list()  # [message, values oldest first or None]
+        self._buffers = dict()  # (chart, indicator, buffer) -> (queue entry, bar of the newest value)
+        self._values = 0
+        self._first = None  # time the first queued message was queued
+        self._flushing = False
+        self._sending = False
+        self._thread = None
+
+    def put(self, message, seq=None):
+        """Queues a message.
+
+        `seq` is the number of the bar of the newest value of a PLOT DATA
+        message. A message is coalesced with the queued message of the same
+        buffer if its values directly follow the values of the queued one
+        """
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._t_flush, daemon=True)
+                self._thread.start()
+
+            data = message["data"]
+            if message["actionType"] != "DATA" or seq is None:
+                self._queue.append([message, None])
+            else:
+                key = (message["chartId"], message["chartIndicatorId"], message["indicatorBufferId"])
+                queued = self._buffers.get(key)
+                if queued is not None and seq - len(data) == queued[1]:
+                    entry = queued[0]
+                    entry[0]["fromDate"] = message["fromDate"]
+                else:
+                    entry = [message, list()]
+                    self._queue.append(entry)
+                entry[1].extend(reversed(data))
+                self._buffers[key] = (entry, seq)
+
+            self._values += len(data) if data else 1
+            if self._first is None:
+                self._first = time.monotonic()
+                self._cond.notify()
+            if self._values >= self.maxvalues:
+                self._cond.notify()
+
+    def flush(self):
+        """Sends the queued messages and waits until they are sent"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._flushing = True
+            self._cond.notify()
+            while self._queue or self._sending:
+                self._cond.wait()
+            self._flushing = False
+
+    def _due(self):
+        if not self._queue:
+            return False
+        if self._flushing or self._values >= self.maxvalues:
+            return True
+        return time.monotonic() - self._first >= self.interval
+
+    def _t_flush(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None
+                    if self._queue:
+                        timeout = max(0.0, self.interval - (time.monotonic() - self._first))
+                    self._cond.wait(timeout)
+
+                batch, self._queue = self._queue, list()
+                self._buffers.clear()
+                self._values = 0
+                self._first = None
+                self._sending = True
+
+            for message, values in batch:
+                if values is not None:
+                    message = dict(message, data=values[::-1])
+                try:
+                    self._send(message)
+                    self.messages += 1
+                except Exception:
+                    self.errors += 1
+
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
@@ -0,0 +1,126 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import struct
+import threading
+import time
+
+from backtradermql5.codec import getcodec
+
+# Channels of the records
+LIVE = 1  # raw message of the LIVE socket
+EVENTS = 2  # raw message of the EVENTS socket
+REPLY = 3  # {"request": ..., "reply": ...} of a request to the terminal
+
+CHANNELS = {LIVE: "live", EVENTS: "events", REPLY: "reply"}
+
+# Request actions whose replies are recorded by default
+RECORDED_ACTIONS = ("CONFIG", "HISTORY", "TRADE", "BALANCE")
+
+MAGIC = b"BTMT5REC"
+VERSION = 1
+
+# File header: magic, format version, codec name
+_HEADER = struct.Struct("<8sB16s")
+# Record header: unix time, channel, payload length
+_RECORD = struct.Struct("<dBI")
+
+Record = collections.namedtuple("Record", "time channel payload")
+
+
+def _read_header(f, path):
+    data = f.read(_HEADER.size)
+    if len(data) < _HEADER.size:
+        raise ValueError("{} is not a session recording: file too short".format(path))
+    magic, version, codec = _HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("{} is not a session recording".format(path))
+    if version != VERSION:
+        raise ValueError("{} has recording format {}, expected {}".format(path, version, VERSION))
+    return codec.rstrip(b"\0").decode("ascii")
+
+
+def recording_codec(path):
+    """Name of the wire codec of a recording"""
+    with open(path, "rb") as f:
+        return _read_header(f, path)
+
+
+def read_records(path):
+    """Yields the `Record` of a recording in the order they were written. A
+    record cut short by a crash ends the recording"""
+    with open(path, "rb") as f:
+        _read_header(f, path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t, channel, size = _RECORD.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            yield Record(t, channel, payload)
+
+
+class Recorder:
+    """
+    Append-only binary log of the traffic of a store session.
+
+    Messages of the LIVE and EVENTS sockets are written as received, before
+    they are decoded, and replies to requests with an action in `actions`
+    together with their request. Every record starts with the unix time it
+    was written, its channel and its length. Writing a session to an
+    existing file appends it, as long as the codec is the same.
+
+    Records can be written from any thread. See `read_records` and
+    `backtradermql5.replay.MTraderReplayServer`
+
+    Params:
+
+      - `path`: file of the recording
+      - `codec` (default: `json`): wire format of the recorded messages
+      - `actions` (default: `RECORDED_ACTIONS`): request actions whose
+        replies are recorded
+    """
+
+    def __init__(self, path, codec="json", actions=RECORDED_ACTIONS):
+        self.path = path
+        self.codec = getcodec(codec)
+        self.actions = frozenset(actions)
+        self.records = 0  # records written by this recorder
+
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(MAGIC, VERSION, self.codec.name.encode("ascii")))
+        else:
+            codec = recording_codec(path)
+            if codec != self.codec.name:
+                self._file.close()
+                raise ValueError("{} was recorded with codec {}, not {}".format(path, codec, self.codec.name))
+
+    def write(self, channel, payload, t=None):
+        header = _RECORD.pack(time.time() if t is None else t, channel, len(payload))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header)
+            self._file.write(payload)
+            self.records += 1
+
+    def reply(self, request, reply):
+        """Records the reply to a request if its action is recorded"""
+        if request.get("action") in self.actions:
+            self.write(REPLY, self.codec.dumps({"request": request, "reply": reply}))
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """Flushes and closes the file. Later records are dropped"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
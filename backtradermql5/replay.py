@@ -0,0 +1,186 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import collections
+import threading
+import time
+
+import zmq
+
+from backtradermql5.mockserver import MTraderMockServer
+from backtradermql5.recorder import EVENTS, LIVE, REPLY, Record, read_records, recording_codec
+
+
+class MTraderReplayServer(MTraderMockServer):
+    """
+    Plays a session recorded with the `recordfile` store param back to a
+    store, in place of the terminal.
+
+    The recorded LIVE and EVENTS messages are pushed in the order they were
+    received, so they go through the same live data routing, `MTraderData`
+    `_load` and `MTraderStore._transaction` code as in the session:
+
+      - HISTORY requests are answered with the recorded bars or ticks of the
+        symbol and timeframe within the requested dates
+      - TRADE requests get the recorded replies of the same symbol and
+        action type in order, so the recorded transactions find the orders
+        by their MT5 order ids
+      - BALANCE requests get the last balance and equity replayed
+
+    The playback waits at every recorded CONFIG, HISTORY and TRADE request
+    until the client sent as many requests of that action, at most
+    `gatetimeout` seconds, so prices do not reach a data feed before it
+    subscribed and downloaded its history and transactions do not arrive
+    before their order. Other requests are answered like `MTraderMockServer`
+    does.
+
+    Params:
+
+      - `path`: file of the recording
+      - `speed` (default: `1.0`): `1.0` plays at the pace of the recording,
+        `2.0` twice as fast, `0` or `None` as fast as possible
+      - `gatetimeout` (default: `5.0`): seconds to wait for the client at a
+        recorded request before going on
+      - other keyword arguments are the params of `MTraderMockServer`.
+        `codec` defaults to the codec of the recording and `fill` to `False`,
+        the recorded transactions carry the deals
+    """
+
+    # Recorded requests the playback waits for
+    _GATES = ("CONFIG", "HISTORY", "TRADE")
+
+    def __init__(self, path, speed=1.0, gatetimeout=5.0, **kwargs):
+        kwargs.setdefault("codec", recording_codec(path))
+        kwargs.setdefault("fill", False)
+        history = kwargs.pop("history", None)
+        super(MTraderReplayServer, self).__init__(**kwargs)
+
+        self.path = path
+        self.speed = speed or None
+        self.gatetimeout = gatetimeout
+        self.history = history or self.recorded_history
+
+        self.played = 0  # LIVE and EVENTS messages pushed
+        self.gatetimeouts = 0  # recorded requests the client did not send in time
+        self.done = threading.Event()  # set at the end of the recording
+
+        self._replay = None
+        self._load(path)
+
+    def _load(self, path):
+        self._stream = list()  # Record of LIVE and EVENTS messages and replies, payload (action, count, reply)
+        self._trades = collections.defaultdict(collections.deque)  # (symbol, action type) -> replies
+        history = collections.defaultdict(dict)  # (symbol, timeframe) -> {time: row}
+        counts = collections.Counter()
+
+        for record in read_records(path):
+            if record.channel != REPLY:
+                self._stream.append(record)
+                continue
+
+            msg = self.codec.loads(record.payload)
+            request, reply = msg["request"], msg["reply"]
+            action = request.get("action")
+            counts[action] += 1
+            if action == "HISTORY" and request.get("actionType") == "DATA":
+                rows = history[(request["symbol"], request["chartTF"])]
+                for row in reply.get("data") or ():
+                    rows[row[0]] = row
+            elif action == "TRADE":
+                self._trades[(request.get("symbol"), request.get("actionType"))].append(reply)
+            self._stream.append(Record(record.time, REPLY, (action, counts[action], reply)))
+
+        self._history = dict()  # (symbol, timeframe) -> (sorted times, rows)
+        for key, rows in history.items():
+            times = sorted(rows)
+            self._history[key] = (times, [rows[t] for t in times])
+
+    def recorded_history(self, symbol, timeframe, begin, end):
+        """Recorded rows of a symbol and timeframe between two unix timestamps"""
+        times, rows = self._history.get((symbol, timeframe), ((), ()))
+        # tick times are in milliseconds
+        scale = 1000 if timeframe == "TICK" else 1
+        lo = bisect.bisect_left(times, begin * scale) if begin else 0
+        hi = bisect.bisect_right(times, end * scale) if end else len(times)
+        return rows[lo:hi]
+
+    def start(self):
+        super(MTraderReplayServer, self).start()
+        self.done.clear()
+        self._replay = threading.Thread(target=self._t_replay, daemon=True)
+        self._replay.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._replay is not None:
+            self._replay.join()
+            self._replay = None
+        super(MTraderReplayServer, self).stop()
+
+    def wait(self, timeout=None):
+        """Waits for the end of the recording. Returns `False` on timeout"""
+        return self.done.wait(timeout)
+
+    def _on_trade(self, request):
+        replies = self._trades.get((request.get("symbol"), request.get("actionType")))
+        if not replies:
+            super(MTraderReplayServer, self)._on_trade(request)
+            return
+        self._reply(replies.popleft())
+
+    def _gate(self, action, count):
+        """Waits until the client sent `count` requests of `action`. Returns `True` if it waited"""
+        if self.requests[action] >= count:
+            return False
+        deadline = time.monotonic() + self.gatetimeout
+        while self.requests[action] < count:
+            if time.monotonic() >= deadline:
+                self.gatetimeouts += 1
+                break
+            if self._stop_event.wait(0.001):
+                break
+        return True
+
+    def _send(self, socket, lock, payload):
+        # PUSH sockets block while no client is connected
+        while not self._stop_event.is_set():
+            try:
+                with lock:
+                    socket.send(payload, zmq.NOBLOCK)
+                self.played += 1
+                return
+            except zmq.Again:
+                self._stop_event.wait(0.001)
+
+    def _t_replay(self):
+        sockets = {
+            LIVE: (self.live_socket, self._live_lock),
+            EVENTS: (self.events_socket, self._events_lock),
+        }
+        start = first = None  # monotonic and recorded time the pace is measured from
+
+        for record in self._stream:
+            if self._stop_event.is_set():
+                return
+
+            if start is None:
+                start, first = time.monotonic(), record.time
+            elif self.speed:
+                delay = start + (record.time - first) / self.speed - time.monotonic()
+                if delay > 0 and self._stop_event.wait(delay):
+                    return
+
+            if record.channel == REPLY:
+                action, count, reply = record.payload
+                if action == "BALANCE" and "balance" in reply:
+                    self.balance, self.equity = reply["balance"], reply["equity"]
+                elif action in self._GATES and self._gate(action, count):
+                    # keep the pace of the recording from here
+                    start, first = time.monotonic(), record.time
+                continue
+
+            socket, lock = sockets[record.channel]
+            self._send(socket, lock, record.payload)
+
+        self.done.set()
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from backtradermql5.mt5store import MTraderStore
+
+
+class MTraderRouter:
+    """
+    Spreads the symbols of one Cerebro over the stores of several MT5
+    terminals.
+
+    Every symbol is served by one store: the one given in `symbols`, else
+    the stores take new symbols in turn. Data feeds subscribe and download
+    their history from the terminal of their symbol, and `getbroker`
+    returns a single broker trading on all terminals.
+
+    Params:
+
+      - `stores`: `MTraderStore` instances, e.g. one per terminal with its
+        own `host` or `ports`
+      - `symbols` (default: `None`): `{symbol: store}` of symbols with a
+        fixed terminal. A store can be given by its index in `stores`
+
+    Usage:
+
+        router = MTraderRouter([MTraderStore(ports=15555), MTraderStore(ports=15565)])
+        broker = router.getbroker(use_positions=True)
+        for symbol in ("EURUSD", "GBPUSD", "USDJPY"):
+            cerebro.adddata(router.getdata(dataname=symbol, timeframe=bt.TimeFrame.Minutes))
+    """
+
+    def __init__(self, stores, symbols=None):
+        self.stores = list(stores)
+        if not self.stores:
+            raise ValueError("MTraderRouter needs at least one store")
+
+        self._symbols = dict()  # symbol -> store
+        for symbol, store in (symbols or {}).items():
+            self._symbols[symbol] = self.stores[store] if isinstance(store, int) else store
+        self._next = 0  # store taking the next new symbol
+        self._lock = threading.Lock()
+
+    def store(self, symbol):
+        """Store serving a symbol. A new symbol is assigned to the next store in turn"""
+        store = self._symbols.get(symbol)
+        if store is not None:
+            return store
+
+        with self._lock:
+            store = self._symbols.get(symbol)
+            if store is None:
+                store = self._symbols[symbol] = self.stores[self._next % len(self.stores)]
+                self._next += 1
+            return store
+
+    def symbols(self, store):
+        """Symbols assigned to a store so far"""
+        return [symbol for symbol, s in self._symbols.items() if s is store]
+
+    def getdata(self, *args, **kwargs):
+        """Returns a data feed of the store of `dataname`"""
+        return self.store(kwargs["dataname"]).getdata(*args, **kwargs)
+
+    def getbroker(self, *args, **kwargs):
+        """Returns a broker routing the orders of each data feed to its store"""
+        return MTraderStore.BrokerCls(*args, router=self, **kwargs)
@@ -0,0 +1,232 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+import itertools
+import threading
+
+
+class _Trail:
+    __slots__ = ("key", "isbuy", "side", "amount", "percent", "group", "active")
+
+    def __init__(self, key, isbuy, side, amount, percent):
+        self.key = key
+        self.isbuy = isbuy
+        self.side = side
+        self.amount = amount
+        self.percent = percent
+        self.group = None
+        self.active = True
+
+
+class _Group:
+    """Trails whose best price since they were added is the same `peak`"""
+
+    __slots__ = ("peak", "amounts", "percents", "version", "dead")
+
+    def __init__(self, peak):
+        self.peak = peak
+        self.amounts = list()  # heap of (amount, seq, trail)
+        self.percents = list()  # heap of (percent, seq, trail)
+        self.version = 0
+        self.dead = False
+
+    def __len__(self):
+        return len(self.amounts) + len(self.percents)
+
+    def push(self, entry, percent):
+        heapq.heappush(self.percents if percent else self.amounts, entry)
+        entry[2].group = self
+
+    def best(self):
+        """Highest stop of the active trails of the group and the heap holding its trail"""
+        for heap in (self.amounts, self.percents):
+            while heap and not heap[0][2].active:
+                heapq.heappop(heap)
+
+        level = heap = None
+        if self.amounts:
+            level, heap = self.peak - self.amounts[0][0], self.amounts
+        if self.percents:
+            plevel = self.peak - self.percents[0][0] * abs(self.peak)
+            if level is None or plevel > level:
+                level, heap = plevel, self.percents
+        return level, heap
+
+
+class _Side:
+    """
+    Trailing stops of one side of a symbol, in a price space where stops
+    are below the price: bid prices for sell stops, negated ask prices for
+    buy stops.
+
+    The peak of a trail is the best price since it was added, so trails
+    added earlier have a higher or equal peak. The groups of trails with the
+    same peak form a stack with falling peaks. A new high only merges the
+    groups at the top of the stack, and a max-heap of the highest stop of
+    each group finds the triggered trails.
+    """
+
+    def __init__(self):
+        self.groups = list()  # stack of _Group, peaks falling
+        self.levels = list()  # heap of (-stop, seq, version, group)
+        self._seq = itertools.count()
+
+    def add(self, trail, price):
+        group = _Group(price)
+        group.push((trail.percent if trail.amount is None else trail.amount, next(self._seq), trail), trail.amount is None)
+        self._stack(group)
+
+    def _stack(self, group):
+        # groups whose peak the new group reaches become part of it
+        while self.groups and self.groups[-1].peak <= group.peak:
+            other = self.groups.pop()
+            if len(other) > len(group):
+                other.peak, group = group.peak, self._merge(other, group)
+            else:
+                group = self._merge(group, other)
+        self.groups.append(group)
+        self._level(group)
+
+    def _merge(self, group, other):
+        other.dead = True
+        for entry in other.amounts:
+            if entry[2].active:
+                group.push(entry, False)
+        for entry in other.percents:
+            if entry[2].active:
+                group.push(entry, True)
+        return group
+
+    def _level(self, group):
+        group.version += 1
+        level, _ = group.best()
+        if level is not None:
+            heapq.heappush(self.levels, (-level, next(self._seq), group.version, group))
+        if len(self.levels) > 2 * len(self.groups) + 64:
+            self._compact()
+
+    def _compact(self):
+        # drop outdated stops and groups without active trails
+        self.levels = list()
+        groups, self.groups = self.groups, list()
+        for group in groups:
+            level, _ = group.best()
+            if level is None:
+                group.dead = True
+                continue
+            self.groups.append(group)
+            group.version += 1
+            self.levels.append((-level, next(self._seq), group.version, group))
+        heapq.heapify(self.levels)
+
+    def update(self, price):
+        """Moves the stops with a new price. Returns the triggered trails"""
+        if self.groups and self.groups[-1].peak < price:
+            group = self.groups.pop()
+            group.peak = price
+            self._stack(group)
+
+        triggered = list()
+        while self.levels and -self.levels[0][0] >= price:
+            _, _, version, group = heapq.heappop(self.levels)
+            if group.dead or version != group.version:
+                continue
+            level, heap = group.best()
+            while level is not None and level >= price:
+                trail = heapq.heappop(heap)[2]
+                trail.active = False
+                triggered.append(trail)
+                level, heap = group.best()
+            self._level(group)
+        return triggered
+
+    def stop(self, trail):
+        if trail.amount is not None:
+            return trail.group.peak - trail.amount
+        return trail.group.peak - trail.percent * abs(trail.group.peak)
+
+
+class TrailingStops:
+    """
+    Client side trailing stops of many orders, by symbol.
+
+    The stop of a sell trail follows the highest bid since it was added at
+    a distance of `amount` or `percent` and is triggered when the bid
+    falls to it. Buy trails follow the lowest ask from above. Adding,
+    removing and each price update take logarithmic time in the number of
+    trails of the symbol (amortized).
+    """
+
+    def __init__(self):
+        self._sides = dict()  # (symbol, isbuy) -> _Side
+        self._trails = dict()  # key -> (symbol, _Trail)
+        self._waiting = dict()  # symbol -> trails added before the first price
+        self._prices = dict()  # symbol -> last (bid, ask)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._trails)
+
+    def __contains__(self, key):
+        return key in self._trails
+
+    def add(self, key, symbol, isbuy, amount=None, percent=None, price=None):
+        """Adds a trail. `price` is the price the stop trails from, the
+        current price of the symbol if `None`"""
+        if (amount is None) == (percent is None):
+            raise ValueError("A trailing stop needs either a trail amount or a trail percent")
+
+        with self._lock:
+            side = self._sides.setdefault((symbol, isbuy), _Side())
+            trail = _Trail(key, isbuy, side, amount, percent)
+            self._trails[key] = (symbol, trail)
+            if price is None:
+                price = self._prices.get(symbol, (None, None))[isbuy]
+            if price is None:
+                self._waiting.setdefault(symbol, list()).append(trail)
+            else:
+                side.add(trail, -price if isbuy else price)
+
+    def remove(self, key):
+        """Removes a trail. Returns `False` if it was not there"""
+        with self._lock:
+            entry = self._trails.pop(key, None)
+            if entry is None:
+                return False
+            entry[1].active = False
+            return True
+
+    def update(self, symbol, bid, ask):
+        """Moves the stops of a symbol with new prices. Returns the keys of the triggered trails"""
+        with self._lock:
+            self._prices[symbol] = (bid, ask)
+            triggered = list()
+            for isbuy, price in ((False, bid), (True, ask)):
+                side = self._sides.get((symbol, isbuy))
+                if side is None or price is None:
+                    continue
+                triggered.extend(side.update(-price if isbuy else price))
+
+            # trails added before the first price start from this one
+            for trail in self._waiting.pop(symbol, ()):
+                price = ask if trail.isbuy else bid
+                if not trail.active:
+                    continue
+                if price is None:
+                    self._waiting.setdefault(symbol, list()).append(trail)
+                else:
+                    trail.side.add(trail, -price if trail.isbuy else price)
+
+            for trail in triggered:
+                self._trails.pop(trail.key, None)
+            return [trail.key for trail in triggered]
+
+    def stop(self, key):
+        """Current stop price of a trail or `None`"""
+        with self._lock:
+            entry = self._trails.get(key)
+            if entry is None or entry[1].group is None:
+                return None
+            trail = entry[1]
+            stop = trail.side.stop(trail)
+            return -stop if trail.isbuy else stop
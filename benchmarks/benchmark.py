@@ -0,0 +1,525 @@
+"""
+End-to-end benchmarks of backtradermql5 against the local mock server.
+
+Every scenario runs in a fresh process: `MTraderStore` is a singleton and
+its socket threads live for the lifetime of the process.
+
+    python benchmarks/benchmark.py
+    python benchmarks/benchmark.py --bars 200000 --ticks 50000 --orders 500
+    python benchmarks/benchmark.py --only history
+    python benchmarks/benchmark.py --codec orjson
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import contextlib
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import backtrader as bt
+from backtrader.utils.py3 import queue
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+class CountStrategy(bt.Strategy):
+    params = (("target", None), ("done", None))
+
+    def __init__(self):
+        self.count = 0
+        self.live = False
+        self.t_end = None
+
+    def next(self):
+        if self.p.target is None:
+            self.count += 1
+            return
+
+        if not self.live:
+            if self.data._state == self.data._ST_LIVE:
+                self.live = True
+                self.p.done.set()  # signal the publisher that live ticks are consumed
+            return
+
+        self.count += 1
+        if self.count >= self.p.target:
+            self.t_end = time.perf_counter()
+            self.env.runstop()
+
+
+def bench_history(args):
+    """History bars/sec through `price_data` and `MTraderData._load`"""
+    from backtradermql5.cache import HistoryCache
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5store import MTraderStore
+
+    with MTraderMockServer(codec=args.codec):
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        fromdate = datetime.utcnow() - timedelta(minutes=args.bars)
+
+        t0 = time.perf_counter()
+        q = store.price_data("EURUSD", fromdate, None, bt.TimeFrame.Minutes, 1)
+        q.get()
+        t_first = time.perf_counter() - t0
+        fetched = 1
+        while q.get() != {}:
+            fetched += 1
+        t_fetch = time.perf_counter() - t0
+
+        rates = dict()
+        for preload in (False, True):
+            cerebro = bt.Cerebro(stdstats=False, preload=preload, runonce=preload)
+            cerebro.addstrategy(CountStrategy)
+            data = store.getdata(
+                dataname="EURUSD",
+                timeframe=bt.TimeFrame.Minutes,
+                compression=1,
+                fromdate=fromdate,
+                historical=True,
+            )
+            cerebro.adddata(data)
+
+            t0 = time.perf_counter()
+            strat = cerebro.run()[0]
+            rates[preload] = strat.count / (time.perf_counter() - t0)
+
+        cachedir = tempfile.mkdtemp()
+        store._historycache = HistoryCache(cachedir)
+        for warm in (False, True):
+            t0 = time.perf_counter()
+            store.price_data_array("EURUSD", fromdate, None, bt.TimeFrame.Minutes, 1)
+            rates[warm, "cache"] = fetched / (time.perf_counter() - t0)
+        shutil.rmtree(cachedir)
+
+    return [
+        ("history: price_data", fetched / t_fetch, "bars/s"),
+        ("history: first bar", t_first * 1000.0, "ms"),
+        ("history: cold cache", rates[False, "cache"], "bars/s"),
+        ("history: warm cache", rates[True, "cache"], "bars/s"),
+        ("history: bar by bar -> next", rates[False], "bars/s"),
+        ("history: bulk preload -> next", rates[True], "bars/s"),
+    ]
+
+
+def bench_indicators(args):
+    """Bars/sec of a strategy using an MT5 indicator, one request per bar, in bulk and from the indicator cache"""
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5indicator import getMTraderIndicator
+    from backtradermql5.mt5store import MTraderStore
+
+    class IndicatorStrategy(CountStrategy):
+        params = (("store", None), ("bulk", True))
+
+        def __init__(self):
+            super(IndicatorStrategy, self).__init__()
+            self.macd = getMTraderIndicator(
+                self.p.store,
+                self.datas[0],
+                ("macd", "signal"),
+                indicator="Examples/MACD",
+                params=[12, 26, 9, "PRICE_CLOSE"],
+                bulk=self.p.bulk,
+            )()
+
+    rows = list()
+    with MTraderMockServer(codec=args.codec):
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        fromdate = datetime.utcnow() - timedelta(minutes=args.bars // 10)
+
+        configs = (
+            ("per bar", False, False, False),
+            ("bulk next", True, False, False),
+            ("bulk once", True, True, False),
+            ("cached once", True, True, True),
+        )
+        for label, bulk, preload, cached in configs:
+            if not cached:
+                store.indicatorcache.clear()
+            cerebro = bt.Cerebro(stdstats=False, preload=preload, runonce=preload)
+            cerebro.addstrategy(IndicatorStrategy, store=store, bulk=bulk)
+            data = store.getdata(
+                dataname="EURUSD",
+                timeframe=bt.TimeFrame.Minutes,
+                compression=1,
+                fromdate=fromdate,
+                historical=True,
+            )
+            cerebro.adddata(data)
+
+            t0 = time.perf_counter()
+            strat = cerebro.run()[0]
+            rows.append(("indicator: " + label, strat.count / (time.perf_counter() - t0), "bars/s"))
+
+    return rows
+
+
+def bench_charts(args):
+    """Bars/sec of a strategy plotting 10 lines to an MT5 chart, and chart messages sent per bar"""
+    import backtrader.indicators as btind
+
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5chart import ChartIndicator, MTraderChart
+    from backtradermql5.mt5store import MTraderStore
+
+    class ChartStrategy(CountStrategy):
+        def __init__(self):
+            super(ChartStrategy, self).__init__()
+            smas = [btind.SMA(self.data, period=5 + i) for i in range(10)]
+            chart = MTraderChart(self.data, realtime=True)
+            indicator = ChartIndicator(idx=0, shortname="SMA")
+            for sma in smas:
+                indicator.addline(sma.sma, style={"linelabel": "SMA"})
+            chart.addchartindicator(indicator)
+
+    with MTraderMockServer(codec=args.codec) as server:
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        cerebro = bt.Cerebro(stdstats=False, preload=False, runonce=False)
+        cerebro.addstrategy(ChartStrategy)
+        data = store.getdata(
+            dataname="EURUSD",
+            timeframe=bt.TimeFrame.Minutes,
+            compression=1,
+            fromdate=datetime.utcnow() - timedelta(minutes=args.bars // 10),
+            historical=True,
+        )
+        cerebro.adddata(data)
+
+        t0 = time.perf_counter()
+        strat = cerebro.run()[0]
+        rate = strat.count / (time.perf_counter() - t0)
+        time.sleep(0.5)  # let the mock server receive the last messages
+        messages = server.chart_messages
+
+    return [
+        ("charts: 10 lines -> next", rate, "bars/s"),
+        ("charts: messages", messages / float(strat.count), "msgs/bar"),
+    ]
+
+
+def bench_live(args):
+    """Live ticks/sec from the live data thread to strategy `next`, spread over `--feeds` symbols"""
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5store import MTraderStore
+
+    symbols = ["EURUSD"] + ["SYM{:03d}".format(i) for i in range(1, args.feeds)]
+
+    with MTraderMockServer(codec=args.codec) as server:
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        live = threading.Event()
+        started = dict()
+
+        def publisher():
+            live.wait()
+            base = int(time.time() * 1000) + 1000
+            started["t"] = time.perf_counter()
+            for i in range(args.ticks + len(symbols)):
+                server.publish_live(symbols[i % len(symbols)], "TICK", [base + i, 1.1, 1.1001])
+
+        t = threading.Thread(target=publisher, daemon=True)
+        t.start()
+
+        cerebro = bt.Cerebro(stdstats=False)
+        cerebro.addstrategy(CountStrategy, target=args.ticks, done=live)
+        cerebro.setbroker(store.getbroker(use_positions=False))
+        for symbol in symbols:
+            data = store.getdata(
+                dataname=symbol,
+                timeframe=bt.TimeFrame.Ticks,
+                fromdate=datetime.utcnow() - timedelta(seconds=10),
+            )
+            cerebro.adddata(data)
+
+        # a first live tick switches the feeds (and the strategy) to live
+        def kickstart():
+            while not live.is_set():
+                for symbol in symbols:
+                    server.publish_live(symbol, "TICK", [int(time.time() * 1000), 1.1, 1.1001])
+                time.sleep(0.05)
+
+        k = threading.Thread(target=kickstart, daemon=True)
+        k.start()
+
+        strat = cerebro.run()[0]
+
+    return [("live: ticks -> next ({} feeds)".format(len(symbols)), strat.count / (strat.t_end - started["t"]), "ticks/s")]
+
+
+def bench_tickbars(args):
+    """Live ticks/sec aggregated into 1 second bars by a `tickbars` feed, until the last bar reaches `next`"""
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5store import MTraderStore
+
+    class VolumeStrategy(bt.Strategy):
+        params = (("target", None), ("done", None))
+
+        def __init__(self):
+            self.ticks = 0
+            self.t_end = None
+
+        def next(self):
+            if self.data._state != self.data._ST_LIVE:
+                return
+            self.p.done.set()
+            if self.t_end is None:
+                self.ticks += int(self.data.volume[0])
+                if self.ticks >= self.p.target:
+                    self.t_end = time.perf_counter()
+                    self.env.runstop()
+
+    with MTraderMockServer(codec=args.codec) as server:
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        live = threading.Event()
+        started = dict()
+
+        def publisher():
+            # a first bar switches the feed to live
+            while not live.is_set():
+                server.publish_live("EURUSD", "TICK", [int(time.time() * 1000), 1.1, 1.1001])
+                time.sleep(0.05)
+            time.sleep(1.0)
+            base = int(time.time()) * 1000 + 1000
+            started["t"] = time.perf_counter()
+            # one tick per millisecond of server time, the last bar closes on time
+            for i in range(args.ticks):
+                server.publish_live("EURUSD", "TICK", [base + i, 1.1 + (i % 100) * 0.00001, 1.1001])
+
+        t = threading.Thread(target=publisher, daemon=True)
+        t.start()
+
+        cerebro = bt.Cerebro(stdstats=False)
+        cerebro.addstrategy(VolumeStrategy, target=args.ticks, done=live)
+        cerebro.setbroker(store.getbroker(use_positions=False))
+        data = store.getdata(
+            dataname="EURUSD",
+            timeframe=bt.TimeFrame.Seconds,
+            compression=1,
+            tickbars=True,
+            fromdate=datetime.utcnow() - timedelta(seconds=10),
+        )
+        cerebro.adddata(data)
+        strat = cerebro.run()[0]
+
+    return [("live: ticks -> 1s tick bars", strat.ticks / (strat.t_end - started["t"]), "ticks/s")]
+
+
+def bench_orders(args):
+    """Order round trip latency through `order_create` and the order threads"""
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5store import MTraderStore
+
+    latencies = list()
+    bursts = dict()  # time until 40 orders queued at once are filled, by mode
+
+    class OrderStrategy(bt.Strategy):
+        def next(self):
+            if latencies:
+                return
+
+            broker = self.broker
+            filled = threading.Event()
+            fills = threading.Semaphore(0)
+            fill = broker._fill
+
+            def _fill(oref, *a, **kw):
+                fill(oref, *a, **kw)
+                filled.set()
+                fills.release()
+
+            broker._fill = _fill
+
+            for i in range(args.orders):
+                filled.clear()
+                t0 = time.perf_counter()
+                self.buy(size=0.01) if i % 2 == 0 else self.sell(size=0.01)
+                if not filled.wait(10):
+                    raise RuntimeError("Order {} was not filled".format(i))
+                latencies.append(time.perf_counter() - t0)
+            while fills.acquire(blocking=False):
+                pass
+
+            for mode in ("one by one", "basket"):
+                t0 = time.perf_counter()
+                with broker.basket() if mode == "basket" else contextlib.suppress():
+                    for i in range(40):
+                        self.buy(size=0.01)
+                for i in range(40):
+                    if not fills.acquire(timeout=10):
+                        raise RuntimeError("Order {} was not filled".format(i))
+                bursts[mode] = time.perf_counter() - t0
+
+            self.env.runstop()
+
+    with MTraderMockServer(codec=args.codec) as server:
+        store = MTraderStore(host="127.0.0.1", datatimeout=60, codec=args.codec)
+        stop = threading.Event()
+
+        def ticker():
+            while not stop.is_set():
+                server.publish_live("EURUSD", "TICK", [int(time.time() * 1000), 1.1, 1.1001])
+                time.sleep(0.01)
+
+        t = threading.Thread(target=ticker, daemon=True)
+        t.start()
+
+        cerebro = bt.Cerebro(stdstats=False)
+        cerebro.addstrategy(OrderStrategy)
+        cerebro.setbroker(store.getbroker(use_positions=False))
+        data = store.getdata(
+            dataname="EURUSD",
+            timeframe=bt.TimeFrame.Ticks,
+            fromdate=datetime.utcnow() - timedelta(seconds=10),
+        )
+        cerebro.adddata(data)
+        cerebro.run()
+        stop.set()
+        t.join()
+
+    ms = [x * 1000.0 for x in latencies]
+    return [
+        ("orders: round trip p50", percentile(ms, 50), "ms"),
+        ("orders: round trip p99", percentile(ms, 99), "ms"),
+        ("orders: throughput", len(ms) / (sum(ms) / 1000.0), "orders/s"),
+        ("orders: 40 orders one by one", bursts["one by one"] * 1000.0, "ms"),
+        ("orders: basket of 40 orders", bursts["basket"] * 1000.0, "ms"),
+    ] + [
+        ("orders: {} p{}".format(stage, p), stats[p], "ms")
+        for stage, stats in store.get_latency_stats((50, 99)).items()
+        for p in (50, 99)
+        if stats[p] is not None
+    ]
+
+
+def bench_warmup(args):
+    """History warm up of `--symbols` symbols, one request at a time and pipelined with `AsyncMTraderAPI`"""
+    import asyncio
+
+    from backtradermql5.asyncapi import AsyncMTraderAPI
+    from backtradermql5.mockserver import MTraderMockServer
+    from backtradermql5.mt5store import MTraderAPI
+
+    symbols = ["SYM{:03d}".format(i) for i in range(args.symbols)]
+    begin = int(time.time()) - 500 * 60
+
+    with MTraderMockServer(codec=args.codec):
+        api = MTraderAPI(host="127.0.0.1", debug=False, datatimeout=60, codec=args.codec)
+        t0 = time.perf_counter()
+        for symbol in symbols:
+            api.construct_and_send(action="HISTORY", actionType="DATA", symbol=symbol, chartTF="M1", fromDate=begin)
+        t_sync = time.perf_counter() - t0
+        api.close()  # replies are pushed round robin to connected clients
+
+        async def warmup():
+            async with AsyncMTraderAPI(host="127.0.0.1", datatimeout=60, codec=args.codec) as aapi:
+                t0 = time.perf_counter()
+                await asyncio.gather(*[aapi.history(symbol, "M1", begin) for symbol in symbols])
+                return time.perf_counter() - t0
+
+        t_async = asyncio.run(warmup())
+
+    return [
+        ("warmup: sequential", len(symbols) / t_sync, "symbols/s"),
+        ("warmup: pipelined async", len(symbols) / t_async, "symbols/s"),
+    ]
+
+
+def bench_codecs(args):
+    """Encode/decode throughput of the wire codecs for typical payloads"""
+    from backtradermql5.codec import CODECS, getcodec
+
+    payloads = {
+        "tick": {"status": "CONNECTED", "symbol": "EURUSD", "timeframe": "TICK", "data": [1588888888123, 1.1, 1.1001]},
+        "history": {
+            "error": False,
+            "symbol": "EURUSD",
+            "timeframe": "M1",
+            "data": [[1588888860 + 60 * i, 1.1, 1.1002, 1.0998, 1.1001, 120, 12] for i in range(10000)],
+        },
+        "transaction": {
+            "request": {
+                "action": "TRADE_ACTION_DEAL",
+                "order": 1000,
+                "symbol": "EURUSD",
+                "type": "ORDER_TYPE_BUY",
+                "volume": 0.01,
+                "price": 1.1,
+            },
+            "reply": {"result": "TRADE_RETCODE_DONE", "order": 1000, "volume": 0.01, "price": 1.1},
+        },
+    }
+    loops = {"tick": 50000, "history": 20, "transaction": 50000}
+
+    rows = list()
+    for name in CODECS:
+        try:
+            codec = getcodec(name)
+        except ImportError:
+            continue
+
+        for kind, payload in payloads.items():
+            raw = codec.dumps(payload)
+            t0 = time.perf_counter()
+            for _ in range(loops[kind]):
+                codec.loads(raw)
+            rows.append(("codec {}: {} decode".format(name, kind), loops[kind] / (time.perf_counter() - t0), "msgs/s"))
+
+    return rows
+
+
+BENCHMARKS = {
+    "history": bench_history,
+    "indicators": bench_indicators,
+    "charts": bench_charts,
+    "live": bench_live,
+    "tickbars": bench_tickbars,
+    "orders": bench_orders,
+    "warmup": bench_warmup,
+    "codecs": bench_codecs,
+}
+
+
+def _run(name, args, results):
+    results.put(BENCHMARKS[name](args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backtradermql5 benchmarks against the local mock server")
+    parser.add_argument("--bars", type=int, default=50000, help="history bars to load")
+    parser.add_argument("--ticks", type=int, default=20000, help="live ticks to stream")
+    parser.add_argument("--feeds", type=int, default=1, help="live feeds sharing the store")
+    parser.add_argument("--symbols", type=int, default=30, help="symbols to warm up")
+    parser.add_argument("--orders", type=int, default=200, help="orders to round trip")
+    parser.add_argument("--codec", default="json", help="wire codec of the store and the mock server")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append", help="run only these benchmarks")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    for name in args.only or BENCHMARKS:
+        results = ctx.Queue()
+        p = ctx.Process(target=_run, args=(name, args, results))
+        p.start()
+        while True:
+            try:
+                rows = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not p.is_alive():
+                    rows = [(name + ": FAILED", float("nan"), "")]
+                    break
+        for label, value, unit in rows:
+            print("{:<32} {:>14,.2f} {}".format(label, value, unit))
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+import threading
+import time
+
+import pytest
+
+from backtradermql5.mockserver import MTraderMockServer
+from backtradermql5.mt5store import MTraderStore
+
+# Stores are singletons per host and ports: every test talks to a terminal of its own
+_ports = itertools.count(25000, 10)
+
+
+def mockserver(**kwargs):
+    """Mock terminal on ports not used by an earlier test. Its history ends now, the synthetic
+    history would otherwise run up to the `toDate` of a request"""
+    server = MTraderMockServer(ports=next(_ports), **kwargs)
+    synthetic = server.history
+
+    def history(symbol, timeframe, begin, end):
+        return synthetic(symbol, timeframe, begin, min(end, int(time.time())) if end else end)
+
+    server.history = history
+    return server
+
+
+@pytest.fixture
+def server():
+    with mockserver() as server:
+        yield server
+
+
+@pytest.fixture
+def store(server):
+    store = MTraderStore(host="127.0.0.1", ports=server.ports)
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def runlive(server):
+    """Runs a cerebro while the server publishes a M1 bar of `symbol` every
+    `interval` seconds, until `done()` or `timeout` seconds"""
+
+    def run(cerebro, symbol="EURUSD", done=lambda: False, timeout=10.0, interval=0.05):
+        stop = threading.Event()
+
+        def publish():
+            t0 = time.time()
+            start = int(t0) // 60 * 60
+            for i in itertools.count(1):
+                if stop.is_set():
+                    return
+                if done() or time.time() - t0 > timeout:
+                    cerebro.runstop()
+                bar = [start + 60 * i, 1.1, 1.1, 1.1, 1.1, 1, 1]
+                try:
+                    server.publish_live(symbol, "M1", bar)
+                except Exception:
+                    return  # the server stopped
+                time.sleep(interval)
+
+        thread = threading.Thread(target=publish, daemon=True)
+        thread.start()
+        try:
+            return cerebro.run()
+        finally:
+            stop.set()
+            thread.join()
+
+    return run
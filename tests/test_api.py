@@ -0,0 +1,80 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+import pytest
+import zmq
+
+from backtradermql5.mt5store import MTraderAPI
+
+
+@pytest.fixture
+def api(server):
+    api = MTraderAPI(host="127.0.0.1", ports=server.ports, debug=False, datatimeout=5)
+    yield api
+    api.close()
+
+
+def history(api, symbol):
+    return api.submit(api.construct_request(action="HISTORY", actionType="DATA", symbol=symbol, chartTF="H1"))
+
+
+def test_replies_match_requests_in_order(api, server):
+    server.latency = 0.005
+    futures = [history(api, "SYM{}".format(i)) for i in range(20)]
+    assert [f.result(timeout=5)["symbol"] for f in futures] == ["SYM{}".format(i) for i in range(20)]
+
+
+def test_replies_match_requests_of_many_threads(api):
+    futures = dict()
+
+    def submit(n):
+        for i in range(10):
+            symbol = "T{}S{}".format(n, i)
+            futures[symbol] = history(api, symbol)
+
+    threads = [threading.Thread(target=submit, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(futures) == 40
+    for symbol, fut in futures.items():
+        assert fut.result(timeout=5)["symbol"] == symbol
+
+
+def test_error_reply_keeps_later_replies_matched(api):
+    bad = api.submit(api.construct_request(action="NOSUCHACTION"))
+    good = history(api, "EURUSD")
+    assert bad.result(timeout=5)["error"]
+    assert good.result(timeout=5)["symbol"] == "EURUSD"
+
+
+def test_indicator_replies_are_matched_apart(api):
+    attach = api.construct_indicator_request(
+        action="INDICATOR", actionType="ATTACH", id="ind", symbol="EURUSD", chartTF="M1", linecount=1
+    )
+    ind = api.submit(attach, indicator=True)
+    data = history(api, "EURUSD")
+    assert ind.result(timeout=5) == {"error": False, "id": "ind"}
+    assert data.result(timeout=5)["symbol"] == "EURUSD"
+
+
+def test_late_reply_is_discarded(server):
+    api = MTraderAPI(host="127.0.0.1", ports=server.ports, debug=False, datatimeout=0.2)
+    try:
+
+        def late(request):
+            time.sleep(0.5)
+            server._on_history(request)
+
+        server._handlers["HISTORY"] = late
+        with pytest.raises(zmq.NotDone):
+            history(api, "EURUSD").result(timeout=5)
+        # the late reply does not answer the next request
+        server._handlers["HISTORY"] = server._on_history
+        assert history(api, "GBPUSD").result(timeout=5)["symbol"] == "GBPUSD"
+    finally:
+        api.close()
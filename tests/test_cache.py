@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime, timedelta
+
+import backtrader as bt
+import numpy as np
+import pytest
+
+from backtradermql5.cache import HistoryCache
+from backtradermql5.mt5store import MTraderStore
+
+from conftest import mockserver
+
+DAY = datetime(2026, 10, 1)
+
+
+@pytest.fixture
+def cached(server, tmp_path):
+    store = MTraderStore(host="127.0.0.1", ports=server.ports, cachedir=str(tmp_path))
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def uncached():
+    with mockserver() as server:
+        store = MTraderStore(host="127.0.0.1", ports=server.ports)
+        yield store
+        store.stop()
+
+
+def history(store, begin, end, timeframe=bt.TimeFrame.Minutes, compression=1):
+    """History of EURUSD between two hours of `DAY`"""
+    dtbegin, dtend = DAY + timedelta(hours=begin), DAY + timedelta(hours=end)
+    return store.price_data_array("EURUSD", dtbegin, dtend, timeframe, compression)
+
+
+def test_cache_downloads_only_the_gaps(cached, uncached, server, tmp_path):
+    first = history(cached, 10, 20)
+    assert server.requests["HISTORY"] == 1
+    np.testing.assert_array_equal(first, history(uncached, 10, 20))
+
+    # one download before and one after the cached range
+    wider = history(cached, 0, 30)
+    assert server.requests["HISTORY"] == 3
+    np.testing.assert_array_equal(wider, history(uncached, 0, 30))
+
+    # served from the cache alone
+    inside = history(cached, 5, 25)
+    assert server.requests["HISTORY"] == 3
+    np.testing.assert_array_equal(inside, history(uncached, 5, 25))
+
+    begin, end, data = HistoryCache(str(tmp_path)).load("EURUSD", "M1")
+    assert begin == (DAY - datetime(1970, 1, 1)).total_seconds()
+    assert (np.diff(data[0]) == 60).all()
+    assert data[0, 0] == begin and data[0, -1] == end
+
+
+def test_cache_of_each_granularity_is_apart(cached, uncached, server):
+    history(cached, 0, 10)
+    hours = history(cached, 0, 10, bt.TimeFrame.Minutes, 60)
+    assert server.requests["HISTORY"] == 2
+    np.testing.assert_array_equal(hours, history(uncached, 0, 10, bt.TimeFrame.Minutes, 60))
+
+
+def test_damaged_cache_is_downloaded_again(cached, uncached, server, tmp_path):
+    history(cached, 0, 10)
+    for f in tmp_path.glob("*.npz"):
+        f.write_bytes(b"damaged")
+    np.testing.assert_array_equal(history(cached, 0, 10), history(uncached, 0, 10))
+    assert server.requests["HISTORY"] == 2
@@ -0,0 +1,73 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from datetime import datetime, timedelta
+
+import backtrader as bt
+import pytest
+
+from backtradermql5.mt5indicator import getMTraderIndicator
+from backtradermql5.mt5store import MTraderStore
+
+from conftest import mockserver
+
+DAY = datetime(2026, 10, 1)
+
+
+class IndicatorStrategy(bt.Strategy):
+    params = (("store", None), ("bulk", True), ("values", None))
+
+    def __init__(self):
+        self.ind = getMTraderIndicator(
+            self.p.store,
+            self.data,
+            ("macd", "signal"),
+            indicator="Examples/MACD",
+            params=[12, 26, 9, "PRICE_CLOSE"],
+            bulk=self.p.bulk,
+        )()
+
+    def next(self):
+        self.p.values.append((self.data.datetime[0], self.ind.macd[0], self.ind.signal[0]))
+
+
+def run(bulk, runonce=False, hours=8):
+    """Values of the indicator on every bar and the INDICATOR requests of the run"""
+    values = list()
+    with mockserver() as server:
+        store = MTraderStore(host="127.0.0.1", ports=server.ports)
+        try:
+            cerebro = bt.Cerebro(stdstats=False, preload=runonce, runonce=runonce)
+            cerebro.adddata(
+                store.getdata(
+                    dataname="EURUSD",
+                    timeframe=bt.TimeFrame.Minutes,
+                    fromdate=DAY,
+                    todate=DAY + timedelta(hours=hours),
+                    historical=True,
+                )
+            )
+            cerebro.addstrategy(IndicatorStrategy, store=store, bulk=bulk, values=values)
+            cerebro.run()
+        finally:
+            store.stop()
+    return values, server.requests["INDICATOR"]
+
+
+@pytest.fixture(scope="module")
+def perbar():
+    return run(bulk=False)
+
+
+def test_bars_are_fetched_one_by_one(perbar):
+    values, requests = perbar
+    assert len(values) > 400
+    # attach and one request per bar
+    assert requests == len(values) + 1
+
+
+@pytest.mark.parametrize("runonce", [False, True])
+def test_range_fetch_matches_bars_fetched_one_by_one(perbar, runonce):
+    values, requests = run(bulk=True, runonce=runonce)
+    assert values == perbar[0]
+    # attach and a single range
+    assert requests == 2
@@ -0,0 +1,156 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+
+import backtrader as bt
+import pytest
+
+
+class OrderStrategy(bt.Strategy):
+    """Buys `orders` market orders of 0.01 on the first live bar and adds itself to `strats`"""
+
+    params = (("orders", 1), ("strats", None))
+
+    def __init__(self):
+        self.p.strats.append(self)
+        self.notes = collections.defaultdict(list)
+        self.sent = list()
+
+    def notify_order(self, order):
+        self.notes[order.ref].append(order.getstatusname())
+
+    def next(self):
+        if self.data._state == self.data._ST_LIVE and not self.sent:
+            self.sent = [self.buy(size=0.01) for _ in range(self.p.orders)]
+
+    def done(self):
+        return bool(self.sent) and all(self.notes[o.ref][-1:] in (["Completed"], ["Rejected"]) for o in self.sent)
+
+
+def cerebro(store, strategy, **kwargs):
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.setbroker(store.getbroker(use_positions=False))
+    fromdate = datetime.utcnow() - timedelta(minutes=30)
+    cerebro.adddata(store.getdata(dataname="EURUSD", timeframe=bt.TimeFrame.Minutes, fromdate=fromdate))
+    cerebro.addstrategy(strategy, **kwargs)
+    return cerebro
+
+
+def run(store, runlive, **kwargs):
+    strats = list()
+    runlive(cerebro(store, OrderStrategy, strats=strats, **kwargs), done=lambda: bool(strats) and strats[0].done())
+    return strats[0]
+
+
+def test_filled_orders_leave_nothing_in_flight(store, server, runlive):
+    strat = run(store, runlive, orders=3)
+    assert [strat.notes[o.ref].count("Completed") for o in strat.sent] == [1, 1, 1]
+    assert server.requests["TRADE"] == 3
+    assert store._ordersinflight == 0
+    assert not store._pendingtrans
+    assert store.broker.getposition(strat.data).size == pytest.approx(0.03)
+
+
+def test_deal_before_order_reply_is_kept_pending(store, server, runlive):
+    oids = itertools.count(5000)
+    pending = list()
+
+    def trade(request):
+        # the terminal pushes the deal before it answers the order request
+        oid, price = next(oids), 1.1
+        volume = request["volume"]
+        deal = {"action": "TRADE_ACTION_DEAL", "order": oid, "symbol": request["symbol"], "type": request["actionType"]}
+        deal.update(volume=volume, price=price)
+        server.publish_event(deal, {"result": "TRADE_RETCODE_DONE", "order": oid, "volume": volume, "price": price})
+        for _ in range(100):
+            if store._pendingtrans.get(oid):
+                pending.append(oid)
+                break
+            time.sleep(0.01)
+        server._reply({"error": False, "retcode": 10009, "order": oid, "volume": volume, "price": price})
+
+    server._handlers["TRADE"] = trade
+    strat = run(store, runlive)
+    assert pending == [5000]
+    assert strat.notes[strat.sent[0].ref].count("Completed") == 1
+    assert store._ordersinflight == 0
+    assert not store._pendingtrans
+    assert store.broker.getposition(strat.data).size == pytest.approx(0.01)
+
+
+def test_failed_order_request_is_rejected(store, server, runlive):
+    construct = store.oapi.construct_request
+
+    def failing(**kwargs):
+        if kwargs.get("action") == "TRADE":
+            raise KeyError("Unknown key in **kwargs ERROR")
+        return construct(**kwargs)
+
+    store.oapi.construct_request = failing
+    strat = run(store, runlive, orders=2)
+    assert [strat.notes[o.ref][-1] for o in strat.sent] == ["Rejected", "Rejected"]
+    assert server.requests["TRADE"] == 0
+    assert store._ordersinflight == 0
+    assert not store._pendingtrans
+
+
+class TrailStrategy(bt.Strategy):
+    def __init__(self):
+        self.notes = collections.defaultdict(list)
+        self.stops = None
+
+    def notify_order(self, order):
+        self.notes[order.ref].append(order.getstatusname())
+
+    def next(self):
+        if self.stops is not None:
+            return
+        self.sell_trail = self.sell(size=0.01, exectype=bt.Order.StopTrail, trailamount=0.001)
+        self.buy_trail = self.buy(size=0.01, exectype=bt.Order.StopTrail, trailpercent=0.001)
+        self.cancelled = self.sell(size=0.01, exectype=bt.Order.StopTrail, trailamount=0.0005)
+        self.cancel(self.cancelled)
+        self.stops = (self.broker.trails.stop(self.sell_trail.ref), self.broker.trails.stop(self.buy_trail.ref))
+
+
+def test_trailing_stops_trigger_on_live_prices(store, server):
+    trades = list()
+    trade = server._handlers["TRADE"]
+    server._handlers["TRADE"] = lambda request: (trades.append(request["actionType"]), trade(request))
+
+    c = bt.Cerebro(stdstats=False)
+    c.setbroker(store.getbroker(use_positions=False))
+    c.adddata(store.getdata(dataname="EURUSD", timeframe=bt.TimeFrame.Ticks, fromdate=datetime.utcnow()))
+    c.addstrategy(TrailStrategy)
+    stop = threading.Event()
+
+    def ticker():
+        # the buy stop is hit by the rise to 1.1020, the sell stop by the fall from there to 1.1009
+        prices = [1.1000, 1.1010, 1.1020, 1.1015, 1.1012, 1.1009, 1.1005, 1.0990]
+        time.sleep(0.5)
+        for i in itertools.count():
+            if stop.is_set():
+                return
+            if i == len(prices) + 20:
+                c.runstop()
+            p = prices[min(i, len(prices) - 1)]
+            server.publish_live("EURUSD", "TICK", [int(time.time() * 1000), p, p + 0.0002])
+            time.sleep(0.2 if i < len(prices) else 0.05)
+
+    thread = threading.Thread(target=ticker, daemon=True)
+    thread.start()
+    try:
+        strat = c.run()[0]
+    finally:
+        stop.set()
+        thread.join()
+
+    assert strat.stops == pytest.approx((1.099, 1.1013002))
+    assert trades == ["ORDER_TYPE_BUY", "ORDER_TYPE_SELL"]
+    assert strat.notes[strat.buy_trail.ref] == ["Submitted", "Accepted", "Completed"]
+    assert strat.notes[strat.sell_trail.ref] == ["Submitted", "Accepted", "Completed"]
+    assert strat.notes[strat.cancelled.ref] == ["Submitted", "Accepted", "Canceled"]
+    assert not store.broker.trails._trails